@@ -0,0 +1,152 @@
+"""
+大模型请求的准入控制
+
+- UserRateLimiter: 每个用户一个令牌桶，超出速率返回 429
+- LLMAdmission: 全局限制同时进行的大模型调用数，超出的请求在有界队列中按先后顺序等待；
+  队列已满、或预计等待后已赶不上请求截止时间时立即拒绝（503），不再白白占用线程
+两种拒绝都带有 Retry-After 建议值。
+"""
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from cancellation import QueryCancelled
+from metrics import metrics
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入，status 为建议的 HTTP 状态码"""
+    status = 503
+    error_code = 'SERVICE_OVERLOADED'
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class RateLimited(AdmissionRejected):
+    status = 429
+    error_code = 'RATE_LIMITED'
+
+
+class Overloaded(AdmissionRejected):
+    status = 503
+    error_code = 'SERVICE_OVERLOADED'
+
+
+class UserRateLimiter:
+    """按用户的令牌桶限流，rate 为每秒补充的令牌数，burst 为桶容量"""
+
+    def __init__(self, rate, burst, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def acquire(self, user_id):
+        """消耗一个令牌，令牌不足时抛出 RateLimited"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[user_id] = (tokens, now)
+                metrics.incr('admission.rate_limited')
+                raise RateLimited("请求过于频繁", (1 - tokens) / self.rate)
+
+            self._buckets[user_id] = (tokens - 1, now)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+
+
+class LLMAdmission:
+    """
+    全局大模型并发上限 + 有界等待队列 + 按截止时间提前拒绝
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32, max_wait=60, initial_latency=3.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiters = deque()
+        # 大模型调用耗时的指数滑动平均，用于估算排队时间
+        self._latency = initial_latency
+
+    def estimated_wait(self, position):
+        """排在第 position 位（从 0 开始）时预计的等待秒数"""
+        return (position // self.max_concurrent + 1) * self._latency if position >= 0 else 0
+
+    @contextmanager
+    def slot(self, deadline=None, cancel_token=None):
+        """
+        占用一个大模型调用名额。deadline 为 time.monotonic() 时间点，
+        到达前必须拿到名额并完成调用，否则抛出 Overloaded。
+        """
+        deadline = deadline or time.monotonic() + self.max_wait
+        ticket = object()
+        queued_at = time.monotonic()
+
+        with self._cond:
+            must_wait = self._waiters or self._active >= self.max_concurrent
+            if must_wait and len(self._waiters) >= self.max_queue:
+                metrics.incr('admission.shed.queue_full')
+                raise Overloaded("大模型请求排队已满", self.estimated_wait(len(self._waiters)))
+
+            position = len(self._waiters) if must_wait else -1
+            if time.monotonic() + self.estimated_wait(position) + self._latency > deadline:
+                metrics.incr('admission.shed.deadline')
+                raise Overloaded("预计排队时间超过请求截止时间", self.estimated_wait(position))
+
+            self._waiters.append(ticket)
+            self._publish()
+            try:
+                while not (self._waiters[0] is ticket and self._active < self.max_concurrent):
+                    if cancel_token and cancel_token.cancelled:
+                        raise QueryCancelled(f"排队时请求已取消: {cancel_token.request_id}")
+                    # 剩余时间已不够完成一次调用，提前放弃
+                    remaining = deadline - self._latency - time.monotonic()
+                    if remaining <= 0:
+                        metrics.incr('admission.shed.deadline')
+                        raise Overloaded("排队超过请求截止时间", self.estimated_wait(self._waiters.index(ticket)))
+                    self._cond.wait(min(remaining, 0.25))
+                self._waiters.popleft()
+                self._active += 1
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                self._publish()
+                self._cond.notify_all()
+                raise
+            self._publish()
+
+        metrics.observe('llm.queue_wait_ms', (time.monotonic() - queued_at) * 1000)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._latency = 0.8 * self._latency + 0.2 * elapsed
+                self._publish()
+                self._cond.notify_all()
+            metrics.observe('llm.latency_ms', elapsed * 1000)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': self._active,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': len(self._waiters),
+                'max_queue': self.max_queue,
+                'avg_latency_seconds': round(self._latency, 3)
+            }
+
+    def _publish(self):
+        metrics.set_gauge('llm.active', self._active)
+        metrics.set_gauge('llm.queue_depth', len(self._waiters))
@@ -1,6 +1,9 @@
 from typing import Dict, List
+import contextvars
 import psycopg2
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from enum import Enum
 import json
@@ -8,19 +11,39 @@ from openai import OpenAI
 import os
 from dotenv import load_dotenv
 import re
+import threading
+import uuid
+
+from admission import AdmissionRejected, LLMAdmission, Overloaded
+from answer_payload import (MESSAGE_EMPTY, MESSAGE_NOT_UNDERSTOOD, MESSAGE_OK, MESSAGE_QUERY_ERROR,
+                            MESSAGE_TOO_EXPENSIVE)
+from cancellation import CancelToken, QueryCancelled
+from cost_guard import DEFAULT_BUDGET, CostGuard, QueryTooExpensive
+from conversation import (ConversationStore, apply_refinement, describe_refinement, looks_like_follow_up,
+                          parse_refinement)
+from db_pool import BlockingConnectionPool
+from db_router import DatabaseRouter
+from intent_classifier import LabelLog, load_intent_classifier
+from log_setup import configure_logging
+from metrics import metrics
+from pagination import (InvalidCursor, ResultHandleStore, build_page_plan, first_page_sql, make_cursor,
+                        next_page_sql, parse_cursor)
+from precompute import DEFAULT_QUERY_TYPES, AnswerPrecomputer
+from rollup_job import RollupFreshness
+from prefork import budget_shortfall, per_worker_share
+from scheduler import FAST_LANE, SLOW_LANE
+from semantic_cache import SemanticCache, guard_tokens
+from sql_analyzer import same_params, single_statement, sql_fingerprint
+from telemetry import (SOURCE_CACHE, SOURCE_CLASSIFIER, SOURCE_FOLLOW_UP, SOURCE_LLM, SOURCE_PRECOMPUTED,
+                       SOURCE_REFINEMENT, SOURCE_TEMPLATE, TelemetrySink, add_llm_usage, add_stage_since, set_source,
+                       stage, trace_query)
+from text_features import normalize_question
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging with file output
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('ai_processor.log'),  # Save logs to a file
-        logging.StreamHandler()  # Also print logs to console
-    ]
-)
+# 统一的异步 JSON 日志（见 log_setup.py）
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # QueryType Enum
@@ -40,10 +63,152 @@ class QueryType(Enum):
     ANNOUNCEMENT = "announcement"
     STUDY_RECOMMENDATION = "study_recommendation"
 
+# 复合问题的子句分隔：标点以及常见的并列连接词
+COMPOUND_SPLIT_PATTERN = re.compile(r'[，,；;？?。！!]|还有|以及|另外|并且|同时')
+
+# 各查询类型的标准 SQL 模板，同时作为提示词中的示例
+# params 为根据学生ID生成参数列表的函数；读汇总表的模板另有 rollup（依赖的汇总表）和 raw_sql（读原始事件表的等价 SQL），
+# 汇总表过期时改用 raw_sql
+SQL_TEMPLATES = {
+    QueryType.EXPERIMENT_REPORT: {
+        'questions': ["我有哪些作业没交？", "未提交的实验报告"],
+        'sql': "SELECT ins.serial_number, ins.course_content, ins.report_deadline, CASE WHEN ins.report_deadline < CURRENT_DATE THEN '已逾期' ELSE '未逾期' END as status, CASE WHEN ins.report_deadline - CURRENT_DATE <= 3 THEN '紧急' WHEN ins.report_deadline - CURRENT_DATE <= 7 THEN '即将到期' ELSE '正常' END as urgency FROM Intelligent_Supervision ins LEFT JOIN LabReport lr ON ins.serial_number = lr.serial_number AND lr.student_id = %s WHERE lr.submitted IS FALSE OR lr.submitted IS NULL ORDER BY ins.report_deadline, ins.serial_number",
+        'params': lambda user_id: [user_id],
+        'explanation': "查询学生未提交的实验报告及其紧急程度"
+    },
+    QueryType.GRADE_INQUIRY: {
+        'questions': ["我的成绩怎么样？", "我得了多少分？"],
+        'sql': "SELECT ins.course_content, sg.grade, sg.submit_date, sg.late_days, sg.comments, CASE WHEN sg.grade >= 90 THEN '优秀' WHEN sg.grade >= 80 THEN '良好' WHEN sg.grade >= 70 THEN '中等' WHEN sg.grade >= 60 THEN '及格' ELSE '不及格' END as grade_level FROM StudentGrades sg JOIN Intelligent_Supervision ins ON sg.serial_number = ins.serial_number WHERE sg.student_id = %s ORDER BY sg.submit_date DESC, sg.serial_number",
+        'params': lambda user_id: [user_id],
+        'explanation': "查询学生的成绩记录和等级评价"
+    },
+    QueryType.TEACHER_FEEDBACK: {
+        'questions': ["老师对我有什么反馈？", "教师评价"],
+        'sql': "SELECT tf.feedback_type, tf.feedback_content, tf.feedback_date, tf.teacher_name, ins.course_content, CASE WHEN tf.feedback_type = 'praise' THEN '表扬' WHEN tf.feedback_type = 'reminder' THEN '提醒' WHEN tf.feedback_type = 'warning' THEN '警告' WHEN tf.feedback_type = 'suggestion' THEN '建议' ELSE '其他' END as feedback_type_zh FROM TeacherFeedback tf LEFT JOIN Intelligent_Supervision ins ON tf.serial_number = ins.serial_number WHERE tf.student_id = %s ORDER BY tf.feedback_date DESC LIMIT 10",
+        'params': lambda user_id: [user_id],
+        'explanation': "查询教师对学生的最新反馈信息"
+    },
+    QueryType.LEARNING_ANALYTICS: {
+        'questions': ["我的学习时间统计", "学习行为分析"],
+        'sql': "SELECT ins.course_content, SUM(lad.activity_count) as total_activities, SUM(lad.total_minutes) as total_minutes, SUM(lad.total_minutes)::numeric / NULLIF(SUM(lad.duration_count), 0) as avg_duration, lad.device_type, COUNT(DISTINCT lad.activity_day) as active_days FROM LearningActivityDaily lad JOIN Intelligent_Supervision ins ON lad.serial_number = ins.serial_number WHERE lad.student_id = %s GROUP BY ins.course_content, lad.device_type ORDER BY total_minutes DESC",
+        'params': lambda user_id: [user_id],
+        'rollup': 'LearningActivityDaily',
+        'raw_sql': "SELECT ins.course_content, COUNT(la.activity_id) as total_activities, SUM(la.duration_minutes) as total_minutes, AVG(la.duration_minutes) as avg_duration, la.device_type, COUNT(DISTINCT DATE(la.activity_date)) as active_days FROM LearningActivity la JOIN Intelligent_Supervision ins ON la.serial_number = ins.serial_number WHERE la.student_id = %s GROUP BY ins.course_content, la.device_type ORDER BY total_minutes DESC",
+        'explanation': "分析学生的学习行为和时间分布"
+    },
+    QueryType.PEER_COMPARISON: {
+        'questions': ["我和其他同学相比怎么样？", "班级排名"],
+        'sql': "WITH student_stats AS (SELECT s.student_id, s.student_name, COUNT(CASE WHEN lr.submitted = TRUE THEN 1 END) as completed, AVG(sg.grade) as avg_grade FROM students s LEFT JOIN LabReport lr ON s.student_id = lr.student_id LEFT JOIN StudentGrades sg ON s.student_id = sg.student_id GROUP BY s.student_id, s.student_name), ranked_students AS (SELECT *, RANK() OVER (ORDER BY completed DESC, avg_grade DESC) as rank FROM student_stats) SELECT rs.rank, rs.completed, rs.avg_grade, (SELECT COUNT(*) FROM ranked_students) as total_students FROM ranked_students rs WHERE rs.student_id = %s",
+        'params': lambda user_id: [user_id],
+        'explanation': "比较当前学生与同班同学的学习表现"
+    },
+    QueryType.UNIT_TEST: {
+        'questions': ["最近有什么测试？", "单元测试安排"],
+        'sql': "SELECT ins.course_content, ins.unit_number, ins.unit_test_date, ins.unit_test_date - CURRENT_DATE as days_left FROM Intelligent_Supervision ins WHERE ins.unit_test_date >= CURRENT_DATE ORDER BY ins.unit_test_date, ins.unit_number LIMIT 10",
+        'params': lambda user_id: [],
+        'explanation': "查询即将进行的单元测试及剩余天数"
+    },
+    QueryType.ANNOUNCEMENT: {
+        'questions': ["有什么重要通知？", "最新公告"],
+        'sql': "SELECT title, content, announcement_type, publish_date, expire_date, CASE WHEN announcement_type = 'urgent' THEN '紧急' WHEN announcement_type = 'deadline' THEN '截止提醒' WHEN announcement_type = 'exam' THEN '考试通知' ELSE '一般通知' END as type_zh FROM Announcements WHERE is_active = TRUE AND (target_students IS NULL OR target_students::text LIKE %s) AND (expire_date IS NULL OR expire_date >= CURRENT_DATE) ORDER BY CASE WHEN announcement_type = 'urgent' THEN 1 ELSE 2 END, publish_date DESC, announcement_id DESC LIMIT 5",
+        'params': lambda user_id: [f'%"{user_id}"%'],
+        'explanation': "查询针对该学生的有效通知公告"
+    },
+    QueryType.STUDY_RECOMMENDATION: {
+        'questions': ["我应该重点学习什么？", "学习建议"],
+        'sql': "SELECT ins.course_content, ins.online_learning_date, ins.report_deadline, CASE WHEN lr.submitted IS FALSE OR lr.submitted IS NULL THEN '需要完成实验报告' END as recommendation, CASE WHEN ins.report_deadline - CURRENT_DATE <= 7 THEN '高优先级' WHEN ins.report_deadline - CURRENT_DATE <= 14 THEN '中优先级' ELSE '低优先级' END as priority FROM Intelligent_Supervision ins LEFT JOIN LabReport lr ON ins.serial_number = lr.serial_number AND lr.student_id = %s WHERE lr.submitted IS FALSE OR lr.submitted IS NULL ORDER BY ins.report_deadline",
+        'params': lambda user_id: [user_id],
+        'explanation': "基于截止日期和完成情况给出学习建议"
+    },
+    QueryType.RESOURCE_USAGE: {
+        'questions': ["我看了多少学习资料？", "资源使用情况"],
+        'sql': "SELECT rad.resource_type, rad.resource_name, SUM(rad.access_count) as access_count, SUM(rad.total_seconds) as total_seconds, SUM(rad.total_seconds)::numeric / NULLIF(SUM(rad.duration_count), 0) as avg_seconds, MAX(rad.last_access) as last_access, CASE WHEN rad.resource_type = 'lecture_video' THEN '讲课视频' WHEN rad.resource_type = 'slides' THEN '课件' WHEN rad.resource_type = 'example_code' THEN '示例代码' WHEN rad.resource_type = 'reference' THEN '参考资料' ELSE '其他' END as resource_type_zh FROM ResourceAccessDaily rad WHERE rad.student_id = %s GROUP BY rad.resource_type, rad.resource_name ORDER BY total_seconds DESC",
+        'params': lambda user_id: [user_id],
+        'rollup': 'ResourceAccessDaily',
+        'raw_sql': "SELECT ra.resource_type, ra.resource_name, COUNT(*) as access_count, SUM(ra.access_duration_seconds) as total_seconds, AVG(ra.access_duration_seconds) as avg_seconds, MAX(ra.access_date) as last_access, CASE WHEN ra.resource_type = 'lecture_video' THEN '讲课视频' WHEN ra.resource_type = 'slides' THEN '课件' WHEN ra.resource_type = 'example_code' THEN '示例代码' WHEN ra.resource_type = 'reference' THEN '参考资料' ELSE '其他' END as resource_type_zh FROM ResourceAccess ra WHERE ra.student_id = %s GROUP BY ra.resource_type, ra.resource_name ORDER BY total_seconds DESC",
+        'explanation': "统计学生对各类学习资源的使用情况"
+    }
+}
+
+
+# 规范化后的模板问题 -> 查询类型，命中时无需调用大模型
+TEMPLATE_QUESTIONS = {
+    normalize_question(question): query_type
+    for query_type, template in SQL_TEMPLATES.items()
+    for question in template['questions']
+}
+
+# 模板 SQL 的分页计划，预计算答案登记结果句柄时直接使用
+TEMPLATE_PAGE_PLANS = {query_type: build_page_plan(template['sql']) for query_type, template in SQL_TEMPLATES.items()}
+
+
+# 关键词意图识别表（只读，多进程部署时在 fork 前加载、各进程共享）
+INTENT_KEYWORDS = {
+    QueryType.EXPERIMENT_REPORT: [
+        "作业", "实验报告", "未提交", "没交", "逾期", "截止", "deadline", "report", "assignment", "homework", "补交"
+    ],
+    QueryType.UNIT_TEST: [
+        "测试", "考试", "单元测试", "unit test", "exam", "quiz", "考核", "测验", "考试安排"
+    ],
+    QueryType.LEARNING_SCHEDULE: [
+        "学习安排", "课程安排", "时间表", "schedule", "计划", "日程", "这周", "下周", "最近", "什么时候学"
+    ],
+    QueryType.COURSE_INFO: [
+        "课程内容", "学习内容", "课程详情", "course", "内容", "学什么", "涵盖", "包含", "课程介绍"
+    ],
+    QueryType.STUDENT_PROGRESS: [
+        "进度", "完成情况", "统计", "progress", "完成率", "学习状况", "表现", "整体情况"
+    ],
+    QueryType.DEADLINE_WARNING: [
+        "即将到期", "快到期", "紧急", "提醒", "警告", "urgent", "soon", "approaching", "催促"
+    ],
+    QueryType.TEACHER_FEEDBACK: [
+        "老师", "教师", "反馈", "评价", "建议", "feedback", "评语", "意见", "指导"
+    ],
+    QueryType.LEARNING_ANALYTICS: [
+        "学习时长", "访问记录", "学习行为", "活跃度", "学习习惯", "analytics", "统计分析"
+    ],
+    QueryType.PEER_COMPARISON: [
+        "同学", "其他人", "排名", "比较", "平均", "对比", "相比", "comparison", "排行"
+    ],
+    QueryType.RESOURCE_USAGE: [
+        "资源", "视频", "课件", "资料", "下载", "观看", "学习资源", "材料"
+    ],
+    QueryType.GRADE_INQUIRY: [
+        "成绩", "分数", "评分", "grade", "score", "多少分", "得分"
+    ],
+    QueryType.ANNOUNCEMENT: [
+        "通知", "公告", "消息", "announcement", "新闻", "最新", "重要通知"
+    ],
+    QueryType.STUDY_RECOMMENDATION: [
+        "建议", "推荐", "应该", "怎么学", "如何", "学习方法", "复习", "准备"
+    ]
+}
+
+
+def render_template_examples(user_id):
+    """把 SQL_TEMPLATES 渲染为提示词中的示例段落"""
+    blocks = []
+    for query_type, template in SQL_TEMPLATES.items():
+        example = {
+            'query_type': query_type.value,
+            'sql': template['sql'],
+            'params': template['params'](user_id),
+            'explanation': template['explanation']
+        }
+        questions = ' / '.join(f'"{q}"' for q in template['questions'])
+        body = json.dumps(example, ensure_ascii=False, indent=4).replace('\n', '\n        ')
+        blocks.append(f"问题: {questions}\n        ```json\n        {body}\n        ```")
+    return '\n\n        '.join(blocks)
+
+
 class AIQueryProcessor:
-    def __init__(self, openai_api_key=None, db_config=None, model="gpt-4o", base_url=None):
+    def __init__(self, openai_api_key=None, db_config=None, model="gpt-4o", base_url=None, worker_count=1,
+                 replica_configs=None):
         """
         Initialize AI Query Processor
+        worker_count: 部署的工作进程数，数据库连接与大模型并发的全局额度按此分摊到本进程
+        replica_configs: 只读副本的连接配置列表（每项覆盖主库配置中的字段），未指定时读取 DB_REPLICAS
         """
         self.openai_api_key = openai_api_key or os.getenv('OPENAI_API_KEY')
         if not self.openai_api_key:
@@ -60,15 +225,121 @@ class AIQueryProcessor:
         self.model = model
         self.base_url = base_url or os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
 
-        # Validate database connection
+        self.worker_count = max(1, int(worker_count))
+
+        # Create connection pool (also validates database connectivity)
+        # DB_POOL_MAX 指定单进程连接数；未指定时由全部进程共用的 DB_CONNECTION_BUDGET 分摊
+        pool_max = os.getenv('DB_POOL_MAX')
+        connection_budget = int(os.getenv('DB_CONNECTION_BUDGET', 10))
+        pool_size = int(pool_max) if pool_max else per_worker_share(connection_budget, self.worker_count, minimum=2)
+        shortfall = None if pool_max else budget_shortfall(connection_budget, self.worker_count, 2)
+        if shortfall:
+            # gunicorn.conf.py 中会拒绝启动；uvicorn 等其他方式启动时只能提醒
+            logger.warning("DB_CONNECTION_BUDGET 不足: %s，连接总数将超出预算", shortfall)
         try:
-            conn = psycopg2.connect(**self.db_config)
-            conn.close()
-            logger.info("Database connection validated successfully")
+            primary_pool = BlockingConnectionPool(
+                minconn=int(os.getenv('DB_POOL_MIN', 1)),
+                maxconn=pool_size,
+                db_config=self.db_config
+            )
+            logger.info("Database connection pool created successfully")
         except Exception as e:
-            logger.error(f"Database connection failed: {str(e)}")
+            logger.error("Database connection failed: %s", e)
             raise ValueError(f"Failed to connect to database: {str(e)}")
 
+        # 只读副本：DB_REPLICAS 为 JSON 列表，每项覆盖主库配置中的字段，如 [{"host": "replica1"}]。
+        # 每个副本是独立的数据库服务器，连接数与主库相同；启动时不建立连接，副本暂时不可达不影响启动
+        if replica_configs is None:
+            replica_configs = json.loads(os.getenv('DB_REPLICAS', '[]'))
+        replicas = []
+        for replica in replica_configs:
+            config = {**self.db_config, **replica}
+            replicas.append((f"{config['host']}:{config['port']}",
+                             BlockingConnectionPool(minconn=0, maxconn=pool_size, db_config=config)))
+        # 生成的只读查询优先分到副本；db_pool 默认借出主库连接，read_only=True 时按副本状态路由
+        self.db_pool = DatabaseRouter(
+            primary_pool,
+            replicas,
+            max_lag_seconds=float(os.getenv('DB_REPLICA_MAX_LAG_SECONDS', 5)),
+            check_interval=float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 2)),
+            read_after_write_seconds=float(os.getenv('DB_READ_AFTER_WRITE_SECONDS', 10))
+        )
+        if replicas:
+            logger.info("只读副本: %s", ', '.join(name for name, _ in replicas))
+
+        # 推测执行：LLM 生成 SQL 期间，先在连接池上执行预测意图的模板 SQL
+        self.speculative_execution = os.getenv('SPECULATIVE_EXECUTION', 'true').lower() == 'true'
+        self.query_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('QUERY_WORKERS', 4)),
+            thread_name_prefix='query'
+        )
+        # 结果句柄：翻页时重新执行缓存的 SQL，无需再次调用大模型
+        self.result_handles = ResultHandleStore(
+            max_handles=int(os.getenv('RESULT_HANDLE_MAX', 10000)),
+            ttl_seconds=int(os.getenv('RESULT_HANDLE_TTL', 1800))
+        )
+        # 结果导出：服务端游标每次取 EXPORT_BATCH_SIZE 行；每个导出在下载结束前一直占用一个连接，
+        # 同时进行的导出数不超过 EXPORT_MAX_CONCURRENT，以免占满连接池
+        self.export_batch_size = int(os.getenv('EXPORT_BATCH_SIZE', 2000))
+        self.export_slots = threading.BoundedSemaphore(int(os.getenv('EXPORT_MAX_CONCURRENT', 2)))
+        # 复合问题的子问题并行处理，与 query_executor 分开以免互相等待
+        self.max_sub_questions = int(os.getenv('MAX_SUB_QUESTIONS', 4))
+        self.subquery_executor = ThreadPoolExecutor(
+            max_workers=self.max_sub_questions,
+            thread_name_prefix='subquery'
+        )
+
+        # 全局大模型并发上限与等待队列（全部工作进程合计，按进程数分摊）
+        self.llm_admission = LLMAdmission(
+            max_concurrent=per_worker_share(int(os.getenv('LLM_MAX_CONCURRENT', 8)), self.worker_count),
+            max_queue=per_worker_share(int(os.getenv('LLM_MAX_QUEUE', 32)), self.worker_count, minimum=0),
+            max_wait=int(os.getenv('LLM_MAX_QUEUE_WAIT', 60))
+        )
+
+        # 意图分类器：置信度达到阈值时直接使用该意图的模板 SQL，不调用大模型
+        self.intent_classifier = load_intent_classifier(os.getenv('INTENT_MODEL_PATH', 'models/intent_nb.npz'))
+        self.intent_skip_threshold = float(os.getenv('INTENT_SKIP_THRESHOLD', 0.97))
+        # 记录大模型选择的 query_type，作为分类器的训练数据（设为空字符串关闭）
+        label_log_path = os.getenv('INTENT_LABEL_LOG', 'intent_labels.jsonl')
+        self.intent_label_log = LabelLog(label_log_path) if label_log_path else None
+
+        # 语义缓存：与已回答问题足够相似时复用大模型为其生成的 SQL（容量设为 0 关闭）
+        cache_size = int(os.getenv('SEMANTIC_CACHE_SIZE', 2000))
+        self.semantic_cache = SemanticCache(
+            max_entries=cache_size,
+            threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.8)),
+            ttl_seconds=int(os.getenv('SEMANTIC_CACHE_TTL', 86400))
+        ) if cache_size > 0 else None
+
+        # 非模板 SQL 执行前按 EXPLAIN 估算代价检查预算（COST_GUARD_MAX_COST 设为 0 关闭），
+        # 超出预算时让大模型重新生成 COST_GUARD_RETRIES 次；每条语句都有执行时间上限
+        max_cost = float(os.getenv('COST_GUARD_MAX_COST', DEFAULT_BUDGET['max_cost']))
+        self.cost_guard = CostGuard(
+            max_cost=max_cost,
+            max_rows=float(os.getenv('COST_GUARD_MAX_ROWS', DEFAULT_BUDGET['max_rows'])),
+            budgets=json.loads(os.getenv('COST_GUARD_BUDGETS', '{}'))
+        ) if max_cost > 0 else None
+        self.cost_guard_retries = int(os.getenv('COST_GUARD_RETRIES', 1))
+        self.statement_timeout_ms = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+        # 查询遥测：每个问题的来源、SQL 指纹、各阶段耗时和 token 用量，攒批写入压缩分段（目录设为空字符串关闭）
+        telemetry_dir = os.getenv('TELEMETRY_DIR', 'telemetry')
+        self.telemetry = TelemetrySink(
+            telemetry_dir,
+            batch_size=int(os.getenv('TELEMETRY_BATCH_SIZE', 256)),
+            flush_interval=float(os.getenv('TELEMETRY_FLUSH_SECONDS', 5)),
+            segment_records=int(os.getenv('TELEMETRY_SEGMENT_RECORDS', 100000)),
+            max_segments=int(os.getenv('TELEMETRY_MAX_SEGMENTS', 200))
+        ) if telemetry_dir else None
+
+        # 多轮对话：每个用户最近一轮的查询与结果，追问时在内存中细化，或作为大模型的上下文
+        self.conversations = ConversationStore(
+            max_users=int(os.getenv('CONVERSATION_MAX_USERS', 5000)),
+            max_rows=int(os.getenv('CONVERSATION_MAX_ROWS', 200000)),
+            max_rows_per_user=int(os.getenv('CONVERSATION_MAX_ROWS_PER_USER', 500)),
+            ttl_seconds=int(os.getenv('CONVERSATION_TTL', 900))
+        )
+
         # Initialize OpenAI client
         try:
             self.client = OpenAI(
@@ -79,64 +350,30 @@ class AIQueryProcessor:
             self.client.models.list()  # Simple API call to verify key and endpoint
             logger.info("OpenAI client initialized successfully")
         except Exception as e:
-            logger.error(f"OpenAI client initialization failed: {str(e)}")
+            logger.error("OpenAI client initialization failed: %s", e)
             raise ValueError(f"Failed to initialize OpenAI client: {str(e)}")
 
-        self.intent_patterns = {
-            QueryType.EXPERIMENT_REPORT: ['作业', '实验报告', '未提交', '截止', '逾期'],
-            QueryType.GRADE_INQUIRY: ['成绩', '分数', '评分', '得分'],
-            QueryType.STUDENT_PROGRESS: ['进度', '完成情况', '学习状况'],
-            QueryType.TEACHER_FEEDBACK: ['老师', '反馈', '评价', '建议'],
-            QueryType.LEARNING_SCHEDULE: ['安排', '计划', '时间表', '日程'],
-            # Removed QueryType.GENERAL_CHAT and QueryType.MOTIVATION as they are not in QueryType Enum
-        }
-        self.intent_keywords = self._init_intent_keywords()
+        self.intent_keywords = INTENT_KEYWORDS
+
+        # 热门模板问题的预计算答案：后台定期为活跃学生算好并随源表变更增量刷新（PRECOMPUTE_INTERVAL 设为 0 关闭）
+        precompute_interval = float(os.getenv('PRECOMPUTE_INTERVAL', 30))
+        # 汇总表水位缺失或超过 ROLLUP_MAX_LAG_SECONDS 未更新（rollup_job.py 没在运行）时，分析模板改读原始事件表
+        self.rollup_freshness = RollupFreshness(
+            self.db_pool,
+            max_lag_seconds=int(os.getenv('ROLLUP_MAX_LAG_SECONDS', 900)),
+            check_seconds=int(os.getenv('ROLLUP_CHECK_SECONDS', 30))
+        )
+        self.answer_store = AnswerPrecomputer(
+            self.db_pool,
+            lambda query_type, rows: self._format_answer(QueryType(query_type), rows, '', None),
+            query_types=[t for t in os.getenv('PRECOMPUTE_QUERY_TYPES', ','.join(DEFAULT_QUERY_TYPES)).split(',') if t],
+            interval=precompute_interval,
+            active_days=int(os.getenv('PRECOMPUTE_ACTIVE_DAYS', 14)),
+            rollup_freshness=self.rollup_freshness,
+            db_config=self.db_config
+        ) if precompute_interval > 0 else None
         logger.info("AIQueryProcessor initialized successfully")
 
-    def _init_intent_keywords(self):
-        """Initialize intent recognition keywords"""
-        return {
-            QueryType.EXPERIMENT_REPORT: [
-                "作业", "实验报告", "未提交", "没交", "逾期", "截止", "deadline", "report", "assignment", "homework", "补交"
-            ],
-            QueryType.UNIT_TEST: [
-                "测试", "考试", "单元测试", "unit test", "exam", "quiz", "考核", "测验", "考试安排"
-            ],
-            QueryType.LEARNING_SCHEDULE: [
-                "学习安排", "课程安排", "时间表", "schedule", "计划", "日程", "这周", "下周", "最近", "什么时候学"
-            ],
-            QueryType.COURSE_INFO: [
-                "课程内容", "学习内容", "课程详情", "course", "内容", "学什么", "涵盖", "包含", "课程介绍"
-            ],
-            QueryType.STUDENT_PROGRESS: [
-                "进度", "完成情况", "统计", "progress", "完成率", "学习状况", "表现", "整体情况"
-            ],
-            QueryType.DEADLINE_WARNING: [
-                "即将到期", "快到期", "紧急", "提醒", "警告", "urgent", "soon", "approaching", "催促"
-            ],
-            QueryType.TEACHER_FEEDBACK: [
-                "老师", "教师", "反馈", "评价", "建议", "feedback", "评语", "意见", "指导"
-            ],
-            QueryType.LEARNING_ANALYTICS: [
-                "学习时长", "访问记录", "学习行为", "活跃度", "学习习惯", "analytics", "统计分析"
-            ],
-            QueryType.PEER_COMPARISON: [
-                "同学", "其他人", "排名", "比较", "平均", "对比", "相比", "comparison", "排行"
-            ],
-            QueryType.RESOURCE_USAGE: [
-                "资源", "视频", "课件", "资料", "下载", "观看", "学习资源", "材料"
-            ],
-            QueryType.GRADE_INQUIRY: [
-                "成绩", "分数", "评分", "grade", "score", "多少分", "得分"
-            ],
-            QueryType.ANNOUNCEMENT: [
-                "通知", "公告", "消息", "announcement", "新闻", "最新", "重要通知"
-            ],
-            QueryType.STUDY_RECOMMENDATION: [
-                "建议", "推荐", "应该", "怎么学", "如何", "学习方法", "复习", "准备"
-            ]
-        }
-
     def _classify_query_intent(self, question):
         """Classify query intent using keywords"""
         question_lower = question.lower()
@@ -152,60 +389,693 @@ class AIQueryProcessor:
 
 
 
-    def process_question(self, question, user_id):
+    def _template_sql(self, query_type):
+        """模板 SQL；依赖的汇总表过期时返回读原始事件表的版本"""
+        template = SQL_TEMPLATES[query_type]
+        if 'rollup' in template and not self.rollup_freshness.fresh(template['rollup']):
+            return template['raw_sql']
+        return template['sql']
+
+    def match_template(self, question):
+        """问题与某个模板问题一致时返回其查询类型，否则返回 None"""
+        return TEMPLATE_QUESTIONS.get(normalize_question(question))
+
+    def confident_intent(self, question):
+        """
+        意图分类器的校准概率达到跳过阈值、且该意图有模板时返回查询类型，否则返回 None。
+        问题带数字或否定词（如“第3单元测试是什么时候？”“哪些作业没交？”）时，意图相同也不能套用
+        不带条件的模板 SQL，和语义缓存一样交给后续步骤
+        """
+        if not self.intent_classifier:
+            return None
+        if guard_tokens(question):
+            metrics.incr('intent.guarded')
+            return None
+        label, probability = self.intent_classifier.predict(question)
+        if probability < self.intent_skip_threshold:
+            return None
+        try:
+            query_type = QueryType(label)
+        except ValueError:
+            return None
+        return query_type if query_type in SQL_TEMPLATES else None
+
+    def classify_lane(self, question, user_id=None):
+        """
+        判断问题应进入的调度通道：能在上一轮结果上细化的追问，以及所有（子）问题都能直接套用模板
+        或命中语义缓存的问题走快通道，否则需要调用大模型，走慢通道
+        """
+        if user_id is not None and self._match_refinement(question, user_id):
+            return FAST_LANE
+        if user_id is not None and self._follow_up_context(question, user_id):
+            # 追问由大模型结合上一轮的 SQL 生成
+            return SLOW_LANE
+        sub_questions = self._decompose_question(question)
+        if all(self.match_template(sub_question)
+               or (self.semantic_cache and self.semantic_cache.contains(sub_question))
+               or self.confident_intent(sub_question)
+               for sub_question, _ in sub_questions):
+            return FAST_LANE
+        return SLOW_LANE
+
+    def process_question(self, question, user_id, cancel_token=None, page_size=None, render_answer=True):
         """
         处理自然语言问题，生成 SQL 并查询数据库
+        cancel_token 被取消时中止大模型调用和数据库查询，并抛出 QueryCancelled
+        page_size 指定时只返回第一页，后续页通过 fetch_page 获取
+        render_answer 为 False 时不拼接文字答案（answer 为 None），由客户端根据结果渲染
+        追问能在上一轮结果上细化时直接在内存中处理，其余追问附带上一轮的 SQL 交给大模型
+        """
+        matched = self._match_refinement(question, user_id)
+        if matched:
+            with trace_query(self.telemetry, question, user_id) as trace:
+                set_source(SOURCE_REFINEMENT)
+                result = self._refine_previous(question, user_id, *matched, render_answer)
+                trace.finish(result)
+                return result
+
+        previous = self._follow_up_context(question, user_id)
+        if previous:
+            result = self._process_single_question(question, user_id, cancel_token, page_size, render_answer,
+                                                   previous=previous)
+        else:
+            sub_questions = self._decompose_question(question)
+            if len(sub_questions) > 1:
+                # 复合问题的结果不作为追问的上下文
+                self.conversations.clear(user_id)
+                return self._process_compound_question(
+                    question, user_id, sub_questions, cancel_token, page_size, render_answer
+                )
+            result = self._process_single_question(question, user_id, cancel_token, page_size, render_answer)
+
+        if result['success']:
+            self.conversations.remember(user_id, question, result['query_type'], result['sql'], result['columns'],
+                                        result['results'], complete=not result['has_more'])
+        return result
+
+    def _follow_up_context(self, question, user_id):
         """
+        问题是追问时返回上一轮的上下文，否则返回 None。
+        与模板问题完全一致的问题（如"我的成绩呢"）按模板回答，不当作追问
+        """
+        if self.match_template(question) or not looks_like_follow_up(question):
+            return None
+        return self.conversations.get(user_id)
+
+    def _match_refinement(self, question, user_id):
+        """追问能在上一轮保存的结果上完成时返回 (上下文, 细化操作)，否则返回 None"""
+        state = self.conversations.get(user_id)
+        if not state or state['rows'] is None:
+            return None
+        ops = parse_refinement(question, state['columns'], state['rows'])
+        return (state, ops) if ops else None
+
+    def _refine_previous(self, question, user_id, state, ops, render_answer=True):
+        """在上一轮结果上筛选、排序、取前 N 条或计数，不调用大模型也不访问数据库"""
+        rows, count_only = apply_refinement(ops, state['rows'])
+        description = describe_refinement(ops, state['columns'])
+        query_type = QueryType(state['query_type']) if state['query_type'] else None
+        metrics.incr('conversation.refined')
+        logger.info("在上一轮结果上细化: %s", description, extra={'question': question[:100]})
+
+        # 细化后的结果作为下一次追问的基础
+        self.conversations.remember(user_id, state['question'], state['query_type'], state['sql'], state['columns'],
+                                    rows, refinements=state['refinements'] + [description])
+
+        answer = None
+        if render_answer:
+            if count_only:
+                conditions = describe_refinement([op for op in ops if op['op'] != 'count'], state['columns'])
+                answer = f"🔢 共有 {len(rows)} 条" + (f"（{conditions}）" if conditions else "") + "。"
+            elif rows:
+                answer = self._format_answer(query_type, rows, question, user_id)
+            else:
+                answer = f"📋 没有符合条件的记录（{description}）。"
+
+        return {
+            'success': True,
+            'answer': answer,
+            'message_code': MESSAGE_OK if rows else MESSAGE_EMPTY,
+            'query_type': state['query_type'],
+            'sql': state['sql'],
+            'results': rows,
+            'columns': state['columns'],
+            'result_count': len(rows),
+            'result_handle': None,
+            'next_cursor': None,
+            'has_more': False,
+            'refinement': description,
+            'suggestions': self.get_conversation_suggestions(query_type) if query_type else []
+        }
+
+    def _decompose_question(self, question):
+        """
+        将复合问题拆分为若干子问题，例如"我有哪些作业没交，成绩怎么样？"。
+        没有识别出意图、或与前一子句意图相同的子句并入前一个子问题。
+        返回 [(子问题, 预测意图)]，只有一个元素时按普通问题处理。
+        """
+        clauses = [c.strip() for c in COMPOUND_SPLIT_PATTERN.split(question) if c and c.strip()]
+        if len(clauses) < 2:
+            return [(question, None)]
+
+        parts = []
+        for clause in clauses:
+            intent = self._classify_query_intent(clause)
+            if parts and (intent is None or intent == parts[-1][1]):
+                parts[-1] = (f"{parts[-1][0]}，{clause}", parts[-1][1])
+            elif parts and parts[-1][1] is None:
+                parts[-1] = (f"{parts[-1][0]}，{clause}", intent)
+            else:
+                parts.append((clause, intent))
+
+        if len(parts) < 2:
+            return [(question, None)]
+        return parts[:self.max_sub_questions]
+
+    def _process_compound_question(self, question, user_id, sub_questions, cancel_token=None, page_size=None,
+                                   render_answer=True):
+        """并行处理各子问题，并按子问题顺序合并各自格式化后的答案"""
+        logger.info("复合问题拆分为 %d 个子问题", len(sub_questions))
+        metrics.incr('compound.questions')
+        metrics.incr('compound.sub_questions', len(sub_questions))
+
+        # 子问题共用一个子令牌，请求取消时随之取消；某个子问题抛出异常（取消、未被准入等）时
+        # 取消其余子问题，释放它们占用的大模型名额和数据库连接
+        sub_token = CancelToken(
+            cancel_token.request_id if cancel_token else None,
+            cancel_token.user_id if cancel_token else user_id,
+            cancel_token.deadline if cancel_token else None
+        )
+        unregister = cancel_token.on_cancel(sub_token.cancel) if cancel_token else None
+
+        # 子问题的日志沿用当前请求的 request_id
+        futures = [
+            self.subquery_executor.submit(
+                contextvars.copy_context().run,
+                self._process_single_question, sub_question, user_id, sub_token, page_size, render_answer
+            )
+            for sub_question, _ in sub_questions
+        ]
+        sub_results = []
         try:
-            # 预分析查询意图
-            predicted_intent = self._classify_query_intent(question)
+            for (sub_question, _), future in zip(sub_questions, futures):
+                result = future.result()
+                result['question'] = sub_question
+                sub_results.append(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            sub_token.cancel()
+            raise
+        finally:
+            if unregister:
+                unregister()
+
+        succeeded = [r for r in sub_results if r['success']]
+        if not succeeded:
+            return {
+                'success': False,
+                'error': sub_results[0]['error'],
+                'message_code': sub_results[0]['message_code'],
+                'query_type': None,
+                'result_count': 0,
+                'sub_results': sub_results,
+                'suggestions': self._get_general_suggestions()
+            }
+
+        answer = None
+        if render_answer:
+            answers = []
+            for result in sub_results:
+                if result['success']:
+                    answers.append(result['answer'])
+                else:
+                    answers.append(f"❓ 关于“{result['question']}”: {result['error']}")
+            answer = '\n\n'.join(answers)
+
+        return {
+            'success': True,
+            'answer': answer,
+            'message_code': MESSAGE_OK if any(r['result_count'] for r in succeeded) else MESSAGE_EMPTY,
+            'query_type': succeeded[0]['query_type'],
+            'sql': ';\n'.join(r['sql'] for r in succeeded),
+            'results': [row for r in succeeded for row in r['results']],
+            'result_count': sum(r['result_count'] for r in succeeded),
+            'sub_results': sub_results,
+            'suggestions': succeeded[0].get('suggestions', [])
+        }
+
+    def _process_single_question(self, question, user_id, cancel_token=None, page_size=None, render_answer=True,
+                                 previous=None):
+        """处理单一意图的问题，并记录一条查询遥测"""
+        with trace_query(self.telemetry, question, user_id) as trace:
+            result = self._answer_single_question(question, user_id, cancel_token, page_size, render_answer, previous)
+            trace.finish(result)
+            return result
 
-            # 使用大模型生成 SQL
-            query_type, sql, params = self._generate_sql(question, user_id, predicted_intent)
+    def _answer_single_question(self, question, user_id, cancel_token=None, page_size=None, render_answer=True,
+                                previous=None):
+        """
+        处理单一意图的问题：生成 SQL、执行查询并格式化答案。
+        previous 为上一轮的上下文时问题是追问，只能由大模型结合上一轮的 SQL 生成
+        """
+        speculation = None
+        cached = None
+        template_intent = None
+        try:
+            if previous is None:
+                with stage('route'):
+                    template_intent = self.match_template(question)
+                    if template_intent:
+                        metrics.incr('template.answered')
+                        set_source(SOURCE_TEMPLATE)
+                    else:
+                        cached = self.semantic_cache.lookup(question, user_id) if self.semantic_cache else None
+                        if cached:
+                            set_source(SOURCE_CACHE)
+                        else:
+                            template_intent = self.confident_intent(question)
+                            if template_intent:
+                                metrics.incr('intent.llm_skipped')
+                                set_source(SOURCE_CLASSIFIER)
+
+            if template_intent and self.answer_store and self.answer_store.handles(template_intent.value):
+                # 预先算好的答案仍然有效时直接返回（结果超过一页时仍按模板查询，以便分页）
+                with stage('precomputed'):
+                    stored = self.answer_store.lookup(user_id, template_intent.value)
+                if stored and (page_size is None or len(stored['rows']) <= page_size):
+                    set_source(SOURCE_PRECOMPUTED)
+                    return self._precomputed_result(template_intent, stored, user_id, page_size, render_answer)
+
+            if template_intent:
+                # 模板问题或分类器有把握的问题直接使用标准 SQL，不调用大模型
+                template = SQL_TEMPLATES[template_intent]
+                query_type, sql = template_intent, self._template_sql(template_intent)
+                params = template['params'](user_id)
+            elif cached:
+                # 与之前回答过的问题足够相似，复用大模型为其生成的 SQL
+                logger.info("语义缓存命中 (相似度 %.3f)", cached['similarity'],
+                            extra={'question': question[:100], 'cached_question': cached['question'][:100]})
+                query_type = QueryType(cached['query_type']) if cached['query_type'] else None
+                sql, params = cached['sql'], cached['params']
+            elif previous is not None:
+                metrics.incr('conversation.follow_up_llm')
+                set_source(SOURCE_FOLLOW_UP)
+                predicted_intent = QueryType(previous['query_type']) if previous['query_type'] else None
+                query_type, sql, params = self._generate_sql(question, user_id, predicted_intent, cancel_token,
+                                                             previous)
+            else:
+                # 预分析查询意图
+                set_source(SOURCE_LLM)
+                predicted_intent = self._classify_query_intent(question)
+
+                # 在等待大模型的同时推测执行预测意图的模板 SQL
+                speculation = self._start_speculation(predicted_intent, user_id, cancel_token, page_size)
+
+                # 使用大模型生成 SQL
+                query_type, sql, params = self._generate_sql(question, user_id, predicted_intent, cancel_token)
             if not sql:
+                self._resolve_speculation(speculation, None, None)
                 return {
                     'success': False,
                     'error': '抱歉，我无法理解您的问题。请尝试使用更具体的表达方式，比如"我有哪些作业没交？"、"我的成绩怎么样？"或"老师有什么反馈？"',
+                    'message_code': MESSAGE_NOT_UNDERSTOOD,
                     'query_type': None,
                     'result_count': 0,
                     'suggestions': self._get_general_suggestions()
                 }
 
-            # 执行查询
-            conn = psycopg2.connect(**self.db_config)
-            cursor = conn.cursor()
-            cursor.execute(sql, params)
-            results = cursor.fetchall()
-            cursor.close()
-            conn.close()
-
-            # 格式化答案
-            answer = self._format_answer(query_type, results, question, user_id)
+            if not template_intent:
+                # 非模板 SQL 先检查估算代价
+                query_type, sql, params = self._enforce_cost_budget(question, user_id, query_type, sql, params,
+                                                                    cancel_token, previous)
+
+            # 执行查询（推测命中时直接使用预取结果）
+            with stage('db'):
+                executed = self._resolve_speculation(speculation, sql, params)
+                if executed is None:
+                    executed = self._execute_statement(sql, params, cancel_token, page_size, user_id)
+            results, columns, plan = executed
+
+            if not template_intent and not cached and previous is None:
+                # 大模型生成的 SQL 执行成功后记录其 query_type，作为意图分类器的训练数据
+                # （追问的 SQL 依赖上一轮上下文，不作为训练数据，也不进入语义缓存）
+                if query_type and self.intent_label_log:
+                    self.intent_label_log.record(question, query_type.value)
+                if self.semantic_cache:
+                    self.semantic_cache.insert(question, query_type.value if query_type else None, sql, params, user_id)
+
+            with stage('format'):
+                # 登记结果句柄，分页时据此重新执行
+                page = self._paginate(user_id, query_type, sql, params, results, columns, plan, page_size)
+                results = page['rows']
+
+                # 格式化答案
+                answer = self._format_answer(query_type, results, question, user_id) if render_answer else None
             result_count = len(results)
 
             return {
                 'success': True,
                 'answer': answer,
+                'message_code': MESSAGE_OK if results else MESSAGE_EMPTY,
                 'query_type': query_type.value if query_type else None,
                 'sql': sql,
                 'results': results,
+                'columns': columns,
                 'result_count': result_count,
+                'result_handle': page['result_handle'],
+                'next_cursor': page['next_cursor'],
+                'has_more': page['next_cursor'] is not None,
                 'suggestions': self.get_conversation_suggestions(query_type) if query_type else []
             }
 
+        except QueryCancelled:
+            self._resolve_speculation(speculation, None, None)
+            logger.info("查询已取消: %s", cancel_token.request_id if cancel_token else '')
+            raise
+        except AdmissionRejected as e:
+            self._resolve_speculation(speculation, None, None)
+            logger.warning("大模型请求未被准入: %s", e)
+            raise
+        except (QueryTooExpensive, psycopg2.extensions.QueryCanceledError) as e:
+            # 超出代价预算，或执行超过 statement_timeout（用户取消已在上面处理）
+            self._resolve_speculation(speculation, None, None)
+            metrics.incr('cost_guard.rejected' if isinstance(e, QueryTooExpensive) else 'db.statement_timeout')
+            logger.warning("查询代价过高，未返回结果: %s", e)
+            return {
+                'success': False,
+                'error': '这个问题需要查询的数据量太大，请缩小范围（例如指定课程、单元或时间段）后再试。',
+                'message_code': MESSAGE_TOO_EXPENSIVE,
+                'query_type': None,
+                'sql': sql,
+                'result_count': 0
+            }
         except Exception as e:
-            logger.error(f"处理查询失败: {str(e)}")
+            logger.error("处理查询失败: %s", e)
             return {
                 'success': False,
                 'error': f'查询过程中遇到了技术问题，请稍后重试。如果问题持续存在，请联系系统管理员。',
+                'message_code': MESSAGE_QUERY_ERROR,
                 'query_type': None,
                 'sql': sql if 'sql' in locals() else None,
                 'result_count': 0
             }
 
-    def _generate_sql(self, question, user_id, predicted_intent=None):
+    def _precomputed_result(self, query_type, stored, user_id, page_size=None, render_answer=True):
+        """
+        由预计算的答案构造与实时查询相同结构的结果，并按模板 SQL 登记结果句柄，
+        与实时查询一样可以通过句柄重新分页和导出
+        """
+        template = SQL_TEMPLATES[query_type]
+        page = self._paginate(user_id, query_type, template['sql'], template['params'](user_id), stored['rows'],
+                              stored['columns'], TEMPLATE_PAGE_PLANS[query_type], page_size)
+        rows = page['rows']
+        return {
+            'success': True,
+            'answer': stored['answer'] if render_answer else None,
+            'message_code': MESSAGE_OK if rows else MESSAGE_EMPTY,
+            'query_type': query_type.value,
+            'sql': template['sql'],
+            'results': rows,
+            'columns': stored['columns'],
+            'result_count': len(rows),
+            'result_handle': page['result_handle'],
+            'next_cursor': page['next_cursor'],
+            'has_more': page['next_cursor'] is not None,
+            'suggestions': self.get_conversation_suggestions(query_type)
+        }
+
+    def _enforce_cost_budget(self, question, user_id, query_type, sql, params, cancel_token=None, previous=None):
+        """
+        检查 SQL 的估算代价，超出预算时附上原因让大模型重新生成，返回通过检查的 (query_type, sql, params)。
+        重试后仍超出预算时抛出 QueryTooExpensive
+        """
+        if not self.cost_guard:
+            return query_type, sql, params
+
+        for attempt in range(self.cost_guard_retries + 1):
+            try:
+                with stage('guard'):
+                    self.cost_guard.check(sql, params, query_type.value if query_type else None,
+                                          lambda: self.db_pool.connection(read_only=True, user_id=user_id))
+                return query_type, sql, params
+            except QueryTooExpensive as e:
+                logger.warning("生成的 SQL 超出代价预算: %s", e, extra={'sql_fingerprint': sql_fingerprint(sql)})
+                if attempt == self.cost_guard_retries:
+                    raise
+                metrics.incr('cost_guard.regenerated')
+                feedback = {'sql': sql, 'reason': str(e)}
+                query_type, new_sql, params = self._generate_sql(question, user_id, query_type, cancel_token,
+                                                                 previous, feedback)
+                if not new_sql:
+                    raise
+                sql = new_sql
+
+    def _execute_statement(self, sql, params, cancel_token=None, page_size=None, user_id=None):
+        """
+        执行生成的 SQL，返回 (结果, 列名, 分页计划)。
+        指定 page_size 时按分页计划只取首页（多取一行用于判断是否还有下一页）
+        """
+        if not page_size:
+            results, columns = self._execute_query(sql, params, cancel_token, user_id)
+            return results, columns, None
+
+        plan = build_page_plan(sql)
+        statement, extra_params = first_page_sql(sql, plan, page_size)
+        results, columns = self._execute_query(statement, list(params or []) + extra_params, cancel_token, user_id)
+        return results, columns, plan
+
+    def _paginate(self, user_id, query_type, sql, params, results, columns, plan, page_size):
+        """登记结果句柄，截取首页并生成下一页游标"""
+        if plan is None:
+            plan = build_page_plan(sql)
+        handle_id = self.result_handles.create(
+            user_id, query_type.value if query_type else None, sql, params, plan, columns
+        )
+        if not page_size or len(results) <= page_size:
+            return {'rows': results, 'result_handle': handle_id, 'next_cursor': None}
+
+        rows = results[:page_size]
+        return {
+            'rows': rows,
+            'result_handle': handle_id,
+            'next_cursor': make_cursor(plan, columns, rows[-1], page_size)
+        }
+
+    def fetch_page(self, handle_id, user_id, cursor=None, page_size=20, cancel_token=None, render_answer=True):
+        """
+        根据结果句柄获取下一页：重新执行缓存的 SQL 并附加键集谓词，不调用大模型
+        """
+        handle = self.result_handles.get(handle_id, user_id)
+        if handle is None:
+            return {'success': False, 'error': '结果已过期，请重新提问', 'error_code': 'HANDLE_NOT_FOUND'}
+
+        try:
+            if cursor:
+                position = parse_cursor(cursor)
+                statement, extra_params = next_page_sql(
+                    handle['sql'], handle['plan'], handle['columns'], position, page_size
+                )
+                offset = position['offset']
+            else:
+                statement, extra_params = first_page_sql(handle['sql'], handle['plan'], page_size)
+                offset = 0
+        except InvalidCursor as e:
+            return {'success': False, 'error': str(e), 'error_code': 'INVALID_CURSOR'}
+
+        try:
+            results, columns = self._execute_query(statement, handle['params'] + extra_params, cancel_token,
+                                                   user_id)
+        except QueryCancelled:
+            raise
+        except Exception as e:
+            logger.error("分页查询失败: %s", e)
+            return {'success': False, 'error': '分页查询失败，请稍后重试', 'error_code': 'PAGE_FAILED'}
+
+        rows = results[:page_size]
+        next_cursor = None
+        if len(results) > page_size:
+            next_cursor = make_cursor(handle['plan'], columns, rows[-1], offset + page_size)
+
+        query_type = QueryType(handle['query_type']) if handle['query_type'] else None
+        return {
+            'success': True,
+            'answer': self._format_answer(query_type, rows, None, user_id) if render_answer else None,
+            'message_code': MESSAGE_OK if rows else MESSAGE_EMPTY,
+            'query_type': handle['query_type'],
+            'results': rows,
+            'columns': columns,
+            'result_count': len(rows),
+            'offset': offset,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+
+    def export_rows(self, handle_id, user_id):
+        """
+        导出结果句柄对应的完整结果，返回 (句柄, 列名, 逐批产出行的生成器)，句柄不存在或已过期时返回 None。
+        返回前已执行查询并取到第一批行，查询出错或导出数已满（Overloaded）时在这里抛出；
+        生成器读完或被关闭时归还连接
+        """
+        handle = self.result_handles.get(handle_id, user_id)
+        if handle is None:
+            return None
+        batches = self._stream_query(handle['sql'], handle['params'], user_id)
+        columns = next(batches)
+        return handle, columns, batches
+
+    def _stream_query(self, sql, params, user_id=None):
+        """用命名游标（服务端游标）执行只读查询：先产出列名，再每次产出 export_batch_size 行"""
+        if not self.export_slots.acquire(blocking=False):
+            raise Overloaded("同时进行的导出过多", retry_after=30)
+        try:
+            with self.db_pool.connection(read_only=True, user_id=user_id) as conn:
+                with conn.cursor() as cursor:
+                    # 每次 FETCH 是一条语句，statement_timeout 限制的是每一批，而不是整个导出
+                    cursor.execute(f"SET LOCAL statement_timeout = {self.statement_timeout_ms}")
+                with conn.cursor(name=f'export_{uuid.uuid4().hex}') as cursor:
+                    cursor.execute(sql, params)
+                    rows = cursor.fetchmany(self.export_batch_size)
+                    yield [column[0] for column in cursor.description]
+                    while rows:
+                        yield rows
+                        rows = cursor.fetchmany(self.export_batch_size)
+        finally:
+            self.export_slots.release()
+
+    def _execute_query(self, sql, params, cancel_token=None, user_id=None):
+        """执行经过校验的只读查询（优先分到只读副本，user_id 用于读己之写），返回 (全部结果, 列名)"""
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+
+        with self.db_pool.connection(read_only=True, user_id=user_id) as conn:
+            fired = []
+
+            def cancel_backend():
+                # 连接级取消：向服务端发送取消请求，中断正在执行的语句
+                fired.append(True)
+                conn.cancel()
+
+            unregister = cancel_token.on_cancel(cancel_backend) if cancel_token else None
+            try:
+                with conn.cursor() as cursor:
+                    # 每条语句都限制执行时间（SET LOCAL 只作用于本事务），生成的 SQL 单独执行
+                    cursor.execute(f"SET LOCAL statement_timeout = {self.statement_timeout_ms}")
+                    cursor.execute(sql, params)
+                    return cursor.fetchall(), [column[0] for column in cursor.description]
+            except psycopg2.extensions.QueryCanceledError:
+                if cancel_token and cancel_token.cancelled:
+                    raise QueryCancelled(f"数据库查询已取消: {cancel_token.request_id}")
+                raise
+            finally:
+                if unregister:
+                    unregister()
+                if fired:
+                    # 取消请求可能晚于语句结束到达服务端，丢弃该连接以免误伤下一条查询
+                    conn.close()
+
+    def _run_speculative_query(self, sql, params, cancel_token, page_size, user_id=None):
+        """推测执行任务，返回 (执行结果, 数据库耗时毫秒)"""
+        started = time.perf_counter()
+        executed = self._execute_statement(sql, params, cancel_token, page_size, user_id)
+        return executed, (time.perf_counter() - started) * 1000
+
+    def _start_speculation(self, predicted_intent, user_id, cancel_token=None, page_size=None):
+        """为预测意图提交模板 SQL 的推测执行，无模板时返回 None"""
+        template = SQL_TEMPLATES.get(predicted_intent)
+        if not self.speculative_execution or not template:
+            return None
+
+        # 推测查询有独立的取消令牌：未命中时单独取消，请求取消时随之取消
+        speculation_token = CancelToken(cancel_token.request_id if cancel_token else None)
+        unregister = cancel_token.on_cancel(speculation_token.cancel) if cancel_token else None
+
+        sql = self._template_sql(predicted_intent)
+        params = template['params'](user_id)
+        metrics.incr('speculation.started')
+        return {
+            'query_type': predicted_intent,
+            'fingerprint': sql_fingerprint(sql),
+            'params': params,
+            'cancel_token': speculation_token,
+            'unregister': unregister,
+            'future': self.query_executor.submit(
+                self._run_speculative_query, sql, params, speculation_token, page_size, user_id
+            )
+        }
+
+    def _resolve_speculation(self, speculation, sql, params):
+        """
+        比较大模型生成的 SQL 与推测执行的模板 SQL。
+        指纹和参数一致时返回预取的 (结果, 列名, 分页计划)，否则丢弃推测结果并返回 None。
+        """
+        if not speculation:
+            return None
+        # 推测已有结论，不再随请求取消（未命中时下面单独取消）
+        if speculation['unregister']:
+            speculation['unregister']()
+
+        future = speculation['future']
+        if sql and sql_fingerprint(sql) == speculation['fingerprint'] and same_params(params, speculation['params']):
+            try:
+                executed, db_ms = future.result()
+                metrics.incr('speculation.hit')
+                metrics.observe('speculation.saved_db_ms', db_ms)
+                logger.info("推测执行命中: %s", speculation['query_type'].value)
+                return executed
+            except Exception as e:
+                # 推测查询本身失败时按未命中处理，由调用方重新执行
+                metrics.incr('speculation.error')
+                logger.warning("推测执行失败，改为正常执行: %s", e)
+                return None
+
+        metrics.incr('speculation.miss')
+        if future.cancel():
+            # 尚未开始执行，没有产生数据库负载
+            metrics.incr('speculation.cancelled')
+        else:
+            # 正在执行的推测查询立即取消，释放连接
+            speculation['cancel_token'].cancel()
+            future.add_done_callback(self._record_wasted_speculation)
+        return None
+
+    @staticmethod
+    def _record_wasted_speculation(future):
+        """记录未命中推测执行浪费的数据库负载"""
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), QueryCancelled):
+            metrics.incr('speculation.aborted')
+            return
+        if future.exception() is not None:
+            return
+        (results, _, _), db_ms = future.result()
+        metrics.incr('speculation.wasted_queries')
+        metrics.incr('speculation.wasted_rows', len(results))
+        metrics.observe('speculation.wasted_db_ms', db_ms)
+
+    def speculation_stats(self):
+        """推测执行命中率与浪费的数据库负载"""
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        return {
+            'started': counters.get('speculation.started', 0),
+            'hit': counters.get('speculation.hit', 0),
+            'miss': counters.get('speculation.miss', 0),
+            'hit_rate': metrics.ratio('speculation.hit', 'speculation.started'),
+            'cancelled': counters.get('speculation.cancelled', 0),
+            'aborted': counters.get('speculation.aborted', 0),
+            'wasted_queries': counters.get('speculation.wasted_queries', 0),
+            'wasted_rows': counters.get('speculation.wasted_rows', 0),
+            'wasted_db_ms': snapshot['timings'].get('speculation.wasted_db_ms')
+        }
+
+    def _generate_sql(self, question, user_id, predicted_intent=None, cancel_token=None, previous=None,
+                      feedback=None):
         """
         使用大模型生成 SQL 查询 - 更详细的数据库结构和示例
+        previous 为上一轮的对话上下文时，提示词附带上一轮的问题与 SQL；
+        feedback 为上一次生成的 SQL 及其被拒绝的原因（代价过高）
         """
         # 详细的数据库表结构和关系说明
         schema = """
@@ -285,6 +1155,26 @@ class AIQueryProcessor:
            - StudentProgressView - 学生进度统计视图
            - CourseCompletionView - 课程完成情况统计视图
 
+        10. LearningActivityDaily (学习行为每日汇总表，由 LearningActivity 定期增量汇总)
+           - student_id VARCHAR(12) - 学生ID
+           - serial_number INT - 序号
+           - activity_day DATE - 日期
+           - device_type VARCHAR(20) - 设备类型
+           - activity_count INT - 当天的活动次数
+           - total_minutes INT - 当天的学习时长合计(分钟)
+           - duration_count INT - 当天记录了时长的活动次数（平均时长 = SUM(total_minutes) / SUM(duration_count)）
+
+        11. ResourceAccessDaily (资源访问每日汇总表，由 ResourceAccess 定期增量汇总)
+           - student_id VARCHAR(12) - 学生ID
+           - serial_number INT - 序号
+           - access_day DATE - 日期
+           - resource_type VARCHAR(30) - 资源类型
+           - resource_name VARCHAR(100) - 资源名称
+           - access_count INT - 当天的访问次数
+           - total_seconds INT - 当天的访问时长合计(秒)
+           - duration_count INT - 当天记录了时长的访问次数（平均时长 = SUM(total_seconds) / SUM(duration_count)）
+           - last_access TIMESTAMP - 当天最后一次访问时间
+
         表关系:
         - LabReport 通过 serial_number 关联 Intelligent_Supervision
         - LabReport 通过 student_id 关联 students
@@ -292,10 +1182,27 @@ class AIQueryProcessor:
         - LearningActivity 记录学生的学习行为轨迹
         - TeacherFeedback 存储教师对学生的个性化反馈
         - ResourceAccess 追踪学生对学习资源的使用情况
+        - LearningActivity、ResourceAccess 按月分区，数据量随学期增长；统计次数、时长、活跃天数时查询每日汇总表
+          （按天累加，不要对汇总表使用 COUNT(*) 或 AVG），只有需要单条记录的细节（具体时间、活动类型、IP）时才查原始表，
+          并按时间范围过滤
         """
 
         # 构建更专业的提示词
         intent_hint = f"\n预测查询意图: {predicted_intent.value if predicted_intent else '未知'}" if predicted_intent else ""
+        if previous:
+            refinements = f"\n        上一轮结果又经过了: {'；'.join(previous['refinements'])}" if previous['refinements'] else ""
+            intent_hint += f"""
+
+        这是对上一轮查询的追问，请在上一轮 SQL 的基础上修改:
+        上一轮问题: "{previous['question']}"
+        上一轮SQL: {previous['sql']}{refinements}"""
+        if feedback:
+            intent_hint += f"""
+
+        上一次为这个问题生成的 SQL 估算代价过高，没有执行:
+        {feedback['sql']}
+        原因: {feedback['reason']}
+        请重新生成：补全表之间的连接条件，尽量按学生ID过滤，只查询需要的列，并限制返回行数。"""
 
         prompt = f"""
         你是一个专业的SQL查询生成助手，专门为智能督学系统服务。请根据学生的自然语言问题生成安全、准确的SQL查询。
@@ -325,106 +1232,24 @@ class AIQueryProcessor:
 
         增强查询示例:
 
-        问题: "我有哪些作业没交？" / "未提交的实验报告"
-        ```json
-        {{
-            "query_type": "experiment_report",
-            "sql": "SELECT ins.serial_number, ins.course_content, ins.report_deadline, CASE WHEN ins.report_deadline < CURRENT_DATE THEN '已逾期' ELSE '未逾期' END as status, CASE WHEN ins.report_deadline - CURRENT_DATE <= 3 THEN '紧急' WHEN ins.report_deadline - CURRENT_DATE <= 7 THEN '即将到期' ELSE '正常' END as urgency FROM Intelligent_Supervision ins LEFT JOIN LabReport lr ON ins.serial_number = lr.serial_number AND lr.student_id = %s WHERE lr.submitted IS FALSE OR lr.submitted IS NULL ORDER BY ins.report_deadline",
-            "params": ["{user_id}"],
-            "explanation": "查询学生未提交的实验报告及其紧急程度"
-        }}
-        ```
-
-        问题: "我的成绩怎么样？" / "我得了多少分？"
-        ```json
-        {{
-            "query_type": "grade_inquiry",
-            "sql": "SELECT ins.course_content, sg.grade, sg.submit_date, sg.late_days, sg.comments, CASE WHEN sg.grade >= 90 THEN '优秀' WHEN sg.grade >= 80 THEN '良好' WHEN sg.grade >= 70 THEN '中等' WHEN sg.grade >= 60 THEN '及格' ELSE '不及格' END as grade_level FROM StudentGrades sg JOIN Intelligent_Supervision ins ON sg.serial_number = ins.serial_number WHERE sg.student_id = %s ORDER BY sg.submit_date DESC",
-            "params": ["{user_id}"],
-            "explanation": "查询学生的成绩记录和等级评价"
-        }}
-        ```
-
-        问题: "老师对我有什么反馈？" / "教师评价"
-        ```json
-        {{
-            "query_type": "teacher_feedback",
-            "sql": "SELECT tf.feedback_type, tf.feedback_content, tf.feedback_date, tf.teacher_name, ins.course_content, CASE WHEN tf.feedback_type = 'praise' THEN '表扬' WHEN tf.feedback_type = 'reminder' THEN '提醒' WHEN tf.feedback_type = 'warning' THEN '警告' WHEN tf.feedback_type = 'suggestion' THEN '建议' ELSE '其他' END as feedback_type_zh FROM TeacherFeedback tf LEFT JOIN Intelligent_Supervision ins ON tf.serial_number = ins.serial_number WHERE tf.student_id = %s ORDER BY tf.feedback_date DESC LIMIT 10",
-            "params": ["{user_id}"],
-            "explanation": "查询教师对学生的最新反馈信息"
-        }}
-        ```
-
-        问题: "我的学习时间统计" / "学习行为分析"
-        ```json
-        {{
-            "query_type": "learning_analytics",
-            "sql": "SELECT ins.course_content, COUNT(la.activity_id) as total_activities, SUM(la.duration_minutes) as total_minutes, AVG(la.duration_minutes) as avg_duration, la.device_type, COUNT(DISTINCT DATE(la.activity_date)) as active_days FROM LearningActivity la JOIN Intelligent_Supervision ins ON la.serial_number = ins.serial_number WHERE la.student_id = %s GROUP BY ins.course_content, la.device_type ORDER BY total_minutes DESC",
-            "params": ["{user_id}"],
-            "explanation": "分析学生的学习行为和时间分布"
-        }}
-        ```
-
-        问题: "我和其他同学相比怎么样？" / "班级排名"
-        ```json
-        {{
-            "query_type": "peer_comparison",
-            "sql": "WITH student_stats AS (SELECT s.student_id, s.student_name, COUNT(CASE WHEN lr.submitted = TRUE THEN 1 END) as completed, AVG(sg.grade) as avg_grade FROM students s LEFT JOIN LabReport lr ON s.student_id = lr.student_id LEFT JOIN StudentGrades sg ON s.student_id = sg.student_id GROUP BY s.student_id, s.student_name), ranked_students AS (SELECT *, RANK() OVER (ORDER BY completed DESC, avg_grade DESC) as rank FROM student_stats) SELECT rs.rank, rs.completed, rs.avg_grade, (SELECT COUNT(*) FROM ranked_students) as total_students FROM ranked_students rs WHERE rs.student_id = %s",
-            "params": ["{user_id}"],
-            "explanation": "比较当前学生与同班同学的学习表现"
-        }}
-        ```
-
-        问题: "有什么重要通知？" / "最新公告"
-        ```json
-        {{
-            "query_type": "announcement",
-            "sql": "SELECT title, content, announcement_type, publish_date, expire_date, CASE WHEN announcement_type = 'urgent' THEN '紧急' WHEN announcement_type = 'deadline' THEN '截止提醒' WHEN announcement_type = 'exam' THEN '考试通知' ELSE '一般通知' END as type_zh FROM Announcements WHERE is_active = TRUE AND (target_students IS NULL OR target_students::text LIKE %s) AND (expire_date IS NULL OR expire_date >= CURRENT_DATE) ORDER BY CASE WHEN announcement_type = 'urgent' THEN 1 ELSE 2 END, publish_date DESC LIMIT 5",
-            "params": [f'%"{user_id}"%'],
-            "explanation": "查询针对该学生的有效通知公告"
-        }}
-        ```
-
-        问题: "我应该重点学习什么？" / "学习建议"
-        ```json
-        {{
-            "query_type": "study_recommendation",
-            "sql": "SELECT ins.course_content, ins.online_learning_date, ins.report_deadline, CASE WHEN lr.submitted IS FALSE OR lr.submitted IS NULL THEN '需要完成实验报告' END as recommendation, CASE WHEN ins.report_deadline - CURRENT_DATE <= 7 THEN '高优先级' WHEN ins.report_deadline - CURRENT_DATE <= 14 THEN '中优先级' ELSE '低优先级' END as priority FROM Intelligent_Supervision ins LEFT JOIN LabReport lr ON ins.serial_number = lr.serial_number AND lr.student_id = %s WHERE lr.submitted IS FALSE OR lr.submitted IS NULL ORDER BY ins.report_deadline",
-            "params": ["{user_id}"],
-            "explanation": "基于截止日期和完成情况给出学习建议"
-        }}
-        ```
-
-        问题: "我看了多少学习资料？" / "资源使用情况"
-        ```json
-        {{
-            "query_type": "resource_usage",
-            "sql": "SELECT ra.resource_type, ra.resource_name, COUNT(*) as access_count, SUM(ra.access_duration_seconds) as total_seconds, AVG(ra.access_duration_seconds) as avg_seconds, MAX(ra.access_date) as last_access, CASE WHEN ra.resource_type = 'lecture_video' THEN '讲课视频' WHEN ra.resource_type = 'slides' THEN '课件' WHEN ra.resource_type = 'example_code' THEN '示例代码' WHEN ra.resource_type = 'reference' THEN '参考资料' ELSE '其他' END as resource_type_zh FROM ResourceAccess ra WHERE ra.student_id = %s GROUP BY ra.resource_type, ra.resource_name ORDER BY total_seconds DESC",
-            "params": ["{user_id}"],
-            "explanation": "统计学生对各类学习资源的使用情况"
-        }}
-        ```
+        {render_template_examples(user_id)}
 
         请根据用户问题生成最合适的SQL查询，充分利用数据库中的丰富信息。
         """
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system",
-                     "content": "你是一个专业的SQL生成助手，专门为教育督学系统服务。请严格按照JSON格式输出，确保SQL查询的安全性和准确性。充分利用数据库中的所有表结构，提供详细和有用的查询结果。"},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"},
-                temperature=0.1  # 降低随机性，提高一致性
-            )
+            content = self._call_llm([
+                {"role": "system",
+                 "content": "你是一个专业的SQL生成助手，专门为教育督学系统服务。请严格按照JSON格式输出，确保SQL查询的安全性和准确性。充分利用数据库中的所有表结构，提供详细和有用的查询结果。"},
+                {"role": "user", "content": prompt}
+            ], cancel_token)
 
-            result = json.loads(response.choices[0].message.content)
+            result = json.loads(content)
 
             query_type = QueryType(result['query_type']) if result.get('query_type') in [qt.value for qt in
                                                                                          QueryType] else None
-            sql = result.get('sql', '').strip()
+            # 去掉结尾分号、拒绝多条语句；之后缓存和结果句柄中保存的都是这条规范后的 SQL
+            sql = single_statement(result.get('sql'))
             params = result.get('params', [])
 
             # 增强的SQL安全性验证
@@ -432,13 +1257,57 @@ class AIQueryProcessor:
                 logger.warning("生成的SQL不安全或无效")
                 return None, None, None
 
-            logger.info(f"生成SQL成功: {result.get('explanation', '无说明')}")
+            logger.info("生成SQL成功: %s", result.get('explanation', '无说明'))
             return query_type, sql, params
 
+        except (QueryCancelled, AdmissionRejected):
+            raise
         except Exception as e:
-            logger.error(f"生成 SQL 失败: {str(e)}")
+            logger.error("生成 SQL 失败: %s", e)
             return None, None, None
 
+    def _call_llm(self, messages, cancel_token=None):
+        """
+        调用大模型并返回完整的回复文本。
+        使用流式响应，取消时直接关闭 HTTP 流，不再等待剩余输出。
+        同时进行的调用数受 llm_admission 限制，排不上队时抛出 AdmissionRejected。
+        """
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+
+        deadline = cancel_token.deadline if cancel_token else None
+        queued = time.perf_counter()
+        with self.llm_admission.slot(deadline, cancel_token), stage('llm'):
+            add_stage_since('llm_queue', queued)
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=0.1,  # 降低随机性，提高一致性
+                stream=True,
+                stream_options={"include_usage": True}  # 最后一个分块带 token 用量
+            )
+            unregister = cancel_token.on_cancel(stream.close) if cancel_token else None
+            chunks = []
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                    if getattr(chunk, 'usage', None):
+                        add_llm_usage(chunk.usage)
+            except Exception:
+                if cancel_token and cancel_token.cancelled:
+                    raise QueryCancelled(f"大模型调用已取消: {cancel_token.request_id}")
+                raise
+            finally:
+                if unregister:
+                    unregister()
+                stream.close()
+
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        return ''.join(chunks)
+
     def _validate_sql_safety(self, sql):
         """增强的SQL安全性验证"""
         if not sql:
@@ -478,7 +1347,8 @@ class AIQueryProcessor:
             QueryType.RESOURCE_USAGE: self._format_resource_usage_answer,
             QueryType.GRADE_INQUIRY: self._format_grade_inquiry_answer,
             QueryType.ANNOUNCEMENT: self._format_announcement_answer,
-            QueryType.STUDY_RECOMMENDATION: self._format_study_recommendation_answer
+            QueryType.STUDY_RECOMMENDATION: self._format_study_recommendation_answer,
+            QueryType.LEARNING_ANALYTICS: self._format_learning_analytics_answer
         }
 
         formatter = formatters.get(query_type, self._format_default_answer)
@@ -643,6 +1513,26 @@ class AIQueryProcessor:
         answer += "💡 **建议**: 请优先完成紧急任务，避免逾期！"
         return answer
 
+    def _format_learning_analytics_answer(self, results, current_date=None):
+        """格式化学习行为分析查询结果"""
+        if not results:
+            return "📊 暂无学习行为数据记录。"
+
+        answer = "📊 **学习行为分析:**\n\n"
+
+        for row in results:
+            if len(row) >= 6:
+                course_content, total_activities, total_minutes, avg_duration, device_type, active_days = row[:6]
+
+                answer += f"📚 **{course_content}** ({device_type})\n"
+                answer += f"   🔢 学习次数: {total_activities}\n"
+                answer += f"   ⏱️ 总时长: {int(total_minutes or 0)}分钟\n"
+                answer += f"   ⏰ 平均每次: {float(avg_duration or 0):.1f}分钟\n"
+                answer += f"   📅 活跃天数: {active_days}\n\n"
+
+        answer += "💡 **建议**: 保持规律的学习节奏，适当增加学习时间较少的课程！"
+        return answer
+
     def _format_peer_comparison_answer(self, results):
         """格式化同学比较查询结果"""
         if not results:
@@ -752,8 +1642,8 @@ class AIQueryProcessor:
 
         for row in results:
             if len(row) >= 4:
-                course_content, online_learning_date, report_deadline, priority = row[:3] + (
-                    row[4] if len(row) > 4 else ['低优先级'])
+                course_content, online_learning_date, report_deadline = row[:3]
+                priority = row[4] if len(row) > 4 else '低优先级'
 
                 emoji_map = {
                     '高优先级': '🚨',
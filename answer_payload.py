@@ -0,0 +1,97 @@
+"""
+结构化的查询结果
+
+format=structured 时 /api/query 不再返回服务端拼好的 Markdown 答案，
+而是返回紧凑的结构化数据，由前端按 query_type 渲染：
+{
+    "query_type": "grade_inquiry",
+    "message_code": "OK",
+    "columns": [{"name": "grade", "type": "number"}, ...],
+    "rows": [[...], ...]
+}
+客户端在 Accept 中声明 application/x-msgpack 且服务端安装了 msgpack 时，以 MessagePack 编码。
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+# message_code: 结果的概况，前端据此选择提示文字
+MESSAGE_OK = 'OK'
+MESSAGE_EMPTY = 'EMPTY'
+MESSAGE_NOT_UNDERSTOOD = 'NOT_UNDERSTOOD'
+MESSAGE_QUERY_ERROR = 'QUERY_ERROR'
+MESSAGE_TOO_EXPENSIVE = 'TOO_EXPENSIVE'
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, (float, Decimal)):
+        return 'number'
+    if isinstance(value, datetime):
+        return 'timestamp'
+    if isinstance(value, date):
+        return 'date'
+    if isinstance(value, timedelta):
+        return 'interval'
+    return 'text'
+
+
+def column_types(columns, rows):
+    """按每列第一个非空值推断列类型，整列为空时记为 text"""
+    typed = []
+    for index, name in enumerate(columns or []):
+        value = next((row[index] for row in rows if row[index] is not None), None)
+        typed.append({'name': name, 'type': _value_type(value) if value is not None else 'text'})
+    return typed
+
+
+def encode_value(value):
+    """转换为 JSON / MessagePack 可表示的值"""
+    if isinstance(value, datetime):
+        return value.isoformat(timespec='seconds')
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def encode_rows(rows):
+    return [[encode_value(value) for value in row] for row in rows]
+
+
+def structured_result(result):
+    """把 process_question / fetch_page 的结果转换为结构化负载"""
+    rows = result.get('results') or []
+    payload = {
+        'query_type': result.get('query_type'),
+        'message_code': result.get('message_code'),
+        'columns': column_types(result.get('columns'), rows),
+        'rows': encode_rows(rows),
+        'result_count': result.get('result_count', 0)
+    }
+    if 'next_cursor' in result:
+        payload['next_cursor'] = result['next_cursor']
+        payload['has_more'] = result['has_more']
+    if result.get('refinement'):
+        payload['refinement'] = result['refinement']
+    return payload
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def pack(payload):
+    return msgpack.packb(payload, use_bin_type=True)
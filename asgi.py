@@ -0,0 +1,14 @@
+"""
+ASGI 入口（需要安装 asgiref 和 uvicorn）
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+    WEB_CONCURRENCY=4 uvicorn asgi:app
+
+uvicorn 自己启动多个进程时没有预加载，每个进程导入时各自加载共享数据并创建连接池
+（uvicorn 以 WEB_CONCURRENCY 作为默认进程数，应用也据此分摊连接池）。
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from backend import create_app
+
+app = WsgiToAsgi(create_app())
@@ -1,24 +1,36 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import os
 import logging
 from datetime import datetime
 import traceback
+import hmac
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 import psycopg2
+from admission import AdmissionRejected, UserRateLimiter
 from ai_sql_generator import AIQueryProcessor, QueryType  # 修正导入，确保与 enhanced_ai_processor.py 一致
+from answer_payload import MSGPACK_MIMETYPE, msgpack_available, pack, structured_result
+from cancellation import CancellationRegistry, QueryCancelled
+from health import HealthMonitor
+import http_cache
+from http_cache import PrecomputedResponse
+from jobs import JobManager, JobQueueFull
+from log_setup import configure_logging, request_id_var
+from metrics import metrics
+from prefork import preload_shared_state, worker_count
+from result_export import EXPORT_FORMATS, export_chunks, export_filename
+from scheduler import LaneScheduler
+from teacher_analytics import MAX_CLASS_PREFIX_LENGTH, TeacherAnalytics, valid_class_prefix
 
 app = Flask(__name__)
 CORS(app)  # Allow cross-domain requests
 
-# Configure logging with file output for better debugging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('backend.log'),  # Save logs to a file
-        logging.StreamHandler()  # Also print logs to console
-    ]
-)
+# 统一的异步 JSON 日志（见 log_setup.py）
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Global configuration
@@ -31,7 +43,35 @@ class Config:
         'user': os.getenv('DB_USER', 'python01_user51'),
         'password': os.getenv('DB_PASSWORD', 'python01_user51@123')
     }
+    # 只读副本：JSON 列表，每项覆盖主库配置中的字段，如 [{"host": "10.0.0.2"}, {"host": "10.0.0.3", "port": 5433}]
+    REPLICA_CONFIGS = json.loads(os.getenv('DB_REPLICAS', '[]'))
     MODEL_NAME = os.getenv('MODEL_NAME', 'gpt-4o')  # Align with enhanced_ai_processor.py
+    # 异步作业：后台线程数、排队上限、结果保留时间（秒）
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 50))
+    JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', 900))
+    JOB_MAX_RUN_SECONDS = int(os.getenv('JOB_MAX_RUN_SECONDS', 300))
+    # 准入控制：每个用户每分钟的提问数与突发上限，同步请求的截止时间（秒）
+    USER_RATE_PER_MINUTE = float(os.getenv('USER_RATE_PER_MINUTE', 20))
+    USER_BURST = int(os.getenv('USER_BURST', 5))
+    REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', 30))
+    # 双通道调度：快通道（模板/缓存，不调用大模型）与慢通道（大模型）各自的线程数和排队上限
+    FAST_LANE_WORKERS = int(os.getenv('FAST_LANE_WORKERS', 8))
+    FAST_LANE_QUEUE = int(os.getenv('FAST_LANE_QUEUE', 64))
+    SLOW_LANE_WORKERS = int(os.getenv('SLOW_LANE_WORKERS', 16))
+    SLOW_LANE_QUEUE = int(os.getenv('SLOW_LANE_QUEUE', 64))
+    # 教师班级分析：访问令牌（未设置时接口关闭）、结果刷新间隔（秒）、活动热力图统计天数
+    TEACHER_API_TOKEN = os.getenv('TEACHER_API_TOKEN')
+    TEACHER_ANALYTICS_REFRESH = int(os.getenv('TEACHER_ANALYTICS_REFRESH', 300))
+    TEACHER_ACTIVITY_DAYS = int(os.getenv('TEACHER_ACTIVITY_DAYS', 28))
+    TEACHER_ANALYTICS_CACHE_SIZE = int(os.getenv('TEACHER_ANALYTICS_CACHE_SIZE', 256))
+    # 后台健康检查：数据库检查间隔与超时（秒）、大模型检查间隔（秒）、判定不可用的连续失败次数、
+    # 大模型不可达时是否视为未就绪
+    HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 5))
+    HEALTH_DB_TIMEOUT = float(os.getenv('HEALTH_DB_TIMEOUT', 2))
+    HEALTH_LLM_INTERVAL = float(os.getenv('HEALTH_LLM_INTERVAL', 60))
+    HEALTH_FAILURE_THRESHOLD = int(os.getenv('HEALTH_FAILURE_THRESHOLD', 2))
+    HEALTH_REQUIRE_LLM = os.getenv('HEALTH_REQUIRE_LLM', 'false').lower() == 'true'
 
 # Validate environment variables
 def validate_config():
@@ -59,55 +99,208 @@ def validate_config():
         errors.append(f"Database connection failed: {str(e)}")
         return False, errors
 
-# Initialize AIQueryProcessor with detailed error handling
+# 以下服务持有连接池、HTTP 客户端或线程，不能跨 fork 共享，由 init_services 在每个工作进程中创建
 ai_processor = None
-try:
-    is_valid, config_errors = validate_config()
-    if not is_valid:
-        logger.error("Configuration validation failed: %s", "; ".join(config_errors))
-        raise ValueError("Invalid configuration: " + "; ".join(config_errors))
-
-    ai_processor = AIQueryProcessor(
-        openai_api_key=Config.OPENAI_API_KEY,
-        db_config=Config.DATABASE_CONFIG,
-        model=Config.MODEL_NAME
-    )
-    logger.info("AIQueryProcessor initialized successfully")
-except Exception as e:
-    logger.error(f"AIQueryProcessor initialization failed: {str(e)}\n{traceback.format_exc()}")
-    ai_processor = None
+teacher_analytics = None
+job_manager = None
+scheduler = None
+rate_limiter = None
+health_monitor = None
+_services_pid = None
+_services_lock = threading.Lock()
+
+# 进行中的查询，按 request_id 登记以便取消
+cancellations = CancellationRegistry()
+
+
+def init_services(workers=None):
+    """
+    创建本进程的服务（连接池、大模型客户端、线程池），同一进程只创建一次。
+    多进程部署时在每个工作进程 fork 之后调用，连接池等容量按工作进程数分摊
+    """
+    global ai_processor, teacher_analytics, job_manager, scheduler, rate_limiter, health_monitor, _services_pid
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        workers = workers or worker_count()
+
+        # Initialize AIQueryProcessor with detailed error handling
+        ai_processor = None
+        try:
+            is_valid, config_errors = validate_config()
+            if not is_valid:
+                logger.error("Configuration validation failed: %s", "; ".join(config_errors))
+                raise ValueError("Invalid configuration: " + "; ".join(config_errors))
+
+            ai_processor = AIQueryProcessor(
+                openai_api_key=Config.OPENAI_API_KEY,
+                db_config=Config.DATABASE_CONFIG,
+                model=Config.MODEL_NAME,
+                worker_count=workers,
+                replica_configs=Config.REPLICA_CONFIGS
+            )
+            logger.info("AIQueryProcessor initialized successfully")
+        except Exception as e:
+            logger.error("AIQueryProcessor initialization failed: %s\n%s", e, traceback.format_exc())
+            ai_processor = None
+
+        # 教师班级分析（与查询共用连接池）
+        teacher_analytics = TeacherAnalytics(
+            ai_processor.db_pool,
+            refresh_seconds=Config.TEACHER_ANALYTICS_REFRESH,
+            activity_days=Config.TEACHER_ACTIVITY_DAYS,
+            max_entries=Config.TEACHER_ANALYTICS_CACHE_SIZE
+        ) if ai_processor else None
+
+        # 后台健康检查，探活接口直接读取其快照
+        health_monitor = HealthMonitor(
+            ai_processor.db_pool,
+            ai_processor.client,
+            interval=Config.HEALTH_CHECK_INTERVAL,
+            db_timeout=Config.HEALTH_DB_TIMEOUT,
+            llm_interval=Config.HEALTH_LLM_INTERVAL,
+            failure_threshold=Config.HEALTH_FAILURE_THRESHOLD,
+            require_llm=Config.HEALTH_REQUIRE_LLM
+        ) if ai_processor else None
+
+        # 长耗时问题的异步作业
+        job_manager = JobManager(
+            max_workers=Config.JOB_WORKERS,
+            max_pending=Config.JOB_MAX_PENDING,
+            ttl_seconds=Config.JOB_TTL_SECONDS,
+            max_run_seconds=Config.JOB_MAX_RUN_SECONDS
+        )
+
+        # 快慢双通道调度
+        scheduler = LaneScheduler(
+            fast_workers=Config.FAST_LANE_WORKERS,
+            fast_queue=Config.FAST_LANE_QUEUE,
+            slow_workers=Config.SLOW_LANE_WORKERS,
+            slow_queue=Config.SLOW_LANE_QUEUE
+        )
+
+        # 按用户限流：请求大致均匀地分到各工作进程，每个进程按总速率的份额放行
+        rate_limiter = UserRateLimiter(
+            rate=Config.USER_RATE_PER_MINUTE / 60 / workers,
+            burst=Config.USER_BURST
+        )
+
+        _services_pid = os.getpid()
+        logger.info("进程 %s 的服务已创建（共 %s 个工作进程）", _services_pid, workers)
+
+
+def create_app(init=None):
+    """
+    应用工厂：预加载只读数据，并注册按进程创建服务的钩子。
+    init 为 None 时，由 gunicorn 预加载（APP_PREFORK=1）则推迟到 post_fork 再创建服务，否则立即创建
+    """
+    preload_shared_state()
+    if init is None:
+        init = os.getenv('APP_PREFORK') != '1'
+    if init:
+        init_services()
+    return app
+
+
+@app.before_request
+def ensure_services():
+    # 兜底：没有经过 post_fork 的进程（或 fork 出的子进程）在第一个请求时创建服务
+    if _services_pid != os.getpid():
+        init_services()
+
+
+@app.before_request
+def bind_request_id():
+    # 本次请求的日志都带上 request_id（可由客户端通过 X-Request-ID 指定）
+    request_id_var.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex)
+
+
+@app.after_request
+def expose_request_id(response):
+    response.headers['X-Request-ID'] = request_id_var.get() or ''
+    return response
+
+# 按路由设置 Cache-Control / ETag 并压缩响应（在上面的钩子之前执行，返回的 304 也带 X-Request-ID）
+http_cache.install(app)
+
+# 前端页面启动时读入并预先压缩，未变化时返回 304
+FRONTEND_RESPONSE = PrecomputedResponse.file(
+    os.path.join(app.root_path, 'templates', 'frontend.html'), 'text/html', http_cache.cache_control('frontend')
+)
+
+@app.route('/', methods=['GET'])
+def frontend():
+    """前端页面"""
+    return FRONTEND_RESPONSE.respond()
+
+def admission_rejected_response(e, request_id=None):
+    """限流或过载时的响应，带 Retry-After"""
+    response = {
+        'success': False,
+        'error': '请求过于频繁，请稍后再试' if e.status == 429 else '当前查询繁忙，请稍后再试',
+        'error_code': e.error_code,
+        'retry_after': e.retry_after,
+        'timestamp': datetime.now().isoformat()
+    }
+    if request_id:
+        response['request_id'] = request_id
+    response = jsonify(response)
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status
+
+@contextmanager
+def db_connection(read_only=False, user_id=None):
+    """借出数据库连接：服务已创建时经连接池路由（只读请求优先分到副本），否则直连主库"""
+    if ai_processor:
+        with ai_processor.db_pool.connection(read_only=read_only, user_id=user_id) as conn:
+            yield conn
+        return
+    conn = psycopg2.connect(**Config.DATABASE_CONFIG)
+    try:
+        yield conn
+    finally:
+        conn.close()
 
 # Validate user ID
 def validate_user(user_id):
     """Validate if the user exists in the database"""
     try:
-        conn = psycopg2.connect(**Config.DATABASE_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute("SELECT student_id FROM students WHERE student_id = %s", (user_id,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_connection(read_only=True, user_id=user_id) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT student_id FROM students WHERE student_id = %s", (user_id,))
+                result = cursor.fetchone()
+            conn.rollback()
         return result is not None
     except Exception as e:
-        logger.error(f"User validation failed: {str(e)}")
+        logger.error("User validation failed: %s", e)
         return False
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
-    db_status = "connected"
-    try:
-        conn = psycopg2.connect(**Config.DATABASE_CONFIG)
-        conn.close()
-    except Exception as e:
-        db_status = f"disconnected: {str(e)}"
-
-    return jsonify({
-        'status': 'healthy' if ai_processor else 'unhealthy',
-        'timestamp': datetime.now().isoformat(),
-        'ai_processor_ready': ai_processor is not None,
-        'database_status': db_status
-    })
+    """Health check endpoint（返回后台健康检查的快照，不新建数据库连接）"""
+    if not health_monitor:
+        return jsonify({
+            'status': 'unhealthy',
+            'timestamp': datetime.now().isoformat(),
+            'ai_processor_ready': False,
+            'database_status': 'unknown'
+        })
+    _, _, body = health_monitor.status()
+    return Response(body, mimetype='application/json')
+
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    """存活探针：进程能处理请求即返回 200，不检查依赖"""
+    return Response('{"status": "alive"}', mimetype='application/json')
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    """就绪探针：按后台检查的快照返回 200 或 503"""
+    if not health_monitor:
+        return Response('{"status": "not_ready", "error": "AI processor not initialized"}', status=503,
+                        mimetype='application/json')
+    ready, body, _ = health_monitor.status()
+    return Response(body, status=200 if ready else 503, mimetype='application/json')
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -129,13 +322,13 @@ def login():
                 'error_code': 'INVALID_CREDENTIALS'
             }), 400
 
-        logger.info(f"用户登录成功: {user_id}")
+        logger.info("用户登录成功: %s", user_id)
         return jsonify({
             'success': True,
             'message': '登录成功'
         })
     except Exception as e:
-        logger.error(f"登录失败: {str(e)}")
+        logger.error("登录失败: %s", e)
         return jsonify({
             'success': False,
             'error': f'登录失败: {str(e)}',
@@ -151,8 +344,16 @@ def process_query():
         "question": "我有哪些作业没交？",
         "user_id": "202311081040",
         "include_sql": true,
-        "include_raw_results": false
+        "include_raw_results": false,
+        "request_id": "可选，客户端生成的请求ID，用于 /api/query/cancel",
+        "async": false,
+        "page_size": 20,
+        "format": "text"
     }
+    async 为 true 时立即返回作业ID，结果通过 /api/jobs/<job_id> 按 offset / limit 分页获取，
+    不能同时指定 page_size 或 format=structured
+    page_size 可选，指定时只返回首页，并附带 result_handle 和 next_cursor 供 /api/query/page 翻页
+    format 为 structured 时返回带类型的列和行，不拼接文字答案，由前端渲染
     """
     try:
         if not ai_processor:
@@ -187,14 +388,78 @@ def process_query():
                 'error_code': 'INVALID_USER_ID'
             }), 400
 
-        logger.info(f"处理查询: {question} (用户: {user_id})")
+        page_size = parse_page_size(data.get('page_size'))
+        if page_size is False:
+            return jsonify({
+                'success': False,
+                'error': f'page_size 必须是 1 到 {MAX_PAGE_SIZE} 之间的整数',
+                'error_code': 'INVALID_PAGE_SIZE'
+            }), 400
+
+        try:
+            rate_limiter.acquire(user_id)
+        except AdmissionRejected as e:
+            logger.warning("用户请求被限流: %s", user_id)
+            return admission_rejected_response(e)
 
-        result = ai_processor.process_question(question, user_id)
+        answer_format = data.get('format', 'text')
+        if answer_format not in ANSWER_FORMATS:
+            return jsonify({
+                'success': False,
+                'error': f"format 必须是 {' / '.join(ANSWER_FORMATS)} 之一",
+                'error_code': 'INVALID_FORMAT'
+            }), 400
+        structured = answer_format == 'structured'
+
+        if data.get('async', False):
+            if page_size is not None or structured:
+                return jsonify({
+                    'success': False,
+                    'error': '异步查询的结果通过 /api/jobs/<job_id> 分页获取，不支持 page_size 和 structured 格式',
+                    'error_code': 'UNSUPPORTED_ASYNC_OPTION'
+                }), 400
+            return submit_query_job(question, user_id)
+
+        request_id = str(data.get('request_id') or request_id_var.get())
+        request_id_var.set(request_id)
+        lane = ai_processor.classify_lane(question, user_id)
+        logger.info("处理查询 (通道: %s)", lane, extra={'user_id': user_id, 'question': question[:100]})
+
+        deadline = time.monotonic() + Config.REQUEST_DEADLINE_SECONDS
+        cancel_token = cancellations.register(request_id, user_id, deadline)
+        try:
+            result = scheduler.run(
+                lane,
+                lambda: ai_processor.process_question(
+                    question, user_id, cancel_token=cancel_token, page_size=page_size,
+                    render_answer=not structured
+                ),
+                cancel_token
+            )
+        except AdmissionRejected as e:
+            logger.warning("查询未被准入: %s (%s)", request_id, e)
+            return admission_rejected_response(e, request_id)
+        except QueryCancelled:
+            metrics.incr('query.cancelled')
+            logger.info("查询已被客户端取消: %s", request_id)
+            return jsonify({
+                'success': False,
+                'error': '查询已取消',
+                'error_code': 'CANCELLED',
+                'request_id': request_id,
+                'timestamp': datetime.now().isoformat()
+            }), 499
+        finally:
+            cancellations.release(request_id)
+
+        if structured:
+            return structured_query_response(result, data, request_id)
 
         response = {
             'success': result['success'],
             'timestamp': datetime.now().isoformat(),
-            'question': question
+            'question': question,
+            'request_id': request_id
         }
 
         if result['success']:
@@ -204,12 +469,32 @@ def process_query():
                 'result_count': result['result_count']
             })
 
+            if result.get('result_handle'):
+                response['result_handle'] = result['result_handle']
+                response['next_cursor'] = result['next_cursor']
+                response['has_more'] = result['has_more']
+
             if data.get('include_sql', True):
                 response['sql'] = result['sql']
 
+            if result.get('refinement'):
+                # 追问在上一轮结果上细化得到
+                response['refinement'] = result['refinement']
+
             if data.get('include_raw_results', False):
                 response['raw_results'] = result['results']
 
+            if 'sub_results' in result:
+                # 复合问题：附带各子问题的处理概况
+                response['sub_results'] = [{
+                    'question': sub['question'],
+                    'success': sub['success'],
+                    'query_type': sub['query_type'],
+                    'result_count': sub['result_count'],
+                    'result_handle': sub.get('result_handle'),
+                    'next_cursor': sub.get('next_cursor')
+                } for sub in result['sub_results']]
+
             if result['query_type']:
                 try:
                     query_type_enum = QueryType(result['query_type'])
@@ -218,7 +503,7 @@ def process_query():
                 except:
                     pass
 
-            logger.info(f"查询成功: {result['result_count']}条结果")
+            logger.info("查询成功: %d条结果", result['result_count'])
             return jsonify(response)
         else:
             response.update({
@@ -229,11 +514,11 @@ def process_query():
             if data.get('include_sql', True) and 'sql' in result:
                 response['sql'] = result['sql']
 
-            logger.warning(f"查询失败: {result['error']}")
+            logger.warning("查询失败: %s", result['error'])
             return jsonify(response), 400
 
     except Exception as e:
-        logger.error(f"处理查询时发生错误: {str(e)}\n{traceback.format_exc()}")
+        logger.error("处理查询时发生错误: %s\n%s", e, traceback.format_exc())
         return jsonify({
             'success': False,
             'error': '服务器内部错误',
@@ -241,56 +526,400 @@ def process_query():
             'timestamp': datetime.now().isoformat()
         }), 500
 
-@app.route('/api/suggestions', methods=['GET'])
-def get_suggestions():
-    """获取查询建议"""
-    try:
-        suggestions = {
-            'learning_schedule': [
-                "这周有什么课程要学？",
-                "最近的学习安排是什么？",
-                "下个月的课程安排",
-                "所有课程的学习时间表"
-            ],
-            'unit_test': [
-                "什么时候有单元测试？",
-                "第3单元测试是什么时候？",
-                "所有单元测试的时间安排",
-                "最近的考试安排"
-            ],
-            'experiment_report': [
-                "我有哪些作业没交？",
-                "未提交的实验报告有哪些？",
-                "本周截止的实验报告",
-                "逾期的作业列表"
-            ],
-            'course_info': [
-                "数据库课程有哪些内容？",
-                "所有课程的详细信息",
-                "课程内容和时间安排",
-                "每次课的学习内容"
-            ],
-            'student_progress': [
-                "我的学习进度怎么样？",
-                "作业完成情况统计",
-                "学习完成度分析",
-                "我提交了多少作业？"
+MAX_PAGE_SIZE = 500
+ANSWER_FORMATS = ('text', 'structured')
+
+def send_payload(payload, status=200):
+    """按 Accept 头返回 JSON 或 MessagePack（需安装 msgpack）"""
+    if msgpack_available() and request.accept_mimetypes.best_match(
+            ['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return Response(pack(payload), status=status, mimetype=MSGPACK_MIMETYPE)
+    return jsonify(payload), status
+
+def structured_query_response(result, data, request_id):
+    """format=structured 的查询响应：只含带类型的列、行和 message_code，不含拼好的答案"""
+    if not result['success']:
+        logger.warning("查询失败: %s", result['error'])
+        return send_payload({
+            'success': False,
+            'error': result['error'],
+            'error_code': 'QUERY_FAILED',
+            'message_code': result.get('message_code'),
+            'request_id': request_id
+        }, 400)
+
+    if 'sub_results' in result:
+        # 复合问题：各子问题的列不同，分别返回
+        payload = {
+            'query_type': result['query_type'],
+            'message_code': result['message_code'],
+            'result_count': result['result_count'],
+            'sub_results': [
+                dict(structured_result(sub), question=sub['question'], success=sub['success'],
+                     error=sub.get('error'), result_handle=sub.get('result_handle'))
+                for sub in result['sub_results']
             ]
         }
+    else:
+        payload = structured_result(result)
+        if result.get('result_handle'):
+            payload['result_handle'] = result['result_handle']
+
+    payload.update({'success': True, 'request_id': request_id})
+    if data.get('include_sql', False):
+        payload['sql'] = result['sql']
+    if result.get('suggestions'):
+        payload['suggestions'] = result['suggestions']
+
+    logger.info("查询成功: %d条结果", result['result_count'])
+    return send_payload(payload)
+
+def parse_page_size(value, default=None):
+    """解析分页大小，未提供时返回 default，非法时返回 False"""
+    if value is None:
+        return default
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        return False
+    return page_size if 1 <= page_size <= MAX_PAGE_SIZE else False
 
+@app.route('/api/query/page', methods=['POST'])
+def fetch_query_page():
+    """
+    翻页获取查询结果（重新执行缓存的 SQL，不调用大模型）
+    请求格式:
+    {
+        "user_id": "202311081040",
+        "result_handle": "...",
+        "cursor": "上一页返回的 next_cursor，省略时返回首页",
+        "page_size": 20,
+        "include_raw_results": true,
+        "format": "text"
+    }
+    """
+    if not ai_processor:
         return jsonify({
-            'success': True,
-            'suggestions': suggestions,
-            'timestamp': datetime.now().isoformat()
+            'success': False,
+            'error': 'AI查询服务暂时不可用。请检查服务器日志以获取详细信息。',
+            'error_code': 'SERVICE_UNAVAILABLE'
+        }), 503
+
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id')
+    handle_id = data.get('result_handle')
+    page_size = parse_page_size(data.get('page_size'), default=20)
+    answer_format = data.get('format', 'text')
+    if not user_id or not handle_id or page_size is False or answer_format not in ANSWER_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': '请求数据格式错误',
+            'error_code': 'INVALID_REQUEST'
+        }), 400
+
+    structured = answer_format == 'structured'
+    result = ai_processor.fetch_page(handle_id, user_id, data.get('cursor'), page_size,
+                                     render_answer=not structured)
+    if not result['success']:
+        status = 404 if result['error_code'] == 'HANDLE_NOT_FOUND' else 400
+        return jsonify(result), status
+
+    if structured:
+        payload = structured_result(result)
+        payload.update({'success': True, 'result_handle': handle_id, 'offset': result['offset']})
+        return send_payload(payload)
+
+    response = {
+        'success': True,
+        'answer': result['answer'],
+        'query_type': result['query_type'],
+        'result_count': result['result_count'],
+        'offset': result['offset'],
+        'result_handle': handle_id,
+        'next_cursor': result['next_cursor'],
+        'has_more': result['has_more'],
+        'timestamp': datetime.now().isoformat()
+    }
+    if data.get('include_raw_results', True):
+        response['columns'] = result['columns']
+        response['raw_results'] = result['results']
+    return jsonify(response)
+
+@app.route('/api/query/export', methods=['GET'])
+def export_query_results():
+    """
+    以 CSV / JSONL 流式下载结果句柄对应的完整结果（重新执行已校验的 SQL，不分页，不调用大模型）
+    参数: user_id, result_handle, format (csv / jsonl，默认 csv), gzip (为 1 时下载 .gz 文件)
+    """
+    if not ai_processor:
+        return jsonify({
+            'success': False,
+            'error': 'AI查询服务暂时不可用。请检查服务器日志以获取详细信息。',
+            'error_code': 'SERVICE_UNAVAILABLE'
+        }), 503
+
+    user_id = request.args.get('user_id')
+    handle_id = request.args.get('result_handle')
+    export_format = request.args.get('format', 'csv')
+    compress = request.args.get('gzip', '0').lower() in ('1', 'true')
+    if not user_id or not handle_id or export_format not in EXPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'error': '请求数据格式错误',
+            'error_code': 'INVALID_REQUEST'
+        }), 400
+
+    try:
+        exported = ai_processor.export_rows(handle_id, user_id)
+    except AdmissionRejected as e:
+        logger.warning("导出被拒绝: %s", e)
+        return admission_rejected_response(e)
+    except Exception as e:
+        logger.error("导出查询失败: %s\n%s", e, traceback.format_exc())
+        return jsonify({
+            'success': False,
+            'error': '导出失败，请稍后重试',
+            'error_code': 'EXPORT_FAILED'
+        }), 500
+    if exported is None:
+        return jsonify({
+            'success': False,
+            'error': '结果已过期，请重新提问',
+            'error_code': 'HANDLE_NOT_FOUND'
+        }), 404
+
+    handle, columns, batches = exported
+    logger.info("开始导出: %s (%s, 用户: %s)", handle_id, export_format, user_id)
+    response = Response(export_chunks(export_format, columns, batches, compress),
+                        content_type='application/gzip' if compress else EXPORT_FORMATS[export_format][0])
+    filename = export_filename(handle['query_type'], export_format, compress)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # 反向代理（nginx）不缓冲，逐块转发给客户端
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def submit_query_job(question, user_id):
+    """把问题提交为异步作业，返回 202 和作业ID"""
+    try:
+        job_id = job_manager.submit(
+            user_id,
+            lambda cancel_token: ai_processor.process_question(question, user_id, cancel_token=cancel_token)
+        )
+    except JobQueueFull as e:
+        logger.warning("异步作业被拒绝: %s", e)
+        response = jsonify({
+            'success': False,
+            'error': '当前排队的查询过多，请稍后再试',
+            'error_code': 'JOB_QUEUE_FULL'
         })
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    logger.info("提交异步查询: %s (用户: %s)", job_id, user_id)
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'poll_url': f'/api/jobs/{job_id}',
+        'timestamp': datetime.now().isoformat()
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    查询异步作业状态，完成后分页返回结果行
+    参数: user_id, offset (默认 0), limit (默认 50，最大 500), include_sql
+    """
+    job = job_manager.get(job_id, request.args.get('user_id'))
+    if not job:
+        return jsonify({
+            'success': False,
+            'error': '作业不存在或已过期',
+            'error_code': 'JOB_NOT_FOUND'
+        }), 404
+
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+
+    response = {
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'created_at': datetime.fromtimestamp(job['created_at']).isoformat(),
+        'timestamp': datetime.now().isoformat()
+    }
+    if job['expires_at']:
+        response['expires_at'] = datetime.fromtimestamp(job['expires_at']).isoformat()
+
+    if job['status'] == 'failed':
+        response['error'] = '查询过程中遇到了技术问题，请稍后重试。'
+    elif job['status'] == 'timed_out':
+        response['error'] = '查询耗时过长，已被取消，请尝试缩小查询范围。'
+    elif job['status'] == 'succeeded':
+        result = job['result']
+        rows = result.get('results') or []
+        response['result'] = {
+            'success': result['success'],
+            'query_type': result['query_type'],
+            'result_count': result['result_count']
+        }
+        if result['success']:
+            response['result']['answer'] = result['answer']
+            if request.args.get('include_sql', 'true').lower() == 'true':
+                response['result']['sql'] = result['sql']
+        else:
+            response['result']['error'] = result['error']
+        response['rows'] = rows[offset:offset + limit]
+        response['offset'] = offset
+        response['next_offset'] = offset + limit if offset + limit < len(rows) else None
+
+    return jsonify(response)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """取消异步作业"""
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id') or request.args.get('user_id')
+    if not job_manager.cancel(job_id, user_id):
+        return jsonify({
+            'success': False,
+            'error': '作业不存在或已过期',
+            'error_code': 'JOB_NOT_FOUND'
+        }), 404
+    return jsonify({'success': True, 'job_id': job_id, 'cancelled': True})
+
+@app.route('/api/query/cancel', methods=['POST'])
+def cancel_query():
+    """
+    取消进行中的查询
+    请求格式: {"request_id": "...", "user_id": "202311081040"}
+    """
+    data = request.get_json(silent=True) or {}
+    request_id = data.get('request_id')
+    user_id = data.get('user_id')
+    if not request_id or not user_id:
+        return jsonify({
+            'success': False,
+            'error': '请求ID和学生ID不能为空',
+            'error_code': 'EMPTY_INPUT'
+        }), 400
+
+    cancelled = cancellations.cancel(str(request_id), user_id)
+    logger.info("取消查询: %s (用户: %s, 进行中: %s)", request_id, user_id, cancelled)
+    return jsonify({
+        'success': True,
+        'request_id': request_id,
+        'cancelled': cancelled
+    })
+
+# 建议问题表（只读，预加载后各工作进程共享）
+SUGGESTIONS = {
+    'learning_schedule': [
+        "这周有什么课程要学？",
+        "最近的学习安排是什么？",
+        "下个月的课程安排",
+        "所有课程的学习时间表"
+    ],
+    'unit_test': [
+        "什么时候有单元测试？",
+        "第3单元测试是什么时候？",
+        "所有单元测试的时间安排",
+        "最近的考试安排"
+    ],
+    'experiment_report': [
+        "我有哪些作业没交？",
+        "未提交的实验报告有哪些？",
+        "本周截止的实验报告",
+        "逾期的作业列表"
+    ],
+    'course_info': [
+        "数据库课程有哪些内容？",
+        "所有课程的详细信息",
+        "课程内容和时间安排",
+        "每次课的学习内容"
+    ],
+    'student_progress': [
+        "我的学习进度怎么样？",
+        "作业完成情况统计",
+        "学习完成度分析",
+        "我提交了多少作业？"
+    ]
+}
+
+# 建议问题表的响应只序列化、压缩一次（timestamp 为生成时间）
+SUGGESTIONS_RESPONSE = PrecomputedResponse.json({
+    'success': True,
+    'suggestions': SUGGESTIONS,
+    'timestamp': datetime.now().isoformat()
+}, http_cache.cache_control('get_suggestions'))
+
+@app.route('/api/suggestions', methods=['GET'])
+def get_suggestions():
+    """获取查询建议"""
+    return SUGGESTIONS_RESPONSE.respond()
+
+@app.route('/api/teacher/analytics', methods=['GET'])
+def get_teacher_analytics():
+    """
+    班级学习情况分析（完成率分位数、成绩分布、迟交天数分布、活动热力图）
+    请求头: X-Teacher-Token
+    参数: class_prefix 班级学号前缀，省略时统计全部学生
+    """
+    token = request.headers.get('X-Teacher-Token', '')
+    if not Config.TEACHER_API_TOKEN or not hmac.compare_digest(token, Config.TEACHER_API_TOKEN):
+        return jsonify({
+            'success': False,
+            'error': '无权访问教师分析接口',
+            'error_code': 'FORBIDDEN'
+        }), 403
+
+    if not teacher_analytics:
+        return jsonify({
+            'success': False,
+            'error': '分析服务暂时不可用。请检查服务器日志以获取详细信息。',
+            'error_code': 'SERVICE_UNAVAILABLE'
+        }), 503
+
+    class_prefix = request.args.get('class_prefix', '').strip()
+    if not valid_class_prefix(class_prefix):
+        return jsonify({
+            'success': False,
+            'error': f'class_prefix 必须是不超过 {MAX_CLASS_PREFIX_LENGTH} 位数字的学号前缀',
+            'error_code': 'INVALID_CLASS_PREFIX'
+        }), 400
 
+    try:
+        report = teacher_analytics.class_report(class_prefix)
+        return jsonify(dict(report, success=True))
     except Exception as e:
-        logger.error(f"获取建议时发生错误: {str(e)}")
+        logger.error("班级分析失败: %s\n%s", e, traceback.format_exc())
         return jsonify({
             'success': False,
-            'error': '获取建议失败',
-            'error_code': 'SUGGESTIONS_ERROR'
+            'error': '班级分析失败',
+            'error_code': 'ANALYTICS_ERROR'
         }), 500
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """运行指标（推测执行命中率、浪费的数据库负载等）"""
+    response = metrics.snapshot()
+    response['in_flight_queries'] = cancellations.in_flight()
+    response['jobs'] = job_manager.stats()
+    if ai_processor:
+        response['speculation'] = ai_processor.speculation_stats()
+        response['db_pool'] = ai_processor.db_pool.stats()
+        response['llm_admission'] = ai_processor.llm_admission.stats()
+        if ai_processor.answer_store:
+            response['precompute'] = ai_processor.answer_store.stats()
+        if ai_processor.semantic_cache:
+            response['semantic_cache'] = ai_processor.semantic_cache.stats()
+        response['rollups'] = ai_processor.rollup_freshness.stats()
+    if health_monitor:
+        response['health'] = health_monitor.stats()
+    response['lanes'] = scheduler.stats()
+    response['timestamp'] = datetime.now().isoformat()
+    return jsonify(response)
+
 @app.route('/api/change_password', methods=['POST'])
 def change_password():
     """Change user password"""
@@ -307,43 +936,43 @@ def change_password():
                 'error_code': 'EMPTY_INPUT'
             }), 400
 
-        # 验证用户和旧密码
-        conn = psycopg2.connect(**Config.DATABASE_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT student_id FROM students WHERE student_id = %s AND password = %s",
-            (user_id, old_password)
-        )
-        if not cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return jsonify({
-                'success': False,
-                'error': '旧密码错误或学生ID不存在',
-                'error_code': 'INVALID_CREDENTIALS'
-            }), 400
-
-        # 更新密码
-        cursor.execute(
-            "UPDATE students SET password = %s WHERE student_id = %s",
-            (new_password, user_id)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        logger.info(f"密码修改成功: {user_id}")
+        # 验证用户和旧密码、更新密码都在主库上进行
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT student_id FROM students WHERE student_id = %s AND password = %s",
+                    (user_id, old_password)
+                )
+                if not cursor.fetchone():
+                    return jsonify({
+                        'success': False,
+                        'error': '旧密码错误或学生ID不存在',
+                        'error_code': 'INVALID_CREDENTIALS'
+                    }), 400
+
+                # 更新密码
+                cursor.execute(
+                    "UPDATE students SET password = %s WHERE student_id = %s",
+                    (new_password, user_id)
+                )
+            conn.commit()
+            # 副本追上这次写入之前，该用户的读请求留在主库
+            if ai_processor:
+                ai_processor.db_pool.record_write(user_id, conn)
+
+        logger.info("密码修改成功: %s", user_id)
         return jsonify({
             'success': True,
             'message': '密码修改成功'
         })
 
     except Exception as e:
-        logger.error(f"密码修改失败: {str(e)}\n{traceback.format_exc()}")
+        logger.error("密码修改失败: %s\n%s", e, traceback.format_exc())
         return jsonify({
             'success': False,
             'error': f'密码修改失败: {str(e)}',
             'error_code': 'CHANGE_PASSWORD_ERROR'
         }), 500
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # 开发环境单进程运行；生产环境使用 gunicorn -c gunicorn.conf.py wsgi:app
+    create_app().run(debug=os.getenv('FLASK_DEBUG', 'true').lower() == 'true', host='0.0.0.0', port=5000)
@@ -0,0 +1,113 @@
+"""
+进行中查询的取消支持
+
+前端为每次提问生成 request_id，放弃等待时调用 /api/query/cancel。
+CancelToken 贯穿 process_question，取消时触发已注册的回调：
+关闭正在进行的大模型 HTTP 流、对正在执行的数据库查询发送 cancel。
+"""
+import threading
+import time
+
+
+class QueryCancelled(Exception):
+    """查询已被客户端取消"""
+
+
+class CancelToken:
+    def __init__(self, request_id=None, user_id=None, deadline=None):
+        self.request_id = request_id
+        self.user_id = user_id
+        # 请求截止时间（time.monotonic()），用于准入控制按截止时间提前拒绝
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """取消请求并执行所有已注册的回调（在锁内执行，保证注销后不会再被调用）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    # 取消是尽力而为的，回调失败不影响其余回调
+                    pass
+
+    def on_cancel(self, callback):
+        """
+        注册取消回调，返回注销函数。
+        如果已经取消，回调会立即执行。
+        """
+        with self._lock:
+            if not self._event.is_set():
+                callback_id = self._next_id
+                self._next_id += 1
+                self._callbacks[callback_id] = callback
+
+                def unregister():
+                    with self._lock:
+                        self._callbacks.pop(callback_id, None)
+
+                return unregister
+
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise QueryCancelled(f"请求已取消: {self.request_id}")
+
+
+class CancellationRegistry:
+    """按 request_id 登记进行中的请求，支持在请求开始前到达的取消"""
+
+    def __init__(self, tombstone_ttl=60):
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._tombstones = {}
+        self.tombstone_ttl = tombstone_ttl
+
+    def register(self, request_id, user_id, deadline=None):
+        token = CancelToken(request_id, user_id, deadline)
+        with self._lock:
+            self._purge_tombstones()
+            self._tokens[request_id] = token
+            tombstone = self._tombstones.pop(request_id, None)
+        if tombstone and tombstone[0] == user_id:
+            token.cancel()
+        return token
+
+    def cancel(self, request_id, user_id):
+        """取消指定请求，只允许请求的发起者取消。请求尚未登记时记录墓碑"""
+        with self._lock:
+            token = self._tokens.get(request_id)
+            if token is None:
+                self._tombstones[request_id] = (user_id, time.monotonic() + self.tombstone_ttl)
+                return False
+        if token.user_id != user_id:
+            return False
+        token.cancel()
+        return True
+
+    def release(self, request_id):
+        with self._lock:
+            self._tokens.pop(request_id, None)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._tokens)
+
+    def _purge_tombstones(self):
+        now = time.monotonic()
+        for request_id in [rid for rid, (_, expires) in self._tombstones.items() if expires < now]:
+            del self._tombstones[request_id]
@@ -0,0 +1,323 @@
+"""
+多轮对话上下文与结果的本地细化
+
+每个用户保留最近一轮查询的 query_type、SQL、输出列和结果行。追问如
+"只看紧急的"、"按截止日期排序"、"成绩最高的3门"、"一共几个" 直接在保存的结果行上
+筛选、排序、取前 N 条或计数，不再调用大模型、也不访问数据库。
+
+细化规则只在整句都能被识别时生效（去掉识别出的部分和语气词后没有剩余内容），
+其余追问仍交给大模型，并附带上一轮的问题和 SQL 作为上下文。
+
+内存有上限：每个用户最多保存 max_rows_per_user 行（结果被截断或分页未取完时只保存 SQL，
+不做本地细化），全部用户合计最多 max_rows 行，超出时淘汰最久未访问的用户；
+超过 ttl_seconds 未访问的上下文失效。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+
+from text_features import normalize_question
+
+# 输出列名 -> 问题中可能使用的叫法
+COLUMN_ALIASES = {
+    'grade': ['成绩', '分数', '得分'],
+    'avg_grade': ['平均分', '平均成绩'],
+    'late_days': ['迟交天数', '逾期天数', '迟交'],
+    'report_deadline': ['截止日期', '截止时间', '截止日', '到期时间', '截止', 'deadline'],
+    'submit_date': ['提交日期', '提交时间'],
+    'online_learning_date': ['学习日期', '上课日期', '上课时间'],
+    'unit_test_date': ['测试日期', '考试日期', '考试时间'],
+    'feedback_date': ['反馈时间', '反馈日期'],
+    'publish_date': ['发布时间', '发布日期'],
+    'expire_date': ['过期时间', '过期日期'],
+    'total_minutes': ['学习时长', '总时长', '时长'],
+    'avg_duration': ['平均时长'],
+    'total_activities': ['活动次数'],
+    'active_days': ['活跃天数'],
+    'access_count': ['访问次数', '次数'],
+    'total_seconds': ['使用时长'],
+    'last_access': ['最近访问', '最后访问'],
+    'rank': ['排名', '名次'],
+    'completed': ['完成数', '完成数量'],
+    'course_content': ['课程', '课程内容'],
+}
+
+_CN_DIGITS = {'零': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_NUMBER = r'(\d+(?:\.\d+)?|[零一二两三四五六七八九十]+)'
+_UNIT = r'(?:个|条|项|门|份|次|名|分|天|分钟|秒)?'
+
+_COUNT = re.compile(r'(?:一共|总共|总计|共)有?(?:多少|几)' + _UNIT + r'|有?(?:多少|几)(?:个|条|项|门|份)|数量')
+_TOP = re.compile(r'前' + _NUMBER + _UNIT)
+_ORDER = r'(从高到低|从大到小|从多到少|从晚到早|从新到旧|降序|倒序|逆序|从低到高|从小到大|从少到多|从早到晚|从旧到新|升序|正序|顺序)'
+_DESCENDING = {'从高到低', '从大到小', '从多到少', '从晚到早', '从新到旧', '降序', '倒序', '逆序'}
+_SUPERLATIVE_DESCENDING = {'高', '多', '大', '晚', '新', '长'}
+_COMPARATORS = [
+    ('>=', r'不低于|不少于|至少|>='), ('<=', r'不高于|不超过|至多|<='),
+    ('>', r'大于|高于|超过|多于|>'), ('<', r'小于|低于|少于|不到|<'), ('=', r'等于|=')
+]
+_EXCLUDE_WORDS = r'不看|不要|去掉|排除|除了|除去|不是|非|不'
+_EXCLUDE_PREFIX = re.compile(r'(?:' + _EXCLUDE_WORDS + r')$')
+_FILTER_WORDS = re.compile(r'只看|只要|只显示|只留|仅看|仅显示|筛选|过滤出?|' + _EXCLUDE_WORDS)
+# 整句去掉细化部分后允许剩下的语气词、代词、连接词等
+_FILLER = re.compile(r'[的呢吧吗啊呀了请帮给我你把再那么就都个条项门些中里面其结果这上刚才一下看显示列出按排序还是和与或及、]+')
+# 看起来是针对上一轮结果的追问
+_FOLLOW_UP = re.compile(
+    r'^(那|那么|再|还是|换成|改成|如果)|呢$|只看|只要|只显示|仅看|排序|其中|这些|这几|上面|刚才|去掉|排除|除了|前'
+    + _NUMBER + r'(个|条|项|门|名)'
+)
+
+
+def _parse_number(text):
+    """阿拉伯数字或不超过九十九的中文数字"""
+    if re.fullmatch(r'\d+(?:\.\d+)?', text):
+        return float(text) if '.' in text else int(text)
+    if '十' not in text:
+        return _CN_DIGITS.get(text) if len(text) == 1 else None
+    tens, _, ones = text.partition('十')
+    if len(tens) > 1 or len(ones) > 1 or (tens and tens not in _CN_DIGITS) or (ones and ones not in _CN_DIGITS):
+        return None
+    return (_CN_DIGITS[tens] if tens else 1) * 10 + (_CN_DIGITS[ones] if ones else 0)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def _column_pattern(columns):
+    """当前结果中存在的列的叫法（长的优先），返回 (正则片段, 叫法 -> 列下标)"""
+    lookup = {}
+    for index, name in enumerate(columns):
+        for alias in COLUMN_ALIASES.get(name, []) + [name.lower()]:
+            lookup.setdefault(alias, index)
+    if not lookup:
+        return None, lookup
+    aliases = sorted(lookup, key=len, reverse=True)
+    return '(' + '|'.join(re.escape(alias) for alias in aliases) + ')', lookup
+
+
+def parse_refinement(question, columns, rows):
+    """
+    把追问解析为细化操作列表，无法完整识别时返回 None。操作:
+    {'op': 'filter', 'column', 'value', 'exclude'} / {'op': 'compare', 'column', 'operator', 'value'} /
+    {'op': 'sort', 'column', 'descending'} / {'op': 'top', 'count'} / {'op': 'count'}
+    """
+    text = normalize_question(question)
+    if not text or not columns:
+        return None
+    column_re, aliases = _column_pattern(columns)
+    ops = []
+
+    def consume(match):
+        nonlocal text
+        text = text[:match.start()] + ' ' + text[match.end():]
+
+    # 比较条件：成绩大于80、迟交天数不超过2天、成绩80分以上
+    if column_re:
+        for operator, words in _COMPARATORS:
+            for match in list(re.finditer(column_re + r'(?:' + words + r')' + _NUMBER + _UNIT, text))[::-1]:
+                value = _parse_number(match.group(2))
+                if value is None:
+                    return None
+                ops.append({'op': 'compare', 'column': aliases[match.group(1)], 'operator': operator, 'value': value})
+                consume(match)
+        for match in list(re.finditer(column_re + r'(?:在)?' + _NUMBER + _UNIT + r'(及?以上|及?以下)', text))[::-1]:
+            value = _parse_number(match.group(2))
+            if value is None:
+                return None
+            operator = '>=' if match.group(3).endswith('以上') else '<='
+            ops.append({'op': 'compare', 'column': aliases[match.group(1)], 'operator': operator, 'value': value})
+            consume(match)
+
+    # 排序：按截止日期排序、按成绩从高到低
+    sort_op = top_op = None
+    if column_re:
+        match = re.search(r'按照?' + column_re + _ORDER + r'?(?:排序|排列|排)?', text)
+        if match:
+            sort_op = {'op': 'sort', 'column': aliases[match.group(1)], 'descending': match.group(2) in _DESCENDING}
+            consume(match)
+        else:
+            # 最值：成绩最高的3门、学习时长最长的
+            match = re.search(column_re + r'最(高|多|大|晚|新|长|低|少|小|早|旧|短)的?' + _NUMBER + '?' + _UNIT, text)
+            if match:
+                count = _parse_number(match.group(3)) if match.group(3) else 1
+                if not count:
+                    return None
+                sort_op = {'op': 'sort', 'column': aliases[match.group(1)],
+                           'descending': match.group(2) in _SUPERLATIVE_DESCENDING}
+                top_op = {'op': 'top', 'count': count}
+                consume(match)
+
+    match = _TOP.search(text)
+    if match and top_op is None:
+        count = _parse_number(match.group(1))
+        if not count:
+            return None
+        top_op = {'op': 'top', 'count': count}
+        consume(match)
+
+    count_op = None
+    match = _COUNT.search(text)
+    if match:
+        count_op = {'op': 'count'}
+        consume(match)
+
+    # 按取值筛选：只看紧急的、去掉已逾期的（单字取值容易误匹配，不参与）
+    values = {}
+    for row in rows:
+        for index, value in enumerate(row):
+            if isinstance(value, str) and 2 <= len(value) <= 20:
+                values.setdefault(normalize_question(value), (index, value))
+    filtered = False
+    for key in sorted(values, key=len, reverse=True):
+        position = text.find(key)
+        if not key or position < 0:
+            continue
+        index, value = values[key]
+        exclude = bool(_EXCLUDE_PREFIX.search(_FILLER.sub('', text[:position].replace(' ', ''))))
+        ops.append({'op': 'filter', 'column': index, 'value': value, 'exclude': exclude})
+        text = text[:position] + ' ' + text[position + len(key):]
+        filtered = True
+
+    for op in (sort_op, top_op, count_op):
+        if op:
+            ops.append(op)
+    if not ops:
+        return None
+
+    # 剩余内容只能是语气词和筛选用语
+    leftover = text.replace(' ', '')
+    if filtered:
+        leftover = _FILTER_WORDS.sub('', leftover)
+    return ops if not _FILLER.sub('', leftover) else None
+
+
+def _compare(value, operator, target):
+    if not _is_number(value):
+        return False
+    value = float(value)
+    return {'>': value > target, '<': value < target, '>=': value >= target,
+            '<=': value <= target, '=': value == target}[operator]
+
+
+def _sort_key(value):
+    # NULL 排在最后，数字与日期可比较，其余按文本
+    if value is None:
+        return (2, 0)
+    if _is_number(value):
+        return (0, float(value))
+    if isinstance(value, date):
+        return (0, value.toordinal() if type(value) is date else value.timestamp() / 86400)
+    return (1, str(value))
+
+
+def apply_refinement(ops, rows):
+    """依次执行筛选、排序、取前 N 条，返回 (结果行, 是否只需计数)。同一列的多个保留取值之间为"或"关系"""
+    rows = list(rows)
+    included = {}
+    for op in ops:
+        if op['op'] == 'filter' and not op['exclude']:
+            included.setdefault(op['column'], set()).add(op['value'])
+        elif op['op'] == 'filter':
+            rows = [row for row in rows if row[op['column']] != op['value']]
+        elif op['op'] == 'compare':
+            rows = [row for row in rows if _compare(row[op['column']], op['operator'], op['value'])]
+    for column, accepted in included.items():
+        rows = [row for row in rows if row[column] in accepted]
+    for op in ops:
+        if op['op'] == 'sort':
+            present = [row for row in rows if row[op['column']] is not None]
+            missing = [row for row in rows if row[op['column']] is None]
+            present.sort(key=lambda row: _sort_key(row[op['column']]), reverse=op['descending'])
+            rows = present + missing
+    for op in ops:
+        if op['op'] == 'top':
+            rows = rows[:op['count']]
+    return rows, any(op['op'] == 'count' for op in ops)
+
+
+def describe_refinement(ops, columns):
+    """细化操作的文字说明，用于答案和大模型上下文"""
+    parts = []
+    for op in ops:
+        if op['op'] == 'filter':
+            parts.append(f"{'排除' if op['exclude'] else '只保留'} {columns[op['column']]} = {op['value']}")
+        elif op['op'] == 'compare':
+            parts.append(f"{columns[op['column']]} {op['operator']} {op['value']}")
+    for op in ops:
+        if op['op'] == 'sort':
+            parts.append(f"按 {columns[op['column']]} {'降序' if op['descending'] else '升序'}")
+    for op in ops:
+        if op['op'] == 'top':
+            parts.append(f"取前 {op['count']} 条")
+        elif op['op'] == 'count':
+            parts.append('计数')
+    return '，'.join(parts)
+
+
+def looks_like_follow_up(question):
+    """问题是否像针对上一轮结果的追问（需要上一轮上下文才能理解）"""
+    return bool(_FOLLOW_UP.search(normalize_question(question)))
+
+
+class ConversationStore:
+    """每个用户最近一轮查询的上下文：LRU 淘汰，总行数与空闲时间都有上限"""
+
+    def __init__(self, max_users=5000, max_rows=200000, max_rows_per_user=500, ttl_seconds=900):
+        self.max_users = max_users
+        self.max_rows = max_rows
+        self.max_rows_per_user = max_rows_per_user
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+        self._row_count = 0
+
+    def remember(self, user_id, question, query_type, sql, columns, rows, complete=True, refinements=()):
+        """
+        保存本轮查询。complete 为 False（分页未取完）或行数超过单用户上限时只保存 SQL，
+        后续追问交给大模型
+        """
+        keep_rows = complete and rows is not None and len(rows) <= self.max_rows_per_user
+        state = {
+            'question': question,
+            'query_type': query_type,
+            'sql': sql,
+            'columns': list(columns or []),
+            'rows': list(rows) if keep_rows else None,
+            'refinements': list(refinements),
+            'touched_at': time.monotonic()
+        }
+        with self._lock:
+            self._discard(user_id)
+            self._states[user_id] = state
+            self._row_count += len(state['rows'] or [])
+            while self._states and (len(self._states) > self.max_users or self._row_count > self.max_rows):
+                self._discard(next(iter(self._states)))
+
+    def get(self, user_id):
+        """返回用户的上下文，不存在或已过期时返回 None"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                return None
+            if time.monotonic() - state['touched_at'] > self.ttl_seconds:
+                self._discard(user_id)
+                return None
+            state['touched_at'] = time.monotonic()
+            self._states.move_to_end(user_id)
+            return state
+
+    def clear(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._states), 'rows': self._row_count, 'max_rows': self.max_rows}
+
+    def _discard(self, user_id):
+        state = self._states.pop(user_id, None)
+        if state is not None:
+            self._row_count -= len(state['rows'] or [])
@@ -0,0 +1,113 @@
+"""
+生成 SQL 的执行前代价检查
+
+大模型生成的 SQL 语法正确、只读，也可能代价极高（例如遗漏连接条件导致两张大表做笛卡尔积）。
+执行前先 EXPLAIN 取得优化器的估算，与该查询类型的预算比较，超出预算的语句不执行。
+
+- 取计划树中所有节点的最大总代价和最大估算行数：LIMIT 节点自身的代价很小，
+  其下的笛卡尔积仍会在子节点上体现
+- 估算结果按 SQL 指纹缓存（参数只影响选择率，对量级判断影响不大），重复的语句不再 EXPLAIN
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from sql_analyzer import sql_fingerprint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = {'max_cost': 100000.0, 'max_rows': 100000.0}
+# 需要汇总全班数据的查询类型预算放宽
+QUERY_TYPE_BUDGETS = {
+    'peer_comparison': {'max_cost': 500000.0},
+    'completion_stats': {'max_cost': 500000.0},
+    'learning_analytics': {'max_cost': 300000.0},
+}
+
+
+class QueryTooExpensive(Exception):
+    """SQL 的估算代价超出预算"""
+
+    def __init__(self, message, estimate):
+        super().__init__(message)
+        self.estimate = estimate
+
+
+def _walk_plan(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _walk_plan(child)
+
+
+def plan_estimate(plan):
+    """从 EXPLAIN (FORMAT JSON) 的计划树中取最大总代价、最大估算行数及代价最高的节点类型"""
+    nodes = list(_walk_plan(plan))
+    costliest = max(nodes, key=lambda node: node.get('Total Cost', 0))
+    return {
+        'cost': float(costliest.get('Total Cost', 0)),
+        'rows': float(max(node.get('Plan Rows', 0) for node in nodes)),
+        'node': costliest.get('Node Type'),
+    }
+
+
+class CostGuard:
+    def __init__(self, max_cost=None, max_rows=None, budgets=None, cache_size=2048):
+        self.default_budget = {
+            'max_cost': float(max_cost if max_cost is not None else DEFAULT_BUDGET['max_cost']),
+            'max_rows': float(max_rows if max_rows is not None else DEFAULT_BUDGET['max_rows']),
+        }
+        self.budgets = {query_type: dict(budget) for query_type, budget in QUERY_TYPE_BUDGETS.items()}
+        for query_type, budget in (budgets or {}).items():
+            self.budgets.setdefault(query_type, {}).update(budget)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def budget(self, query_type):
+        """查询类型的预算，未单独配置的项使用默认预算"""
+        return {**self.default_budget, **self.budgets.get(query_type, {})}
+
+    def estimate(self, sql, params, connect):
+        """返回 SQL 的代价估算；缓存未命中时通过 connect() 借出连接执行 EXPLAIN"""
+        fingerprint = sql_fingerprint(sql)
+        with self._lock:
+            cached = self._cache.get(fingerprint)
+            if cached is not None:
+                self._cache.move_to_end(fingerprint)
+                self._hits += 1
+                return cached
+            self._misses += 1
+
+        with connect() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+            conn.rollback()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = plan_estimate(plan[0]['Plan'])
+
+        with self._lock:
+            self._cache[fingerprint] = estimate
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return estimate
+
+    def check(self, sql, params, query_type, connect):
+        """估算代价超出查询类型的预算时抛出 QueryTooExpensive，否则返回估算"""
+        estimate = self.estimate(sql, params, connect)
+        budget = self.budget(query_type)
+        if estimate['cost'] > budget['max_cost'] or estimate['rows'] > budget['max_rows']:
+            raise QueryTooExpensive(
+                f"估算代价 {estimate['cost']:.0f}（上限 {budget['max_cost']:.0f}）、"
+                f"估算行数 {estimate['rows']:.0f}（上限 {budget['max_rows']:.0f}），代价最高的步骤是 {estimate['node']}",
+                estimate
+            )
+        return estimate
+
+    def stats(self):
+        with self._lock:
+            return {'cached_plans': len(self._cache), 'hits': self._hits, 'misses': self._misses}
@@ -0,0 +1,74 @@
+"""
+阻塞式数据库连接池
+
+psycopg2 自带的 ThreadedConnectionPool 在连接耗尽时直接抛出 PoolError，
+这里用信号量包装，使调用方排队等待可用连接。
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from psycopg2 import extensions, pool
+
+logger = logging.getLogger(__name__)
+
+
+def env_db_config():
+    """从 DB_* 环境变量读取数据库连接配置（命令行工具使用）"""
+    return {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'port': int(os.getenv('DB_PORT', 5432)),
+        'database': os.getenv('DB_NAME', 'learning_system'),
+        'user': os.getenv('DB_USER', 'postgres'),
+        'password': os.getenv('DB_PASSWORD', 'password')
+    }
+
+
+class PoolTimeout(Exception):
+    """在超时时间内没有拿到可用连接"""
+
+
+class BlockingConnectionPool:
+    def __init__(self, minconn, maxconn, db_config, acquire_timeout=30):
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **db_config)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._in_use = 0
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """借出一个连接，用完后回滚未结束的事务并归还"""
+        if not self._slots.acquire(timeout=timeout or self.acquire_timeout):
+            raise PoolTimeout(f"等待数据库连接超时 ({timeout or self.acquire_timeout}s)")
+
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            with self._lock:
+                self._in_use += 1
+            yield conn
+        finally:
+            if conn is not None:
+                broken = bool(conn.closed)
+                if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except Exception as e:
+                        logger.warning("归还连接时回滚失败，丢弃该连接: %s", e)
+                        broken = True
+                self._pool.putconn(conn, close=broken)
+                with self._lock:
+                    self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        """连接池使用情况"""
+        with self._lock:
+            in_use = self._in_use
+        return {'max': self.maxconn, 'in_use': in_use, 'available': self.maxconn - in_use}
+
+    def closeall(self):
+        self._pool.closeall()
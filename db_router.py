@@ -0,0 +1,226 @@
+"""
+主库 / 只读副本路由
+
+写操作和读己之写的会话走主库；经过校验的只读查询（生成的 SQL、用户校验、健康检查、班级分析）分到只读副本，
+增加副本即可扩展读能力。
+- 后台线程定期检查每个副本：能否连接、是否仍在追主库（比较主库当前 WAL 位置与副本已回放的位置，
+  落后时按最后回放事务的时间估算延迟）。不可达或延迟超过 max_lag_seconds 的副本暂停分配，恢复后自动加入
+- 从健康副本中选借出连接最少的一个；没有可用副本、或借连接时副本连不上，回退到主库
+- 读己之写：record_write 在写入提交后记下主库的 WAL 位置，该用户之后的读请求只分给已回放到该位置的副本，
+  确认不了（独立实例、检查结果尚未更新）时留在主库，最长 read_after_write_seconds
+"""
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import psycopg2
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lsn(text):
+    """把 'X/Y' 形式的 WAL 位置转换为整数，便于比较"""
+    if not text:
+        return None
+    high, low = text.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class _Replica:
+    """一个只读副本的连接池及最近一次检查结果"""
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.reachable = None
+        self.in_recovery = None
+        self.replay_lsn = None
+        self.lag_seconds = None
+        self.error = None
+        self.checked_at = None
+
+    def healthy(self, max_lag_seconds):
+        return bool(self.reachable) and self.lag_seconds is not None and self.lag_seconds <= max_lag_seconds
+
+    def to_dict(self, max_lag_seconds):
+        return {'name': self.name, 'healthy': self.healthy(max_lag_seconds), 'in_recovery': self.in_recovery,
+                'lag_seconds': self.lag_seconds, 'error': self.error, **self.pool.stats()}
+
+
+class DatabaseRouter:
+    """
+    与 BlockingConnectionPool 相同的 connection() / stats() 接口，默认借出主库连接；
+    read_only=True 时按副本状态路由，user_id 用于读己之写的判断
+    """
+
+    def __init__(self, primary, replicas=None, max_lag_seconds=5.0, check_interval=2.0, check_timeout=2.0,
+                 read_after_write_seconds=10.0):
+        self.primary = primary
+        self.replicas = [_Replica(name, pool) for name, pool in (replicas or [])]
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.read_after_write_seconds = read_after_write_seconds
+        # user_id -> (截止时间, 写入时主库的 WAL 位置)
+        self._writes = {}
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if self.replicas:
+            self.check_replicas()
+            self._thread = threading.Thread(target=self._run, name='db-router', daemon=True)
+            self._thread.start()
+
+    # ---- 副本检查 ----
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check_replicas()
+            except Exception as e:
+                logger.error(f"副本状态检查失败: {str(e)}")
+
+    def _primary_lsn(self):
+        try:
+            with self.primary.connection(timeout=self.check_timeout) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_current_wal_lsn()::text")
+                    lsn = parse_lsn(cursor.fetchone()[0])
+                conn.rollback()
+            return lsn
+        except Exception as e:
+            logger.warning(f"读取主库 WAL 位置失败: {str(e)}")
+            return None
+
+    def check_replicas(self):
+        """检查各副本的可达性与复制延迟，并清理过期的写入记录"""
+        now = time.monotonic()
+        with self._lock:
+            for user_id in [user_id for user_id, (expires, _) in self._writes.items() if expires <= now]:
+                del self._writes[user_id]
+        primary_lsn = self._primary_lsn()
+        for replica in self.replicas:
+            was_healthy = replica.healthy(self.max_lag_seconds)
+            first_check = replica.checked_at is None
+            try:
+                with replica.pool.connection(timeout=self.check_timeout) as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            "SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()::text, "
+                            "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+                        )
+                        in_recovery, replay_lsn, replay_age = cursor.fetchone()
+                    conn.rollback()
+            except Exception as e:
+                replica.reachable, replica.error = False, str(e).strip()
+                metrics.incr('db_router.replica_check_failures')
+            else:
+                replica.reachable, replica.error = True, None
+                replica.in_recovery = in_recovery
+                replica.replay_lsn = parse_lsn(replay_lsn)
+                if not in_recovery:
+                    # 不在恢复模式（独立实例或已被提升），没有复制延迟可言
+                    replica.lag_seconds = 0.0
+                elif primary_lsn is not None and replica.replay_lsn is not None \
+                        and replica.replay_lsn >= primary_lsn:
+                    replica.lag_seconds = 0.0
+                else:
+                    replica.lag_seconds = round(float(replay_age), 3) if replay_age is not None else None
+            replica.checked_at = time.time()
+            if replica.lag_seconds is not None:
+                metrics.set_gauge(f'db_router.{replica.name}.lag_seconds', replica.lag_seconds)
+
+            healthy = replica.healthy(self.max_lag_seconds)
+            if was_healthy and not healthy:
+                logger.warning(f"副本 {replica.name} 暂停分配: {replica.error or f'复制延迟 {replica.lag_seconds}s'}")
+            elif healthy and not was_healthy and not first_check:
+                logger.info(f"副本 {replica.name} 恢复分配")
+
+    # ---- 读己之写 ----
+
+    def record_write(self, user_id, conn):
+        """写入提交后调用：记下主库当前的 WAL 位置，该用户随后的读请求等副本追上后再分给副本"""
+        if not self.replicas or not user_id:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_current_wal_lsn()::text")
+                lsn = parse_lsn(cursor.fetchone()[0])
+            conn.rollback()
+        except Exception as e:
+            logger.warning(f"读取写入位置失败，按时间窗口留在主库: {str(e)}")
+            lsn = None
+        with self._lock:
+            self._writes[str(user_id)] = (time.monotonic() + self.read_after_write_seconds, lsn)
+
+    def _pending_write(self, user_id):
+        """返回该用户尚未确认同步的写入位置（没有则为 None，位置未知为 -1）"""
+        if user_id is None:
+            return None
+        with self._lock:
+            entry = self._writes.get(str(user_id))
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._writes[str(user_id)]
+                return None
+        return entry[1] if entry[1] is not None else -1
+
+    # ---- 路由 ----
+
+    def _choose_replica(self, user_id):
+        candidates = [replica for replica in self.replicas if replica.healthy(self.max_lag_seconds)]
+        pending = self._pending_write(user_id) if candidates else None
+        if pending is not None:
+            candidates = [replica for replica in candidates if pending >= 0 and replica.in_recovery
+                          and replica.replay_lsn is not None and replica.replay_lsn >= pending]
+            if not candidates:
+                metrics.incr('db_router.read_after_write_primary')
+                return None
+        if not candidates:
+            return None
+        with self._lock:
+            self._next += 1
+            start = self._next
+        # 借出连接最少的副本；相同时轮流分配
+        ordered = candidates[start % len(candidates):] + candidates[:start % len(candidates)]
+        return min(ordered, key=lambda replica: replica.pool.stats()['in_use'])
+
+    @contextmanager
+    def connection(self, timeout=None, read_only=False, user_id=None):
+        """借出连接：read_only 的请求优先分给副本，其余走主库"""
+        replica = self._choose_replica(user_id) if read_only and self.replicas else None
+        with ExitStack() as stack:
+            conn = None
+            if replica is not None:
+                try:
+                    conn = stack.enter_context(replica.pool.connection(timeout=timeout))
+                    metrics.incr('db_router.replica_reads')
+                except psycopg2.OperationalError as e:
+                    # 副本连不上：立即暂停分配，等下一轮检查恢复
+                    replica.reachable, replica.error = False, str(e).strip()
+                    metrics.incr('db_router.replica_fallbacks')
+                    logger.warning("副本 %s 连接失败，回退到主库: %s", replica.name, replica.error)
+            if conn is None:
+                conn = stack.enter_context(self.primary.connection(timeout=timeout))
+                metrics.incr('db_router.primary_reads' if read_only else 'db_router.primary_writes')
+            yield conn
+
+    def stats(self):
+        """主库连接池使用情况（字段与 BlockingConnectionPool 相同），另附各副本状态"""
+        stats = self.primary.stats()
+        if self.replicas:
+            stats['replicas'] = [replica.to_dict(self.max_lag_seconds) for replica in self.replicas]
+            with self._lock:
+                stats['read_after_write_users'] = len(self._writes)
+        return stats
+
+    def closeall(self):
+        self._stop.set()
+        self.primary.closeall()
+        for replica in self.replicas:
+            replica.pool.closeall()
@@ -0,0 +1,500 @@
+"""
+压测数据生成 - 按随机种子生成全部表（8 张表和 2 个统计视图）的模拟数据，用 COPY 批量写入 PostgreSQL
+
+    python generate_dataset.py load --students 20000 --seed 42 --reset
+
+同样的种子和参数总是生成同样的数据。学生按 STUDENTS_PER_CHUNK 人一块生成，每块的随机数由 (种子, 表, 块号) 派生，
+数据逐块编码为 COPY 文本格式流式发送，内存占用与总量无关。
+- 学号为 入学年份(4) + 班级(4) + 班内序号(4)，可按前缀选班级（与教师分析一致）
+- 每个学生有投入度（活动次数）、勤奋度（实验报告提交率、迟交）、能力（成绩均值）和常用设备，各表数据随之相关
+- 学习活动与资源访问集中在单元上线后的几天内，按一天中各小时的活跃度分布（上午、下午、晚上三个高峰）
+- 学习时长、访问时长为对数正态分布，视频的访问时长明显更长
+--reset 删除并重建全部表：先建不带主键和外键的表，以 COPY ... FREEZE 写入，完成后再一次性添加主键、外键并 ANALYZE
+（逐行维护索引、检查外键会拖慢 COPY）。
+"""
+import argparse
+import io
+import json
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+import rollup_job
+from db_pool import env_db_config
+
+STUDENTS_PER_CHUNK = 2000
+ENROLLMENT_YEARS = [2021, 2022, 2023, 2024]
+
+SCHEMA_SQL = [
+    "CREATE TABLE students (student_id VARCHAR(12), email VARCHAR(50) NOT NULL, "
+    "student_name VARCHAR(50), gender CHAR(1), password VARCHAR(50) DEFAULT '123456')",
+    "CREATE TABLE Intelligent_Supervision (serial_number INT, course_content VARCHAR(50) NOT NULL, "
+    "online_learning_date DATE NOT NULL, report_deadline DATE NOT NULL, unit_number INT NOT NULL, "
+    "unit_test_date DATE NOT NULL)",
+    "CREATE TABLE LabReport (serial_number INT, student_id VARCHAR(12), submitted BOOLEAN DEFAULT false)",
+    "CREATE TABLE StudentGrades (grade_id SERIAL, student_id VARCHAR(12), serial_number INT, "
+    "grade DECIMAL(5,2), submit_date DATE, late_days INT DEFAULT 0, comments TEXT, "
+    "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    "CREATE TABLE LearningActivity (activity_id SERIAL, student_id VARCHAR(12), serial_number INT, "
+    "activity_type VARCHAR(20), activity_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, duration_minutes INT, "
+    "device_type VARCHAR(20), ip_address VARCHAR(15))",
+    "CREATE TABLE Announcements (announcement_id SERIAL, title VARCHAR(100) NOT NULL, "
+    "content TEXT NOT NULL, announcement_type VARCHAR(20), target_students TEXT, "
+    "publish_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expire_date DATE, is_active BOOLEAN DEFAULT TRUE, "
+    "created_by VARCHAR(50) DEFAULT 'system')",
+    "CREATE TABLE TeacherFeedback (feedback_id SERIAL, student_id VARCHAR(12), serial_number INT, "
+    "feedback_type VARCHAR(20), feedback_content TEXT NOT NULL, feedback_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+    "is_read BOOLEAN DEFAULT FALSE, teacher_name VARCHAR(50) DEFAULT '系统教师')",
+    "CREATE TABLE ResourceAccess (access_id SERIAL, student_id VARCHAR(12), serial_number INT, "
+    "resource_type VARCHAR(30), resource_name VARCHAR(100), access_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+    "access_duration_seconds INT)",
+]
+# 主键与外键在 COPY 完成后再添加：一次性建索引、校验比逐行维护快得多
+PRIMARY_KEYS = {
+    'students': 'student_id', 'Intelligent_Supervision': 'serial_number', 'LabReport': 'serial_number, student_id',
+    'StudentGrades': 'grade_id', 'LearningActivity': 'activity_id', 'Announcements': 'announcement_id',
+    'TeacherFeedback': 'feedback_id', 'ResourceAccess': 'access_id',
+}
+TABLES = ['ResourceAccess', 'TeacherFeedback', 'Announcements', 'LearningActivity', 'StudentGrades', 'LabReport',
+          'Intelligent_Supervision', 'students']
+FOREIGN_KEYS = [
+    (table, column, target)
+    for table in ['LabReport', 'StudentGrades', 'LearningActivity', 'TeacherFeedback', 'ResourceAccess']
+    for column, target in [('serial_number', 'Intelligent_Supervision (serial_number)'),
+                           ('student_id', 'students (student_id)')]
+]
+VIEWS_SQL = [
+    "CREATE VIEW StudentProgressView AS SELECT s.student_id, s.student_name, COUNT(lr.serial_number) AS total_reports, "
+    "COUNT(*) FILTER (WHERE lr.submitted) AS submitted_reports, "
+    "ROUND(100.0 * COUNT(*) FILTER (WHERE lr.submitted) / NULLIF(COUNT(lr.serial_number), 0), 1) AS completion_rate, "
+    "(SELECT ROUND(AVG(sg.grade), 2) FROM StudentGrades sg WHERE sg.student_id = s.student_id) AS avg_grade "
+    "FROM students s LEFT JOIN LabReport lr ON lr.student_id = s.student_id GROUP BY s.student_id, s.student_name",
+    "CREATE VIEW CourseCompletionView AS SELECT ins.serial_number, ins.course_content, ins.report_deadline, "
+    "COUNT(lr.student_id) AS total_students, COUNT(*) FILTER (WHERE lr.submitted) AS submitted_count, "
+    "ROUND(100.0 * COUNT(*) FILTER (WHERE lr.submitted) / NULLIF(COUNT(lr.student_id), 0), 1) AS completion_rate "
+    "FROM Intelligent_Supervision ins LEFT JOIN LabReport lr ON lr.serial_number = ins.serial_number "
+    "GROUP BY ins.serial_number, ins.course_content, ins.report_deadline",
+]
+
+SURNAMES = list('王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈')
+GIVEN_CHARS = list('伟芳娜秀英敏静丽强磊军洋勇艳杰娟涛明超秀兰霞平刚桂英华玉萍红娥玲芬燕彬鹏辉宇浩然子轩梓涵一诺欣怡')
+TOPICS = ['数据库概述', '关系模型', 'SQL 基础查询', '多表连接', '子查询', '聚合与分组', '视图与索引', '事务与并发',
+          '存储过程', '触发器', '数据库设计', '范式理论', '查询优化', '备份与恢复', '安全与权限', 'NoSQL 简介',
+          '数据仓库', '分布式数据库', 'Python 数据库编程', '综合实验']
+TEACHERS = ['张老师', '李老师', '王老师', '刘老师', '陈老师', '系统教师']
+
+# 一天中各小时的活跃度（上午、下午、晚上三个高峰，凌晨很少）
+HOUR_WEIGHTS = np.array([2, 1, 0.5, 0.3, 0.3, 0.5, 1, 3, 6, 9, 10, 8, 5, 6, 9, 10, 9, 7, 6, 8, 11, 12, 9, 5],
+                        dtype=float)
+HOUR_WEIGHTS /= HOUR_WEIGHTS.sum()
+ACTIVITY_TYPES = (['view', 'download', 'submit', 'review'], [0.55, 0.2, 0.1, 0.15])
+DEVICES = (['PC', 'Mobile', 'Tablet'], [0.55, 0.35, 0.1])
+# 资源类型：占比、访问时长（秒）对数正态分布的中位数
+RESOURCE_TYPES = {
+    'lecture_video': (0.4, 900, '讲课视频'),
+    'slides': (0.3, 240, '课件'),
+    'example_code': (0.2, 180, '示例代码'),
+    'reference': (0.1, 120, '参考资料'),
+}
+FEEDBACK = {
+    'praise': (0.35, ['实验报告完成得很认真，继续保持', '本单元成绩优秀，思路清晰', '代码规范，注释完整']),
+    'reminder': (0.3, ['请按时提交实验报告', '本单元的测试即将开始，注意复习', '记得查看最新的课程通知']),
+    'warning': (0.15, ['多次迟交实验报告，请注意', '近期学习时长明显不足', '成绩有所下滑，请及时调整']),
+    'suggestion': (0.2, ['建议多练习多表连接查询', '可以看看参考资料中的优化案例', '建议复习事务与并发控制']),
+}
+COMMENTS = ['完成较好', '思路清晰', '需要改进', '格式不规范', '结果正确', '分析不够深入']
+ANNOUNCEMENT_TYPES = (['general', 'deadline', 'exam', 'urgent'], [0.5, 0.25, 0.15, 0.1])
+
+
+def _rng(seed, table, chunk=0):
+    """每张表、每块数据使用各自的随机数序列，生成结果只取决于种子和参数，与各表的生成顺序无关"""
+    return np.random.default_rng([seed, sum(map(ord, table)), chunk])
+
+
+def _copy_text(*columns):
+    """按列拼成 COPY 文本格式（列已经是字符串，None 写成 \\N）"""
+    lists = []
+    for column in columns:
+        values = column.tolist() if isinstance(column, np.ndarray) else list(column)
+        if None in values:
+            values = ['\\N' if value is None else value for value in values]
+        lists.append(values)
+    return ('\n'.join(map('\t'.join, zip(*lists))) + '\n').encode('utf-8')
+
+
+# 数字和一天内时刻的字符串查表，比逐个格式化（astype(str)）快数倍
+_INT_STRINGS = np.array([str(i) for i in range(10000)], dtype=object)
+_GRADE_STRINGS = np.array([f'{i / 100:.2f}' for i in range(10001)], dtype=object)
+_TIME_OF_DAY = np.array([f'T{h:02d}:{m:02d}:{s:02d}' for h in range(24) for m in range(60) for s in range(60)],
+                        dtype=object)
+
+
+def _ints(values):
+    values = np.asarray(values)
+    if len(values) and 0 <= values.min() and values.max() < len(_INT_STRINGS):
+        return _INT_STRINGS[values]
+    return values.astype(str)
+
+
+def _dates(days):
+    """自 1970 年起的天数 -> 'YYYY-MM-DD'"""
+    if not len(days):
+        return np.array([], dtype=object)
+    first = days.min()
+    names = np.arange(first, days.max() + 1).astype('datetime64[D]').astype(str).astype(object)
+    return names[days - first]
+
+
+def _timestamps(seconds):
+    """自 1970 年起的秒数 -> 'YYYY-MM-DDTHH:MM:SS'"""
+    days, time_of_day = np.divmod(seconds, 86400)
+    return _dates(days) + _TIME_OF_DAY[time_of_day]
+
+
+def _day_seconds(day):
+    return (day - date(1970, 1, 1)).days * 86400
+
+
+class _ChunkStream(io.RawIOBase):
+    """把字节块的迭代器包装成 copy_expert 可读取的文件对象"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self._offset >= len(self._buffer):
+            self._buffer, self._offset = next(self._chunks, b''), 0
+        end = len(self._buffer) if size < 0 else self._offset + size
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        return data
+
+
+class DatasetGenerator:
+    def __init__(self, students=20000, units=40, activities_per_student=120, accesses_per_student=60,
+                 feedback_per_student=4, announcements=200, class_size=40, seed=42, today=None):
+        self.students = students
+        self.units = units
+        self.activities_per_student = activities_per_student
+        self.accesses_per_student = accesses_per_student
+        self.feedback_per_student = feedback_per_student
+        self.announcements = announcements
+        self.class_size = class_size
+        self.seed = seed
+        self.today = today or date.today()
+
+        # 学期：每周上线两个单元（理论、实验），上线 10 天后截止；今天大约在学期的 60% 处，已截止和未截止的单元都有
+        weeks = (units + 1) // 2
+        self.semester_start = self.today - timedelta(days=int(weeks * 7 * 0.6))
+        self.online_days = _day_seconds(self.semester_start) // 86400 + np.arange(units) // 2 * 7
+        self.deadline_days = self.online_days + 10
+        self.today_day = _day_seconds(self.today) // 86400
+        self.published = int(np.count_nonzero(self.online_days <= self.today_day))
+
+        # 学生的固有属性：一次性生成，各表的相关性由此而来
+        rng = _rng(seed, 'students')
+        self.engagement = rng.lognormal(0.0, 0.5, students)
+        self.diligence = rng.beta(5, 2, students)
+        self.ability = np.clip(rng.normal(76, 9, students), 40, 98)
+        self.device = rng.choice(len(DEVICES[0]), students, p=DEVICES[1])
+        self.student_ids = np.array([self._student_id(i) for i in range(students)])
+
+    def _student_id(self, index):
+        class_index, seq = divmod(index, self.class_size)
+        year = ENROLLMENT_YEARS[class_index % len(ENROLLMENT_YEARS)]
+        return f"{year}{class_index // len(ENROLLMENT_YEARS) + 1:04d}{seq + 1:04d}"
+
+    def _chunks(self):
+        for chunk, start in enumerate(range(0, self.students, STUDENTS_PER_CHUNK)):
+            yield chunk, np.arange(start, min(start + STUDENTS_PER_CHUNK, self.students))
+
+    # ---- 各表 ----
+
+    def students_rows(self):
+        for chunk, index in self._chunks():
+            rng = _rng(self.seed, 'students', chunk + 1)
+            names = [SURNAMES[s] + ''.join(GIVEN_CHARS[g] for g in given[:length])
+                     for s, given, length in zip(rng.integers(0, len(SURNAMES), len(index)),
+                                                 rng.integers(0, len(GIVEN_CHARS), (len(index), 2)),
+                                                 rng.integers(1, 3, len(index)))]
+            ids = self.student_ids[index]
+            emails = np.char.add(ids, '@stu.example.edu.cn')
+            genders = np.where(rng.random(len(index)) < 0.52, 'M', 'F')
+            yield len(index), _copy_text(ids, emails, names, genders, ['123456'] * len(index))
+
+    def units_rows(self):
+        serial = np.arange(1, self.units + 1)
+        online = self.online_days.astype('datetime64[D]').astype(str)
+        deadline = self.deadline_days.astype('datetime64[D]').astype(str)
+        unit_number = (serial + 1) // 2
+        test_date = (self.online_days + 13).astype('datetime64[D]').astype(str)
+        content = [f"{TOPICS[(n - 1) % len(TOPICS)]}（第{n}单元-{'理论' if s % 2 else '实验'}）"
+                   for s, n in zip(serial, unit_number)]
+        yield self.units, _copy_text(serial.astype(str), content, online, deadline, unit_number.astype(str),
+                                     test_date)
+
+    def _reports(self, rng, index):
+        """每个学生 × 每个单元的提交情况：已截止单元按勤奋度提交，未截止单元只有部分提前提交"""
+        due = self.deadline_days <= self.today_day
+        probability = np.where(due[None, :], self.diligence[index, None],
+                               self.diligence[index, None] * 0.3)
+        return rng.random((len(index), self.units)) < probability
+
+    def lab_report_rows(self):
+        for chunk, index in self._chunks():
+            submitted = self._reports(_rng(self.seed, 'LabReport', chunk), index)
+            units = np.tile(np.arange(1, self.units + 1).astype(str), len(index))
+            ids = np.repeat(self.student_ids[index], self.units)
+            yield submitted.size, _copy_text(units, ids, np.where(submitted.ravel(), 't', 'f'))
+
+    def grade_rows(self):
+        """已提交且已截止的实验报告有成绩；勤奋度低的学生更常迟交"""
+        for chunk, index in self._chunks():
+            submitted = self._reports(_rng(self.seed, 'LabReport', chunk), index)
+            graded = submitted & (self.deadline_days <= self.today_day)[None, :]
+            student, unit = np.nonzero(graded)
+            rng = _rng(self.seed, 'StudentGrades', chunk)
+            count = len(student)
+            late = np.where(rng.random(count) < (1 - self.diligence[index][student]) * 0.5,
+                            rng.geometric(0.4, count), 0)
+            grade = np.clip(rng.normal(self.ability[index][student] - late * 2, 8), 0, 100)
+            submit_day = np.minimum(self.deadline_days[unit] - rng.integers(0, 4, count) * (late == 0) + late,
+                                    self.today_day)
+            # 约一半的成绩没有评语
+            comments = np.where(rng.random(count) < 0.5,
+                                np.array(COMMENTS, dtype=object)[rng.integers(0, len(COMMENTS), count)], None)
+            yield count, _copy_text(self.student_ids[index][student], _ints(unit + 1), _GRADE_STRINGS[np.rint(grade * 100).astype(int)],
+                                    _dates(submit_day), _ints(late), comments)
+
+    def _events(self, rng, index, per_student):
+        """
+        活动事件的学生与时间：次数按投入度泊松分布，单元上线后指数衰减（平均 4 天），小时按活跃度分布。
+        返回 (学生下标, 单元下标, 时间秒数)
+        """
+        counts = rng.poisson(per_student * self.engagement[index])
+        student = np.repeat(np.arange(len(index)), counts)
+        total = len(student)
+        unit = rng.integers(0, max(self.published, 1), total)
+        day = np.minimum(self.online_days[unit] + rng.exponential(4.0, total).astype(int), self.today_day)
+        seconds = (day * 86400 + rng.choice(24, total, p=HOUR_WEIGHTS) * 3600
+                   + rng.integers(0, 3600, total))
+        return student, unit, seconds
+
+    def activity_rows(self):
+        for chunk, index in self._chunks():
+            rng = _rng(self.seed, 'LearningActivity', chunk)
+            student, unit, seconds = self._events(rng, index, self.activities_per_student)
+            count = len(student)
+            activity = np.array(ACTIVITY_TYPES[0])[rng.choice(4, count, p=ACTIVITY_TYPES[1])]
+            duration = np.clip(rng.lognormal(np.log(20), 0.8, count), 1, 240).astype(int)
+            # 75% 的活动使用常用设备
+            device = np.where(rng.random(count) < 0.75, self.device[index][student],
+                              rng.choice(3, count, p=DEVICES[1]))
+            # 电脑在校园网（10.20.x.x），手机和平板在移动网络（172.16.x.x），每个学生地址固定
+            campus = np.array([f"10.20.{(i >> 8) & 255}.{i & 255}" for i in index.tolist()], dtype=object)
+            mobile = np.array([f"172.16.{(i >> 8) & 255}.{i & 255}" for i in index.tolist()], dtype=object)
+            ip = np.where(device == 0, campus[student], mobile[student])
+            yield count, _copy_text(self.student_ids[index][student], _ints(unit + 1), activity,
+                                    _timestamps(seconds), _ints(duration), np.array(DEVICES[0])[device], ip)
+
+    def access_rows(self):
+        names = list(RESOURCE_TYPES)
+        shares = [RESOURCE_TYPES[name][0] for name in names]
+        medians = np.array([RESOURCE_TYPES[name][1] for name in names], dtype=float)
+        labels = [RESOURCE_TYPES[name][2] for name in names]
+        for chunk, index in self._chunks():
+            rng = _rng(self.seed, 'ResourceAccess', chunk)
+            student, unit, seconds = self._events(rng, index, self.accesses_per_student)
+            count = len(student)
+            kind = rng.choice(len(names), count, p=shares)
+            duration = np.clip(rng.lognormal(np.log(medians[kind]), 0.7), 5, 7200).astype(int)
+            resource = [f"{TOPICS[u // 2 % len(TOPICS)]}-{labels[k]}{r}"
+                        for u, k, r in zip(unit.tolist(), kind.tolist(), rng.integers(1, 4, count).tolist())]
+            yield count, _copy_text(self.student_ids[index][student], _ints(unit + 1),
+                                    np.array(names)[kind], resource, _timestamps(seconds), _ints(duration))
+
+    def feedback_rows(self):
+        kinds = list(FEEDBACK)
+        shares = [FEEDBACK[kind][0] for kind in kinds]
+        for chunk, index in self._chunks():
+            rng = _rng(self.seed, 'TeacherFeedback', chunk)
+            counts = rng.poisson(self.feedback_per_student, len(index))
+            student = np.repeat(np.arange(len(index)), counts)
+            count = len(student)
+            # 勤奋度低的学生收到更多提醒和警告
+            kind = np.where(rng.random(count) < 1 - self.diligence[index][student],
+                            rng.choice([1, 2], count), rng.choice(len(kinds), count, p=shares))
+            unit = rng.integers(0, max(self.published, 1), count)
+            seconds = (np.minimum(self.deadline_days[unit] + rng.integers(0, 5, count), self.today_day) * 86400
+                       + rng.integers(8 * 3600, 20 * 3600, count))
+            content = [FEEDBACK[kinds[k]][1][c] for k, c in zip(kind.tolist(), rng.integers(0, 3, count).tolist())]
+            yield count, _copy_text(self.student_ids[index][student], _ints(unit + 1), np.array(kinds)[kind],
+                                    content, _timestamps(seconds), np.where(rng.random(count) < 0.6, 't', 'f'),
+                                    np.array(TEACHERS)[rng.integers(0, len(TEACHERS), count)])
+
+    def announcement_rows(self):
+        rng = _rng(self.seed, 'Announcements')
+        count = self.announcements
+        kind = rng.choice(4, count, p=ANNOUNCEMENT_TYPES[1])
+        publish = (self.today_day - rng.integers(0, max(self.today_day - self.online_days[0], 1), count)) * 86400 \
+            + rng.integers(8 * 3600, 18 * 3600, count)
+        expire = publish // 86400 + rng.integers(3, 30, count)
+        targets = []
+        for _ in range(count):
+            # 大多数公告面向全体，其余指定少数学生
+            if rng.random() < 0.8:
+                targets.append(None)
+            else:
+                chosen = rng.choice(self.students, min(rng.integers(1, 6), self.students), replace=False)
+                targets.append(json.dumps(self.student_ids[chosen].tolist()))
+        zh = {'general': '课程通知', 'deadline': '截止提醒', 'exam': '考试安排', 'urgent': '紧急通知'}
+        titles = [f"{zh[ANNOUNCEMENT_TYPES[0][k]]}（{i + 1}）" for i, k in enumerate(kind.tolist())]
+        content = [f"{title}：请同学们及时查看课程安排" for title in titles]
+        yield count, _copy_text(titles, content, np.array(ANNOUNCEMENT_TYPES[0])[kind], targets, _timestamps(publish),
+                                _dates(expire),
+                                np.where(rng.random(count) < 0.9, 't', 'f'))
+
+    def tables(self):
+        """(表名, COPY 的列, 批次生成函数)，按外键依赖顺序"""
+        return [
+            ('students', 'student_id, email, student_name, gender, password', self.students_rows),
+            ('Intelligent_Supervision',
+             'serial_number, course_content, online_learning_date, report_deadline, unit_number, unit_test_date',
+             self.units_rows),
+            ('LabReport', 'serial_number, student_id, submitted', self.lab_report_rows),
+            ('StudentGrades', 'student_id, serial_number, grade, submit_date, late_days, comments', self.grade_rows),
+            ('LearningActivity',
+             'student_id, serial_number, activity_type, activity_date, duration_minutes, device_type, ip_address',
+             self.activity_rows),
+            ('ResourceAccess',
+             'student_id, serial_number, resource_type, resource_name, access_date, access_duration_seconds',
+             self.access_rows),
+            ('TeacherFeedback',
+             'student_id, serial_number, feedback_type, feedback_content, feedback_date, is_read, teacher_name',
+             self.feedback_rows),
+            ('Announcements',
+             'title, content, announcement_type, target_students, publish_date, expire_date, is_active',
+             self.announcement_rows),
+        ]
+
+
+def reset_schema(conn):
+    """
+    删除并重建全部表（不带主键和外键，学习活动、资源访问也不分区）。
+    由事件表派生的每日汇总表（migrations/V007）清空并把水位归零，写入后执行 rollup_job.py run 重新汇总；
+    预计算的答案（migrations/V008）同样清空
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("DROP VIEW IF EXISTS StudentProgressView, CourseCompletionView")
+        for table in TABLES:
+            cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        for statement in SCHEMA_SQL:
+            cursor.execute(statement)
+        cursor.execute("SELECT to_regclass('rollup_watermark')")
+        has_rollups = cursor.fetchone()[0] is not None
+        # 预计算的答案随源表一起作废（触发器随表删除，由 precompute.py 下一轮补装并全量重算）
+        cursor.execute("SELECT to_regclass('precomputed_answers')")
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("DELETE FROM precomputed_answers")
+            cursor.execute("DELETE FROM precompute_runs")
+    conn.commit()
+    if has_rollups:
+        rollup_job.reset(conn)
+
+
+def finish_schema(conn):
+    """COPY 完成后添加主键和外键、创建统计视图并更新统计信息"""
+    with conn.cursor() as cursor:
+        for table, columns in PRIMARY_KEYS.items():
+            cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY ({columns})")
+        for table, column, target in FOREIGN_KEYS:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table.lower()}_{column}_fkey "
+                           f"FOREIGN KEY ({column}) REFERENCES {target}")
+        for statement in VIEWS_SQL:
+            cursor.execute(statement)
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    conn.autocommit = False
+
+
+def load(conn, generator, freeze=False):
+    """
+    逐表 COPY，返回每张表的行数、耗时与速度。
+    freeze 用于刚重建的空表：在同一事务内 TRUNCATE 后 COPY ... FREEZE，写入的行直接标记为已冻结，
+    省去之后首次读取和 VACUUM 时的改写
+    """
+    report = {}
+    for table, columns, batches in generator.tables():
+        started = time.perf_counter()
+        counter = {'rows': 0}
+
+        def chunks():
+            for rows, data in batches():
+                counter['rows'] += rows
+                yield data
+
+        with conn.cursor() as cursor:
+            if freeze:
+                cursor.execute(f"TRUNCATE {table}")
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN" + (" WITH (FREEZE)" if freeze else ""),
+                               _ChunkStream(chunks()), size=1 << 20)
+        conn.commit()
+        elapsed = time.perf_counter() - started
+        report[table] = {'rows': counter['rows'], 'seconds': round(elapsed, 2),
+                         'rows_per_second': round(counter['rows'] / elapsed) if elapsed else None}
+    return report
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='生成压测数据并用 COPY 写入数据库（连接配置取自 DB_* 环境变量）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load_parser = subparsers.add_parser('load', help='生成并写入全部表')
+    load_parser.add_argument('--students', type=int, default=20000)
+    load_parser.add_argument('--units', type=int, default=40, help='智能督学单元数（每周两个单元）')
+    load_parser.add_argument('--activities', type=float, default=120, help='每个学生的平均学习活动数')
+    load_parser.add_argument('--accesses', type=float, default=60, help='每个学生的平均资源访问数')
+    load_parser.add_argument('--feedback', type=float, default=4, help='每个学生的平均教师反馈数')
+    load_parser.add_argument('--announcements', type=int, default=200)
+    load_parser.add_argument('--class-size', type=int, default=40)
+    load_parser.add_argument('--seed', type=int, default=42)
+    load_parser.add_argument('--today', type=date.fromisoformat, help='数据中的 "今天"（默认当天）')
+    load_parser.add_argument('--reset', action='store_true', help='删除并重建全部表（会清空现有数据）')
+    args = parser.parse_args()
+
+    generator = DatasetGenerator(
+        students=args.students, units=args.units, activities_per_student=args.activities,
+        accesses_per_student=args.accesses, feedback_per_student=args.feedback, announcements=args.announcements,
+        class_size=args.class_size, seed=args.seed, today=args.today
+    )
+    conn = psycopg2.connect(**env_db_config())
+    try:
+        if args.reset:
+            reset_schema(conn)
+        started = time.perf_counter()
+        report = {'tables': load(conn, generator, freeze=args.reset)}
+        report['copy_seconds'] = round(time.perf_counter() - started, 2)
+        if args.reset:
+            finish_started = time.perf_counter()
+            finish_schema(conn)
+            report['constraints_and_analyze_seconds'] = round(time.perf_counter() - finish_started, 2)
+        total_rows = sum(table['rows'] for table in report['tables'].values())
+        report['total_rows'] = total_rows
+        report['rows_per_second'] = round(total_rows / report['copy_seconds']) if report['copy_seconds'] else None
+    finally:
+        conn.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+gunicorn 配置
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+主进程预加载应用和只读数据（preload_app），冻结现有对象后 fork 工作进程；
+每个工作进程在 post_fork 中创建自己的连接池、大模型客户端和线程池。
+
+结果句柄、多轮对话上下文、异步作业和取消登记保存在工作进程的内存中，翻页、追问、作业查询和取消
+必须落到同一个进程，所以默认只启动 1 个工作进程，用线程扩展并发（GUNICORN_THREADS）。
+"""
+import gc
+import logging
+import os
+
+from prefork import budget_shortfall
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+# 请求大部分时间在等待大模型和数据库，每个进程用线程处理并发请求
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+
+# 应用据此分摊连接池等全局额度，并且不在主进程中创建连接池和线程
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['APP_PREFORK'] = '1'
+
+# 未指定单进程连接数时，各进程从 DB_CONNECTION_BUDGET 中至少分到 2 个连接，总数超出预算则拒绝启动
+if not os.getenv('DB_POOL_MAX'):
+    shortfall = budget_shortfall(int(os.getenv('DB_CONNECTION_BUDGET', 10)), workers, 2)
+    if shortfall:
+        raise RuntimeError(f"DB_CONNECTION_BUDGET 不足: {shortfall}，请调大预算或减少 WEB_CONCURRENCY")
+
+
+def when_ready(server):
+    # 预加载的对象移出垃圾回收的扫描范围，避免工作进程中的回收改写共享内存页
+    gc.collect()
+    gc.freeze()
+    if workers > 1:
+        logging.getLogger('gunicorn.error').warning(
+            "WEB_CONCURRENCY=%d：结果句柄、对话上下文、异步作业和取消登记按进程保存，"
+            "翻页、追问、作业查询和取消落到其他进程时会失效", workers)
+
+
+def post_fork(server, worker):
+    import backend
+
+    backend.init_services()
@@ -0,0 +1,174 @@
+"""
+后台健康检查
+
+探活请求（负载均衡、编排系统每秒多次）不再各自新建数据库连接，而是读取后台线程定期检查的结果：
+- 数据库：按只读查询的路由借出连接（有可用副本时检查的是副本）执行 SELECT 1，记录耗时与连接池使用情况
+- 大模型：按较长的间隔请求一次模型列表，记录是否可达与耗时
+每次检查后重新生成状态快照（包括序列化好的响应体），接口直接返回快照，不做任何 I/O。
+连续失败达到阈值才判定为不可用，避免单次抖动导致实例被摘除；快照长时间没有更新（检查线程卡住）同样视为不可用。
+连接池已满时借不到连接说明数据库正在正常服务，只记录为饱和，不算失败（否则高峰期实例会被摘除）。
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from db_pool import PoolTimeout
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Check:
+    """一项检查的最近结果"""
+
+    def __init__(self, name):
+        self.name = name
+        self.ok = None
+        self.latency_ms = None
+        self.error = None
+        self.checked_at = None
+        self.consecutive_failures = 0
+
+    def update(self, ok, latency_ms, error=None):
+        self.ok = ok
+        self.latency_ms = round(latency_ms, 2)
+        self.error = error
+        self.checked_at = datetime.now().isoformat(timespec='seconds')
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+        metrics.set_gauge(f'health.{self.name}_latency_ms', self.latency_ms)
+        if not ok:
+            metrics.incr(f'health.{self.name}_failures')
+
+    def healthy(self, failure_threshold):
+        """尚未检查过的项按健康处理（启动时已经连上数据库）"""
+        return self.ok is not False or self.consecutive_failures < failure_threshold
+
+    def to_dict(self):
+        return {'ok': self.ok, 'latency_ms': self.latency_ms, 'error': self.error, 'checked_at': self.checked_at,
+                'consecutive_failures': self.consecutive_failures}
+
+
+class HealthMonitor:
+    """
+    定期检查数据库连接池和大模型接口，保存最近一次的状态快照。
+    require_llm 为 False 时大模型不可达只影响报告，不影响就绪状态（模板、缓存问题仍可回答）
+    """
+
+    def __init__(self, db_pool, llm_client=None, interval=5, db_timeout=2, llm_interval=60, llm_timeout=5,
+                 failure_threshold=2, require_llm=False):
+        self.db_pool = db_pool
+        self.llm_client = llm_client
+        self.interval = interval
+        self.db_timeout = db_timeout
+        self.llm_interval = llm_interval
+        self.llm_timeout = llm_timeout
+        self.failure_threshold = failure_threshold
+        self.require_llm = require_llm
+        # 超过这个时间没有更新的快照视为过期
+        self.stale_after = max(3 * interval, interval + db_timeout + llm_timeout)
+
+        self._db = _Check('db')
+        self._llm = _Check('llm')
+        self._last_llm_check = None
+        self._started_at = time.time()
+        self._stop = threading.Event()
+        self._snapshot = None
+        self._publish()
+        self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"健康检查失败: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def check(self):
+        """执行一轮检查并更新快照（到期时才检查大模型）"""
+        self._check_db()
+        now = time.monotonic()
+        if self.llm_client is not None and (self._last_llm_check is None
+                                            or now - self._last_llm_check >= self.llm_interval):
+            self._last_llm_check = now
+            self._check_llm()
+        self._publish()
+
+    def _check_db(self):
+        started = time.perf_counter()
+        try:
+            with self.db_pool.connection(timeout=self.db_timeout, read_only=True) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+                conn.rollback()
+        except PoolTimeout:
+            metrics.incr('health.db_pool_saturated')
+            self._db.update(True, (time.perf_counter() - started) * 1000, '连接池已满，本轮未检查')
+            return
+        except Exception as e:
+            self._db.update(False, (time.perf_counter() - started) * 1000, str(e))
+            if self._db.consecutive_failures == self.failure_threshold:
+                logger.warning(f"数据库健康检查连续 {self.failure_threshold} 次失败: {str(e)}")
+            return
+        if self._db.consecutive_failures >= self.failure_threshold:
+            logger.info("数据库健康检查恢复正常")
+        self._db.update(True, (time.perf_counter() - started) * 1000)
+
+    def _check_llm(self):
+        started = time.perf_counter()
+        try:
+            self.llm_client.models.list(timeout=self.llm_timeout)
+        except Exception as e:
+            self._llm.update(False, (time.perf_counter() - started) * 1000, str(e))
+            return
+        self._llm.update(True, (time.perf_counter() - started) * 1000)
+
+    def _publish(self):
+        """生成新的快照，整体替换引用（读取方无需加锁）"""
+        db_ok = self._db.healthy(self.failure_threshold)
+        llm_ok = self._llm.healthy(self.failure_threshold)
+        ready = db_ok and (llm_ok or not self.require_llm)
+        checks = {'database': self._db.to_dict(), 'llm': self._llm.to_dict()}
+        pool = self.db_pool.stats()
+        updated = time.monotonic()
+        timestamp = datetime.now().isoformat()
+
+        ready_body = {'status': 'ready' if ready else 'not_ready', 'timestamp': timestamp, 'checks': checks,
+                      'db_pool': pool}
+        # /health 保持原有字段，另外附上检查详情
+        health_body = {
+            'status': 'healthy' if ready else 'unhealthy',
+            'timestamp': timestamp,
+            'ai_processor_ready': True,
+            'database_status': 'connected' if db_ok else f"disconnected: {self._db.error}",
+            'checks': checks,
+            'db_pool': pool,
+        }
+        self._snapshot = {
+            'ready': ready,
+            'updated': updated,
+            'ready_body': json.dumps(ready_body, ensure_ascii=False),
+            'health_body': json.dumps(health_body, ensure_ascii=False),
+        }
+
+    def status(self):
+        """返回 (是否就绪, /health/ready 响应体, /health 响应体)；快照过期时按不可用处理"""
+        snapshot = self._snapshot
+        if time.monotonic() - snapshot['updated'] > self.stale_after:
+            timestamp = datetime.now().isoformat()
+            ready_body = {'status': 'not_ready', 'timestamp': timestamp, 'error': '健康检查结果已过期'}
+            health_body = {'status': 'unhealthy', 'timestamp': timestamp, 'ai_processor_ready': True,
+                           'database_status': 'unknown: 健康检查结果已过期'}
+            return False, json.dumps(ready_body, ensure_ascii=False), json.dumps(health_body, ensure_ascii=False)
+        return snapshot['ready'], snapshot['ready_body'], snapshot['health_body']
+
+    def stats(self):
+        return {'ready': self._snapshot['ready'], 'database': self._db.to_dict(), 'llm': self._llm.to_dict(),
+                'uptime_seconds': round(time.time() - self._started_at)}
+
+    def stop(self):
+        self._stop.set()
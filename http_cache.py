@@ -0,0 +1,175 @@
+"""
+HTTP 响应的缓存头与压缩
+
+- 压缩：JSON、HTML、MessagePack 响应体不小于 HTTP_COMPRESS_MIN_SIZE（默认 1024）字节时，
+  按 Accept-Encoding 用 brotli（需安装 brotli）或 gzip 压缩，并加上 Vary: Accept-Encoding；
+  流式响应（如导出）和已压缩的响应不处理
+- Cache-Control：按路由（Flask endpoint）设置，见 CACHE_POLICIES，未列出的接口为 no-store
+- ETag：静态和变化慢的 GET 接口按响应体的哈希加强校验 ETag，If-None-Match 一致时返回 304、不带响应体。
+  同一内容的不同编码是不同的字节，ETag 带上编码后缀（"<哈希>-br"），比较时忽略后缀
+- 固定响应（前端页面、建议问题表）用 PrecomputedResponse 在启动时序列化、计算 ETag 并按各编码压缩一次，
+  请求时只协商编码、比较 ETag
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+from flask import Response, request
+
+from metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只用 gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript',
+                          'application/x-msgpack'}
+COMPRESS_MIN_SIZE = int(os.getenv('HTTP_COMPRESS_MIN_SIZE', 1024))
+# 每个请求现场压缩用较快的级别，启动时预先压缩的固定响应用最高级别
+GZIP_LEVEL = int(os.getenv('HTTP_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('HTTP_BROTLI_QUALITY', 4))
+
+# endpoint -> (Cache-Control, 是否加 ETag)
+CACHE_POLICIES = {
+    # 前端页面每次都向服务端确认，未变化时 304
+    'frontend': ('no-cache', True),
+    # 建议问题表随版本发布才变化
+    'get_suggestions': ('public, max-age=3600', True),
+    # 班级分析按 TEACHER_ANALYTICS_REFRESH 定期刷新，只允许浏览器缓存，每次确认
+    'get_teacher_analytics': ('private, no-cache', True),
+}
+DEFAULT_POLICY = ('no-store', False)
+
+
+def cache_control(endpoint):
+    return CACHE_POLICIES.get(endpoint, DEFAULT_POLICY)[0]
+
+
+def accepted_encoding():
+    """客户端接受的压缩编码，优先 brotli，都不接受时返回 None"""
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def encode(body, encoding, precomputed=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if precomputed else BROTLI_QUALITY)
+    # mtime=0：同样的内容压缩出同样的字节
+    return gzip.compress(body, compresslevel=9 if precomputed else GZIP_LEVEL, mtime=0)
+
+
+def strong_etag(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def etag_matches(etag):
+    """If-None-Match 中是否有与 etag（不带引号和编码后缀）相同的值"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for value in header.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value.strip('"').split('-', 1)[0] == etag:
+            return True
+    return False
+
+
+def _etag_header(etag, encoding):
+    return f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+
+
+def not_modified(etag, cache_control, encoding=None, vary=True):
+    """304 响应：ETag 与同样协商结果下 200 响应的 ETag（含编码后缀）一致"""
+    metrics.incr('http.not_modified')
+    response = Response(status=304)
+    response.headers['ETag'] = _etag_header(etag, encoding)
+    response.headers['Cache-Control'] = cache_control
+    if vary:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+class PrecomputedResponse:
+    """启动时序列化一次的固定响应：ETag 与各编码的压缩结果都预先算好"""
+
+    def __init__(self, body, mimetype, cache_control):
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.etag = strong_etag(body)
+        self.variants = {None: body}
+        if len(body) >= COMPRESS_MIN_SIZE:
+            for encoding in (['br', 'gzip'] if brotli else ['gzip']):
+                self.variants[encoding] = encode(body, encoding, precomputed=True)
+
+    @classmethod
+    def json(cls, payload, cache_control):
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return cls(body, 'application/json', cache_control)
+
+    @classmethod
+    def file(cls, path, mimetype, cache_control):
+        with open(path, 'rb') as f:
+            return cls(f.read(), mimetype, cache_control)
+
+    def respond(self):
+        encoding = accepted_encoding() if len(self.variants) > 1 else None
+        if etag_matches(self.etag):
+            return not_modified(self.etag, self.cache_control, encoding, vary=len(self.variants) > 1)
+        response = Response(self.variants[encoding], mimetype=self.mimetype)
+        response.headers['ETag'] = _etag_header(self.etag, encoding)
+        response.headers['Cache-Control'] = self.cache_control
+        if len(self.variants) > 1:
+            response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+            metrics.incr(f'http.compressed.{encoding}')
+        return response
+
+
+def finalize_response(response):
+    """after_request：按路由加 Cache-Control 和 ETag（条件请求返回 304），再按需压缩"""
+    cache_control, use_etag = CACHE_POLICIES.get(request.endpoint, DEFAULT_POLICY)
+    response.headers.setdefault('Cache-Control', cache_control)
+    if response.is_streamed or response.direct_passthrough or 'ETag' in response.headers:
+        # 流式响应（导出自行压缩）、文件和 PrecomputedResponse 不再处理响应体
+        return response
+    if 'Content-Encoding' in response.headers or response.status_code in (204, 304) or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    body = response.get_data()
+    compress = len(body) >= COMPRESS_MIN_SIZE
+    if compress:
+        response.vary.add('Accept-Encoding')
+
+    encoding = accepted_encoding() if compress else None
+    etag = None
+    if use_etag and request.method in ('GET', 'HEAD') and response.status_code == 200:
+        etag = strong_etag(body)
+        if etag_matches(etag):
+            return not_modified(etag, response.headers['Cache-Control'], encoding, vary=compress)
+        response.headers['ETag'] = _etag_header(etag, None)
+
+    if encoding:
+        encoded = encode(body, encoding)
+        response.set_data(encoded)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.headers['ETag'] = _etag_header(etag, encoding)
+        metrics.incr(f'http.compressed.{encoding}')
+        metrics.incr('http.bytes_saved', len(body) - len(encoded))
+    return response
+
+
+def install(app):
+    app.after_request(finalize_response)
+    logger.info(f"响应压缩: {'br, gzip' if brotli else 'gzip'} (不小于 {COMPRESS_MIN_SIZE} 字节)")
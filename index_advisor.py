@@ -0,0 +1,446 @@
+"""
+索引建议 - 根据生成 SQL 的实际负载推荐二级索引，生成版本化的迁移脚本并测量效果
+
+负载来自查询遥测中记录的规范化 SQL（按出现次数加权），也可以追加一个 SQL 文件或 SQL_TEMPLATES。
+对每条语句解析 FROM / JOIN 的别名，提取每张表上的：
+- 等值过滤列（与参数、字面量比较，或 IN 列表）
+- 连接列（两张表的列相等）
+- 范围过滤列（<、>、BETWEEN）和排序列（仅在有 LIMIT 时有用）
+每条语句、每张表得到一个候选索引：等值过滤列在前，随后是一个范围列（没有范围列时依次取带 LIMIT 的排序列、连接列）；
+只有连接列的表按连接列单独建索引。布尔列区分度太低，不参与。
+候选按 "命中查询数 × 表的估算行数"（顺序扫描可省去的行数）排序；
+被其他候选或已有索引的前缀覆盖的候选合并掉，同一张表上前导列相同的候选只保留收益最高的一个，其余作为备选列出。
+
+    python index_advisor.py analyze --telemetry telemetry --templates
+    python index_advisor.py migrations --telemetry telemetry --out migrations
+    python index_advisor.py measure --telemetry telemetry --user-id 000000000001
+
+measure 在一个事务内先 EXPLAIN ANALYZE 负载中的语句，再建好全部候选索引（非 CONCURRENTLY）重新测量，最后回滚，
+不改动数据库。生成的 SQL 中参数几乎都是学号，测量时统一替换为 --user-id。
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db_pool import env_db_config
+from sql_analyzer import normalize_sql, referenced_tables
+from telemetry import SEGMENT_PATTERN, load_table
+
+MAX_INDEX_COLUMNS = 3
+MIGRATION_PATTERN = re.compile(r'^V(\d+)__.*\.sql$')
+
+_LITERAL = re.compile(r"'(?:''|[^'])*'")
+# CASE WHEN 中的比较是取值表达式，不是过滤条件
+_CASE = re.compile(r'\bcase\b.*?\bend\b')
+_IDENTIFIER = r'"?[a-z_][\w$]*"?'
+_TABLE_ALIAS = re.compile(
+    rf'(?<!distinct )\b(?:from|join)\s+((?:{_IDENTIFIER}\.)?{_IDENTIFIER})(?:\s+(?:as\s+)?([a-z_]\w*))?'
+)
+_COLUMN = r'(?<![\w.$"])(?:([a-z_]\w*)\.)?([a-z_]\w*)\b'
+_VALUE = r'(?:%s|\$lit|-?\d+(?:\.\d+)?|true|false)(?![\w.(])'
+_EQUALS_VALUE = re.compile(rf'{_COLUMN}\s*=\s*{_VALUE}')
+_VALUE_EQUALS = re.compile(rf'(?<![<>!]){_VALUE}\s*=\s*{_COLUMN}(?!\s*[(.])')
+_IN_LIST = re.compile(rf'{_COLUMN}\s+in\s*\(')
+_JOIN = re.compile(rf'{_COLUMN}\s*=\s*(?:([a-z_]\w*)\.)([a-z_]\w*)\b(?!\s*\()')
+_RANGE = re.compile(rf'{_COLUMN}\s*(?:<=|>=|<|>|\s+between\s)')
+_ORDER_BY = re.compile(r'\border by\s+(.+?)(?=\blimit\b|\boffset\b|\)|$)')
+_LIMIT = re.compile(r'\blimit\b')
+
+# 表名后面紧跟的关键字不是别名
+_NOT_ALIASES = {
+    'where', 'on', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'join', 'natural', 'lateral', 'using',
+    'group', 'order', 'limit', 'offset', 'having', 'window', 'union', 'except', 'intersect', 'fetch', 'for'
+}
+
+
+def _bare(name):
+    """去掉模式名和引号"""
+    return name.split('.')[-1].replace('"', '')
+
+
+class Schema:
+    """public 模式下各表的列、列类型、估算行数和已有索引（只取普通列上的非部分索引）"""
+
+    def __init__(self, columns, row_estimates, indexes):
+        self.columns = columns
+        self.row_estimates = row_estimates
+        self.indexes = indexes
+
+    @classmethod
+    def load(cls, conn):
+        columns = defaultdict(dict)
+        row_estimates = {}
+        indexes = defaultdict(list)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT lower(table_name), lower(column_name), data_type FROM information_schema.columns "
+                "WHERE table_schema = 'public'"
+            )
+            for table, column, data_type in cursor.fetchall():
+                columns[table][column] = data_type
+            cursor.execute(
+                "SELECT lower(c.relname), c.reltuples FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p')"
+            )
+            row_estimates = {table: max(float(rows), 0.0) for table, rows in cursor.fetchall()}
+            cursor.execute(
+                "SELECT lower(t.relname), i.relname, array_agg(lower(a.attname) ORDER BY k.ordinality) "
+                "FROM pg_index x "
+                "JOIN pg_class t ON t.oid = x.indrelid JOIN pg_class i ON i.oid = x.indexrelid "
+                "JOIN pg_namespace n ON n.oid = t.relnamespace "
+                "CROSS JOIN LATERAL unnest(x.indkey::int2[]) WITH ORDINALITY AS k(attnum, ordinality) "
+                "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum "
+                "WHERE n.nspname = 'public' AND x.indpred IS NULL AND x.indexprs IS NULL "
+                "GROUP BY t.relname, i.relname"
+            )
+            for table, name, index_columns in cursor.fetchall():
+                indexes[table].append((name, tuple(index_columns)))
+        conn.rollback()
+        return cls(dict(columns), row_estimates, dict(indexes))
+
+    def has_column(self, table, column):
+        return column in self.columns.get(table, {})
+
+    def is_boolean(self, table, column):
+        return self.columns.get(table, {}).get(column) == 'boolean'
+
+
+class _Usage:
+    """一条语句对一张表的列使用情况（按出现顺序）"""
+
+    def __init__(self):
+        self.filters = []
+        self.joins = []
+        self.ranges = []
+        self.orders = []
+
+    @staticmethod
+    def _add(columns, column):
+        if column not in columns:
+            columns.append(column)
+
+
+def extract_usage(sql, schema):
+    """
+    解析一条 SQL，返回 ({表名: _Usage}, 是否有 LIMIT)。
+    带限定名的列按别名解析；不带限定名的列只在语句引用的表中恰好一张有该列时才归属该表，
+    WITH 子句定义的结果集和无法解析的别名被忽略。
+    """
+    code = _CASE.sub('$expr', _LITERAL.sub('$lit', normalize_sql(sql)))
+    tables = [table for table in referenced_tables(code) if table in schema.columns]
+    aliases = {table: table for table in tables}
+    for name, alias in _TABLE_ALIAS.findall(code):
+        table = _bare(name)
+        if table in schema.columns:
+            aliases[table] = table
+            if alias and alias not in _NOT_ALIASES:
+                aliases[alias] = table
+
+    def resolve(qualifier, column):
+        if qualifier:
+            table = aliases.get(qualifier)
+            return (table, column) if table and schema.has_column(table, column) else None
+        owners = [table for table in tables if schema.has_column(table, column)]
+        return (owners[0], column) if len(owners) == 1 else None
+
+    usage = defaultdict(_Usage)
+
+    def record(kind, qualifier, column):
+        resolved = resolve(qualifier, column)
+        if resolved and not schema.is_boolean(*resolved):
+            _Usage._add(getattr(usage[resolved[0]], kind), resolved[1])
+
+    joined = set()
+    for left_alias, left_column, right_alias, right_column in _JOIN.findall(code):
+        left, right = resolve(left_alias, left_column), resolve(right_alias, right_column)
+        if left and right and left[0] != right[0]:
+            joined.update({left, right})
+            record('joins', left_alias, left_column)
+            record('joins', right_alias, right_column)
+    for pattern in (_EQUALS_VALUE, _VALUE_EQUALS, _IN_LIST):
+        for qualifier, column in pattern.findall(code):
+            record('filters', qualifier, column)
+    for qualifier, column in _RANGE.findall(code):
+        if resolve(qualifier, column) not in joined:
+            record('ranges', qualifier, column)
+    for clause in _ORDER_BY.findall(code):
+        for item in clause.split(','):
+            match = re.fullmatch(rf'\s*{_COLUMN}(?:\s+(?:asc|desc))?(?:\s+nulls\s+(?:first|last))?\s*', item)
+            if match:
+                record('orders', *match.groups())
+    return dict(usage), bool(_LIMIT.search(code))
+
+
+def candidate_keys(usage, has_limit):
+    """
+    一张表的候选索引，返回 [(列, 前导等值列数)]：等值过滤列在前，再接一个范围列 / 带 LIMIT 的排序列 / 连接列
+    （连接列也是等值条件）
+    """
+    if usage.filters:
+        key = list(usage.filters[:MAX_INDEX_COLUMNS - 1])
+        equal = len(key)
+        for tail, is_equal in ((usage.ranges, False), (usage.orders if has_limit else [], False),
+                               (usage.joins, True)):
+            extra = [column for column in tail if column not in key]
+            if extra:
+                key.append(extra[0])
+                equal += is_equal
+                break
+        return [(tuple(key), equal)]
+    if usage.joins:
+        return [((column,), 1) for column in usage.joins]
+    if usage.ranges:
+        return [((usage.ranges[0],), 0)]
+    return []
+
+
+def covers(index_columns, key, equal):
+    """已有（或更宽的）索引能否代替候选：前导等值列是同一组列（顺序无关），其后的列依次相同"""
+    index_columns = tuple(index_columns)
+    return (len(index_columns) >= len(key) and set(index_columns[:equal]) == set(key[:equal])
+            and index_columns[equal:len(key)] == key[equal:])
+
+
+def index_name(table, key):
+    return f"idx_{table}_{'_'.join(key)}"[:63]
+
+
+def advise(workload, schema, min_rows=1000):
+    """
+    workload 为 {SQL: 出现次数}。返回按收益排序的建议（recommended）、
+    已有索引可以覆盖的候选（covered）、被同表更优候选取代的备选（alternatives），
+    以及估算行数不足 min_rows 的小表上的候选（small_tables，顺序扫描已经足够快）
+    """
+    candidates = {}
+    for sql, hits in workload.items():
+        usages, has_limit = extract_usage(sql, schema)
+        for table, usage in usages.items():
+            for key, equal in candidate_keys(usage, has_limit):
+                candidate = candidates.setdefault((table, key, equal), {
+                    'table': table, 'columns': list(key), 'equality_columns': equal, 'hits': 0,
+                    'statements': Counter()
+                })
+                candidate['hits'] += hits
+                candidate['statements'][sql] += hits
+
+    def score(candidate):
+        return candidate['hits'] * max(schema.row_estimates.get(candidate['table'], 0.0), 1.0)
+
+    ordered = sorted(candidates.values(), key=lambda c: (-score(c), -len(c['columns']), c['table'], c['columns']))
+    recommended, covered, alternatives, small_tables = [], [], [], []
+    for candidate in ordered:
+        if schema.row_estimates.get(candidate['table'], 0.0) < min_rows:
+            small_tables.append(candidate)
+            continue
+        key, equal = tuple(candidate['columns']), candidate['equality_columns']
+        existing = [name for name, columns in schema.indexes.get(candidate['table'], [])
+                    if covers(columns, key, equal)]
+        if existing:
+            covered.append({**candidate, 'covered_by': existing[0]})
+            continue
+        wider = [kept for kept in recommended if kept['table'] == candidate['table']
+                 and covers(kept['columns'], key, equal)]
+        if wider:
+            wider[0]['hits'] += candidate['hits']
+            wider[0]['statements'].update(candidate['statements'])
+            continue
+        same_leading = [kept for kept in recommended if kept['table'] == candidate['table']
+                        and kept['columns'][0] == key[0]]
+        if same_leading:
+            alternatives.append({**candidate, 'instead_of': index_name(candidate['table'], same_leading[0]['columns'])})
+            continue
+        recommended.append(candidate)
+
+    total = sum(workload.values()) or 1
+    recommended.sort(key=lambda c: -score(c))
+
+    def describe(candidate):
+        entry = {key: value for key, value in candidate.items() if key != 'statements'}
+        entry['name'] = index_name(candidate['table'], candidate['columns'])
+        entry['share'] = round(candidate['hits'] / total, 4)
+        entry['estimated_rows'] = int(schema.row_estimates.get(candidate['table'], 0))
+        entry['example'] = candidate['statements'].most_common(1)[0][0]
+        return entry
+
+    return {
+        'statements': len(workload),
+        'queries': sum(workload.values()),
+        'recommended': [dict(describe(candidate), rank=rank) for rank, candidate in enumerate(recommended, 1)],
+        'covered': [describe(candidate) for candidate in covered],
+        'alternatives': [describe(candidate) for candidate in alternatives],
+        'small_tables': [describe(candidate) for candidate in small_tables],
+    }
+
+
+def load_workload(telemetry_dir=None, sql_file=None, templates=False, since=None):
+    """汇总负载：遥测中的规范化 SQL（按次数）、SQL 文件中以分号分隔的语句、SQL_TEMPLATES（各计一次）"""
+    workload = Counter()
+    if telemetry_dir:
+        paths = sorted(glob.glob(os.path.join(telemetry_dir, SEGMENT_PATTERN)))
+        if paths:
+            table = load_table(paths, since)
+            for code, count in enumerate(table.counts('sql')):
+                sql = table.values['sql'][code]
+                if sql and count:
+                    workload[sql] += int(count)
+    if sql_file:
+        with open(sql_file, encoding='utf-8') as f:
+            for statement in f.read().split(';'):
+                if statement.strip():
+                    workload[normalize_sql(statement)] += 1
+    if templates:
+        from ai_sql_generator import SQL_TEMPLATES
+        for template in SQL_TEMPLATES.values():
+            workload[normalize_sql(template['sql'])] += 1
+    return workload
+
+
+def write_migrations(report, directory):
+    """
+    每条建议写成一个 Flyway 风格的迁移脚本 V<版本>__add_index_<表>_<列>.sql，版本号接在目录中已有脚本之后；
+    目录中已经有同名索引的脚本时跳过。CREATE INDEX CONCURRENTLY 不能在事务中执行，迁移工具需按非事务方式运行
+    """
+    os.makedirs(directory, exist_ok=True)
+    existing = sorted(name for name in os.listdir(directory) if MIGRATION_PATTERN.match(name))
+    version = max((int(MIGRATION_PATTERN.match(name).group(1)) for name in existing), default=0)
+    created = []
+    for entry in report['recommended']:
+        if any(name.endswith(f"__add_index_{entry['name'][4:]}.sql") for name in existing):
+            continue
+        version += 1
+        path = os.path.join(directory, f"V{version:03d}__add_index_{entry['name'][4:]}.sql")
+        columns = ', '.join(entry['columns'])
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(
+                f"-- 由 index_advisor.py 生成（{datetime.now():%Y-%m-%d}），收益排名 {entry['rank']}\n"
+                f"-- 命中 {entry['hits']} 次查询（占 {entry['share']:.1%}），表估算行数 {entry['estimated_rows']}\n"
+                f"-- 示例: {entry['example'][:200]}\n"
+                f"-- CONCURRENTLY 建索引不锁写入，但不能在事务中执行\n"
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {entry['name']} ON {entry['table']} ({columns});\n"
+                f"ANALYZE {entry['table']};\n"
+            )
+        created.append(path)
+    return created
+
+
+def _explain(cursor, sql, user_id, repeat):
+    """EXPLAIN ANALYZE 执行 repeat 次，取最短执行时间及对应的计划摘要"""
+    params = [user_id] * sql.count('%s') or None
+    best = None
+    for _ in range(repeat):
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        if best is None or plan[0]['Execution Time'] < best[0]['Execution Time']:
+            best = plan
+    nodes, stack = [], [best[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get('Plans', ()))
+    return {
+        'execution_ms': round(best[0]['Execution Time'], 3),
+        'total_cost': best[0]['Plan']['Total Cost'],
+        'shared_blocks': sum(node.get('Shared Hit Blocks', 0) + node.get('Shared Read Blocks', 0)
+                             for node in nodes if 'Plans' not in node),
+        'seq_scans': sorted({node['Relation Name'] for node in nodes if node['Node Type'] == 'Seq Scan'}),
+        'indexes': sorted({node['Index Name'] for node in nodes if 'Index Name' in node}),
+    }
+
+
+def _try_explain(cursor, sql, user_id, repeat):
+    """单条语句出错（如参数个数不符）时回滚到保存点，不影响整个测量事务"""
+    cursor.execute("SAVEPOINT explain_statement")
+    try:
+        result = _explain(cursor, sql, user_id, repeat)
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT explain_statement")
+        return {'error': str(e).strip()}
+    cursor.execute("RELEASE SAVEPOINT explain_statement")
+    return result
+
+
+def measure(report, workload, conn, user_id, top=20, repeat=3, statement_timeout_ms=30000):
+    """
+    在同一事务内测量负载中最常见的 top 条语句建索引前后的 EXPLAIN ANALYZE，结束时回滚（索引不会保留）
+    """
+    tables = {entry['table'] for entry in report['recommended']}
+    statements = [sql for sql, _ in workload.most_common()
+                  if tables & set(referenced_tables(sql))][:top]
+    results = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+            before = [_try_explain(cursor, sql, user_id, repeat) for sql in statements]
+            started = time.perf_counter()
+            for entry in report['recommended']:
+                cursor.execute(f"CREATE INDEX {entry['name']} ON {entry['table']} ({', '.join(entry['columns'])})")
+            for table in sorted(tables):
+                cursor.execute(f"ANALYZE {table}")
+            build_seconds = time.perf_counter() - started
+            after = [_try_explain(cursor, sql, user_id, repeat) for sql in statements]
+    finally:
+        conn.rollback()
+
+    weighted_before = weighted_after = 0.0
+    for sql, old, new in zip(statements, before, after):
+        entry = {'sql': sql[:200], 'hits': workload[sql], 'before': old, 'after': new}
+        if 'error' not in old and 'error' not in new:
+            entry['speedup'] = round(old['execution_ms'] / max(new['execution_ms'], 0.001), 2)
+            weighted_before += workload[sql] * old['execution_ms']
+            weighted_after += workload[sql] * new['execution_ms']
+        results.append(entry)
+    return {
+        'indexes': [entry['name'] for entry in report['recommended']],
+        'build_seconds': round(build_seconds, 2),
+        'weighted_ms_before': round(weighted_before, 2),
+        'weighted_ms_after': round(weighted_after, 2),
+        'statements': results,
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='根据生成 SQL 的负载推荐索引')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    analyze_parser = subparsers.add_parser('analyze', help='按收益排序的索引建议')
+    migrations_parser = subparsers.add_parser('migrations', help='把建议写成版本化的迁移脚本')
+    migrations_parser.add_argument('--out', default='migrations')
+    measure_parser = subparsers.add_parser('measure', help='建索引前后的 EXPLAIN ANALYZE 对比（事务内执行后回滚）')
+    measure_parser.add_argument('--user-id', required=True, help='替换 SQL 中 %%s 参数的学号')
+    measure_parser.add_argument('--top', type=int, default=20, help='测量最常见的语句数')
+    measure_parser.add_argument('--repeat', type=int, default=3)
+    for sub in (analyze_parser, migrations_parser, measure_parser):
+        sub.add_argument('--telemetry', default=os.getenv('TELEMETRY_DIR', 'telemetry'), help='遥测目录')
+        sub.add_argument('--since', type=float, help='只统计该时间戳之后的遥测记录')
+        sub.add_argument('--sql-file', help='额外的 SQL 语句文件（分号分隔）')
+        sub.add_argument('--templates', action='store_true', help='把 SQL_TEMPLATES 计入负载')
+        sub.add_argument('--min-rows', type=int, default=1000, help='估算行数低于该值的表不建议建索引')
+    args = parser.parse_args()
+
+    workload = load_workload(args.telemetry, args.sql_file, args.templates, args.since)
+    conn = psycopg2.connect(**env_db_config())
+    try:
+        report = advise(workload, Schema.load(conn), args.min_rows)
+        if args.command == 'migrations':
+            output = {'created': write_migrations(report, args.out), 'recommended': report['recommended']}
+        elif args.command == 'measure':
+            output = measure(report, workload, conn, args.user_id, args.top, args.repeat)
+        else:
+            output = report
+    finally:
+        conn.close()
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
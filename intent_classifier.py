@@ -0,0 +1,273 @@
+"""
+基于字符 n-gram 的意图分类器（多项式朴素贝叶斯）
+
+离线使用运行时记录的 (问题, 大模型给出的 query_type) 训练，模型以 NumPy 数组保存为 .npz，
+加载只需几毫秒。朴素贝叶斯的原始概率普遍过于自信，训练时在留出集上拟合温度参数进行校准，
+校准后的概率可以直接作为"能否跳过大模型"的判断依据。
+
+用法:
+    python intent_classifier.py train --data intent_labels.jsonl --out models/intent_nb.npz
+    python intent_classifier.py evaluate --data intent_labels.jsonl --model models/intent_nb.npz
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from text_features import hashed_counts, normalize_question
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FEATURES = 1 << 14
+NGRAM_RANGE = (1, 3)
+# 温度搜索范围（对数均匀）
+TEMPERATURES = np.exp(np.linspace(np.log(0.25), np.log(50), 80))
+
+# 已加载的模型（按路径），多进程部署时在 fork 前加载一次，各工作进程共享
+_loaded_models = {}
+
+
+def _softmax(scores):
+    scores = scores - scores.max(axis=-1, keepdims=True)
+    exp = np.exp(scores)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class IntentClassifier:
+    def __init__(self, labels, log_prior, log_likelihood, temperature=1.0, ngram_range=NGRAM_RANGE):
+        self.labels = list(labels)
+        self.log_prior = log_prior
+        # 类别 × 特征 的对数条件概率
+        self.log_likelihood = log_likelihood
+        self.temperature = float(temperature)
+        self.ngram_range = tuple(ngram_range)
+
+    @property
+    def n_features(self):
+        return self.log_likelihood.shape[1]
+
+    @classmethod
+    def fit(cls, questions, labels, n_features=DEFAULT_FEATURES, alpha=0.1, ngram_range=NGRAM_RANGE):
+        """训练朴素贝叶斯模型（温度为 1，需再调用 calibrate）"""
+        classes = sorted(set(labels))
+        class_index = {label: index for index, label in enumerate(classes)}
+        counts = np.zeros((len(classes), n_features), dtype=np.float64)
+        class_counts = np.zeros(len(classes), dtype=np.float64)
+        for question, label in zip(questions, labels):
+            indices, values = hashed_counts(question, n_features, ngram_range)
+            counts[class_index[label], indices] += values
+            class_counts[class_index[label]] += 1
+
+        smoothed = counts + alpha
+        log_likelihood = np.log(smoothed / smoothed.sum(axis=1, keepdims=True)).astype(np.float32)
+        log_prior = np.log(class_counts / class_counts.sum())
+        return cls(classes, log_prior, log_likelihood, 1.0, ngram_range)
+
+    def scores(self, question):
+        """未校准的各类别对数后验（差一个常数）"""
+        indices, values = hashed_counts(question, self.n_features, self.ngram_range)
+        return self.log_prior + self.log_likelihood[:, indices] @ values
+
+    def predict_proba(self, question):
+        """返回 {query_type: 校准后的概率}"""
+        probabilities = _softmax(self.scores(question) / self.temperature)
+        return dict(zip(self.labels, probabilities.tolist()))
+
+    def predict(self, question):
+        """返回 (最可能的 query_type, 校准后的概率)"""
+        probabilities = _softmax(self.scores(question) / self.temperature)
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    def calibrate(self, questions, labels):
+        """在留出集上搜索使负对数似然最小的温度"""
+        known = [(q, l) for q, l in zip(questions, labels) if l in self.labels]
+        if not known:
+            return self.temperature
+        scores = np.array([self.scores(q) for q, _ in known])
+        targets = np.array([self.labels.index(l) for _, l in known])
+        best_nll, best_temperature = None, self.temperature
+        for temperature in TEMPERATURES:
+            probabilities = _softmax(scores / temperature)
+            nll = -np.log(np.maximum(probabilities[np.arange(len(targets)), targets], 1e-12)).mean()
+            if best_nll is None or nll < best_nll:
+                best_nll, best_temperature = nll, float(temperature)
+        self.temperature = best_temperature
+        return best_temperature
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez_compressed(
+            path,
+            labels=np.array(self.labels),
+            log_prior=self.log_prior,
+            log_likelihood=self.log_likelihood,
+            temperature=np.array(self.temperature),
+            ngram_range=np.array(self.ngram_range)
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                [str(label) for label in data['labels']],
+                data['log_prior'],
+                data['log_likelihood'],
+                float(data['temperature']),
+                tuple(int(n) for n in data['ngram_range'])
+            )
+
+
+def load_intent_classifier(path):
+    """加载模型文件（同一路径只加载一次），不存在或无法加载时返回 None（此时不跳过大模型）"""
+    if path in _loaded_models:
+        return _loaded_models[path]
+    if not path or not os.path.exists(path):
+        logger.info(f"未找到意图分类模型: {path}")
+        return None
+    try:
+        classifier = IntentClassifier.load(path)
+        logger.info(f"意图分类模型已加载: {path} ({len(classifier.labels)} 个类别)")
+    except Exception as e:
+        logger.warning(f"意图分类模型加载失败: {str(e)}")
+        return None
+    _loaded_models[path] = classifier
+    return classifier
+
+
+class LabelLog:
+    """把 (问题, 大模型选择的 query_type) 追加到 JSONL 文件，作为分类器的训练数据"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, question, query_type):
+        line = json.dumps({
+            'question': question,
+            'query_type': query_type,
+            'logged_at': datetime.now().isoformat(timespec='seconds')
+        }, ensure_ascii=False)
+        try:
+            with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            logger.warning("记录意图标签失败: %s", e)
+
+
+def load_pairs(path):
+    """读取 JSONL 标注数据，返回 (问题列表, 标签列表)，同一问题只保留最后一次的标签"""
+    latest = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            question, label = record.get('question'), record.get('query_type')
+            if question and label:
+                latest[normalize_question(question)] = (question, label)
+    pairs = list(latest.values())
+    return [q for q, _ in pairs], [l for _, l in pairs]
+
+
+def _is_holdout(question, folds=5):
+    """按问题哈希稳定地划分留出集"""
+    return zlib.crc32(normalize_question(question).encode('utf-8')) % folds == 0
+
+
+def train(questions, labels, n_features=DEFAULT_FEATURES, alpha=0.1, threshold=0.97):
+    """
+    先在 80% 数据上训练、在留出的 20% 上拟合温度并评估，再用全部数据重新训练并沿用该温度。
+    返回 (模型, 留出集评估结果)
+    """
+    train_idx = [i for i, q in enumerate(questions) if not _is_holdout(q)]
+    holdout_idx = [i for i, q in enumerate(questions) if _is_holdout(q)]
+    temperature, report = 1.0, None
+    if train_idx and holdout_idx:
+        holdout_questions = [questions[i] for i in holdout_idx]
+        holdout_labels = [labels[i] for i in holdout_idx]
+        model = IntentClassifier.fit([questions[i] for i in train_idx], [labels[i] for i in train_idx],
+                                     n_features, alpha)
+        temperature = model.calibrate(holdout_questions, holdout_labels)
+        report = evaluate(model, holdout_questions, holdout_labels, threshold)
+
+    model = IntentClassifier.fit(questions, labels, n_features, alpha)
+    model.temperature = temperature
+    return model, report
+
+
+def evaluate(model, questions, labels, threshold=0.97, bins=10):
+    """
+    与大模型标签对比：整体准确率、各类别准确率、期望校准误差（ECE），
+    以及在跳过阈值下可跳过的比例和这部分的准确率
+    """
+    predictions = [model.predict(q) for q in questions]
+    predicted = np.array([p for p, _ in predictions])
+    confidence = np.array([c for _, c in predictions])
+    correct = predicted == np.array(labels)
+
+    bin_index = np.minimum((confidence * bins).astype(int), bins - 1)
+    ece = 0.0
+    for b in range(bins):
+        mask = bin_index == b
+        if mask.any():
+            ece += mask.mean() * abs(correct[mask].mean() - confidence[mask].mean())
+
+    skipped = confidence >= threshold
+    per_class = {}
+    for label in sorted(set(labels)):
+        mask = np.array(labels) == label
+        per_class[label] = {'count': int(mask.sum()), 'accuracy': round(float(correct[mask].mean()), 4)}
+
+    return {
+        'count': len(questions),
+        'accuracy': round(float(correct.mean()), 4) if len(questions) else None,
+        'ece': round(float(ece), 4),
+        'temperature': model.temperature,
+        'threshold': threshold,
+        'skip_rate': round(float(skipped.mean()), 4) if len(questions) else None,
+        'skip_accuracy': round(float(correct[skipped].mean()), 4) if skipped.any() else None,
+        'per_class': per_class
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='意图分类器的训练与评估')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='从标注日志训练模型')
+    train_parser.add_argument('--data', required=True, help='JSONL 标注数据 (question, query_type)')
+    train_parser.add_argument('--out', default='models/intent_nb.npz')
+    train_parser.add_argument('--features', type=int, default=DEFAULT_FEATURES)
+    train_parser.add_argument('--alpha', type=float, default=0.1)
+    train_parser.add_argument('--threshold', type=float, default=0.97)
+
+    eval_parser = subparsers.add_parser('evaluate', help='评估模型与大模型标签的一致程度')
+    eval_parser.add_argument('--data', required=True)
+    eval_parser.add_argument('--model', default='models/intent_nb.npz')
+    eval_parser.add_argument('--threshold', type=float, default=0.97)
+
+    args = parser.parse_args()
+    questions, labels = load_pairs(args.data)
+    if args.command == 'train':
+        model, report = train(questions, labels, args.features, args.alpha, args.threshold)
+        model.save(args.out)
+        print(f"已训练 {len(questions)} 条样本、{len(model.labels)} 个类别，温度 {model.temperature:.3f}，保存到 {args.out}")
+        if report:
+            print("留出集评估:")
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        model = IntentClassifier.load(args.model)
+        print(json.dumps(evaluate(model, questions, labels, args.threshold), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+长耗时问题的异步作业
+
+/api/query 携带 async=true 时只返回作业ID，问题在有界的后台线程池中处理，
+结果保存在内存中供分页拉取，完成后超过保留时间自动过期。
+运行超过 max_run_seconds 的作业被取消并标记为 timed_out，同样在保留时间后过期，
+即使处理线程卡住不响应取消，作业记录也不会一直留在内存中。
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import CancelToken, QueryCancelled
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """排队中的作业已达上限"""
+
+
+class JobManager:
+    def __init__(self, max_workers=2, max_pending=50, ttl_seconds=900, max_run_seconds=300):
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self.max_run_seconds = max_run_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, user_id, func):
+        """
+        提交作业，func(cancel_token) 返回作业结果。
+        排队和运行中的作业数达到上限时抛出 JobQueueFull。
+        """
+        with self._lock:
+            self._purge_expired()
+            active = sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+            if active >= self.max_pending:
+                metrics.incr('jobs.rejected')
+                raise JobQueueFull(f"排队中的作业已达上限 ({self.max_pending})")
+
+            job_id = uuid.uuid4().hex
+            job = {
+                'job_id': job_id,
+                'user_id': user_id,
+                'status': 'queued',
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'expires_at': None,
+                'result': None,
+                'error': None,
+                'cancel_token': CancelToken(job_id, user_id)
+            }
+            self._jobs[job_id] = job
+
+        metrics.incr('jobs.submitted')
+        self._executor.submit(contextvars.copy_context().run, self._run, job, func)
+        return job_id
+
+    def get(self, job_id, user_id):
+        """返回作业记录，不存在、已过期或不属于该用户时返回 None"""
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            if job is None or job['user_id'] != user_id:
+                return None
+            return dict(job)
+
+    def cancel(self, job_id, user_id):
+        """取消作业，排队中的作业不会再执行"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['user_id'] != user_id:
+                return False
+            if job['status'] == 'queued':
+                self._finish(job, 'cancelled')
+        job['cancel_token'].cancel()
+        return True
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+    def _run(self, job, func):
+        with self._lock:
+            if job['status'] != 'queued':
+                return
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            job['cancel_token'].deadline = time.monotonic() + self.max_run_seconds
+        metrics.observe('jobs.queue_wait_ms', (job['started_at'] - job['created_at']) * 1000)
+
+        try:
+            result = func(job['cancel_token'])
+            status, error = 'succeeded', None
+        except QueryCancelled:
+            result, status, error = None, 'cancelled', None
+        except Exception as e:
+            logger.error("异步作业失败 %s: %s", job['job_id'], e)
+            result, status, error = None, 'failed', str(e)
+
+        with self._lock:
+            if job['status'] != 'running':
+                # 已超时，结果不再保留
+                return
+            job['result'] = result
+            job['error'] = error
+            self._finish(job, status)
+        metrics.incr(f'jobs.{status}')
+        metrics.observe('jobs.run_ms', (job['finished_at'] - job['started_at']) * 1000)
+
+    def _finish(self, job, status):
+        job['status'] = status
+        job['finished_at'] = time.time()
+        job['expires_at'] = job['finished_at'] + self.ttl_seconds
+
+    def _purge_expired(self):
+        now = time.time()
+        for job in self._jobs.values():
+            if job['status'] == 'running' and now - job['started_at'] > self.max_run_seconds:
+                logger.warning("异步作业运行超时，已取消: %s", job['job_id'])
+                job['cancel_token'].cancel()
+                job['error'] = f"运行超过 {self.max_run_seconds} 秒"
+                self._finish(job, 'timed_out')
+                metrics.incr('jobs.timed_out')
+        expired = [job_id for job_id, job in self._jobs.items() if job['expires_at'] and job['expires_at'] < now]
+        for job_id in expired:
+            del self._jobs[job_id]
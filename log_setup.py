@@ -0,0 +1,193 @@
+"""
+统一的日志配置
+
+- 所有模块的日志经 QueueHandler 放入内存队列，由后台线程（QueueListener）格式化并写文件和控制台，
+  请求线程不做文件 I/O，也不做消息格式化（日志参数在后台线程中才拼接）
+- 每条日志输出为一行 JSON，带上当前请求的 request_id
+- INFO 及以下级别的请求日志按 request_id 采样（同一请求的日志要么全部保留、要么全部丢弃），
+  采样在入队前完成；WARNING 及以上、以及不属于任何请求的日志全部保留
+
+环境变量: LOG_LEVEL (默认 INFO)、LOG_FILE (默认 backend.log，设为空字符串只输出到控制台)、
+LOG_FORMAT (json / text，默认 json)、LOG_INFO_SAMPLE_RATE (0~1，默认 1)
+
+    python log_setup.py bench    # 比较请求线程上每条日志的耗时（同步写文件 / 队列 / 队列+采样）
+"""
+import argparse
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+# 当前请求的 ID，由 Web 层在请求开始时设置，跨线程执行时随 contextvars 复制
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+# LogRecord 的标准属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+_lock = threading.Lock()
+_queue_handler = None
+_listener = None
+_output_handlers = []
+
+
+class JsonFormatter(logging.Formatter):
+    """一条记录一行 JSON：时间、级别、logger、消息、request_id 以及 extra 字段"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _RequestQueueHandler(logging.handlers.QueueHandler):
+    """在调用线程上只记录 request_id 并按请求采样，不格式化消息"""
+
+    def __init__(self, log_queue, sample_rate=1.0):
+        super().__init__(log_queue)
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        if self.sample_rate < 1 and record.levelno < logging.WARNING and record.request_id:
+            bucket = zlib.crc32(str(record.request_id).encode('utf-8')) % 10000
+            if bucket >= self.sample_rate * 10000:
+                return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        # 队列在进程内，记录原样入队，由监听线程格式化（默认实现会在调用线程上格式化）
+        return record
+
+
+def _start_listener():
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_output_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # fork 出的子进程里没有监听线程，需要重新创建队列和监听线程
+    if _queue_handler is not None:
+        _start_listener()
+
+
+def configure_logging():
+    """配置根 logger，重复调用无效果"""
+    global _queue_handler
+    with _lock:
+        if _queue_handler is not None:
+            return
+
+        level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+        formatter = JsonFormatter() if os.getenv('LOG_FORMAT', 'json') == 'json' else logging.Formatter(TEXT_FORMAT)
+        log_file = os.getenv('LOG_FILE', 'backend.log')
+        _output_handlers.append(logging.StreamHandler())
+        if log_file:
+            _output_handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+        for handler in _output_handlers:
+            handler.setFormatter(formatter)
+
+        _queue_handler = _RequestQueueHandler(None, float(os.getenv('LOG_INFO_SAMPLE_RATE', 1)))
+        _start_listener()
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_queue_handler)
+
+        atexit.register(shutdown_logging)
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def shutdown_logging():
+    """写出队列中剩余的日志"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def _time_logging(handler, count, requests):
+    """用给定的 handler 记录 count 条请求日志，返回调用线程上平均每条的耗时（微秒）"""
+    bench_logger = logging.getLogger('log_setup.bench')
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+    bench_logger.handlers = [handler]
+    per_request = max(1, count // requests)
+    started = time.perf_counter()
+    for i in range(count):
+        if i % per_request == 0:
+            request_id_var.set(uuid.uuid4().hex)
+        bench_logger.info("查询成功: %d条结果", i, extra={'user_id': '202100000001', 'question': '我这学期的成绩'})
+    elapsed = time.perf_counter() - started
+    bench_logger.handlers = []
+    request_id_var.set(None)
+    return elapsed / count * 1e6
+
+
+def bench(count=20000, requests=2000, sample_rate=0.1):
+    """比较三种方式在请求线程上的日志开销，队列方式另外给出后台线程上每条记录的写出耗时"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sync_handler = logging.FileHandler(os.path.join(directory, 'sync.log'), encoding='utf-8')
+        sync_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        sync_handler.addFilter(lambda record: setattr(record, 'request_id', request_id_var.get()) or True)
+        results['sync_file_text'] = _time_logging(sync_handler, count, requests)
+        sync_handler.close()
+
+        for name, rate in (('queue_json', 1.0), (f'queue_json_sampled_{sample_rate:g}', sample_rate)):
+            file_handler = logging.FileHandler(os.path.join(directory, f'{name}.log'), encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter())
+            log_queue = queue.SimpleQueue()
+            # 先只入队、再启动监听线程写出：分别得到请求线程和后台线程上的耗时
+            # （单核机器上两者同时运行会互相争抢 GIL，混在一起测不出请求线程的开销）
+            results[name] = _time_logging(_RequestQueueHandler(log_queue, rate), count, requests)
+            pending = log_queue.qsize()
+            listener = logging.handlers.QueueListener(log_queue, file_handler)
+            started = time.perf_counter()
+            listener.start()
+            listener.stop()
+            results[f'{name}_background'] = (time.perf_counter() - started) / max(1, pending) * 1e6
+            file_handler.close()
+    return {name: round(value, 2) for name, value in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='日志开销测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='比较请求线程上每条日志的耗时（微秒）')
+    bench_parser.add_argument('--count', type=int, default=20000)
+    bench_parser.add_argument('--requests', type=int, default=2000, help='模拟的请求数（每个请求一个 request_id）')
+    bench_parser.add_argument('--sample-rate', type=float, default=0.1)
+    args = parser.parse_args()
+
+    print(json.dumps(bench(args.count, args.requests, args.sample_rate), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
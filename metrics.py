@@ -0,0 +1,66 @@
+"""
+进程内运行指标 - 计数器、瞬时值和延迟分布
+"""
+import threading
+from collections import defaultdict, deque
+
+
+class Metrics:
+    """线程安全的指标注册表，供 /api/metrics 导出"""
+
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = defaultdict(lambda: deque(maxlen=self._window))
+
+    def incr(self, name, value=1):
+        """累加计数器"""
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name, value):
+        """设置瞬时值（如队列深度）"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        """记录一次观测值（通常是毫秒延迟），只保留最近 window 个样本"""
+        with self._lock:
+            self._timings[name].append(value)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def ratio(self, numerator, denominator):
+        """计算两个计数器的比值，分母为 0 时返回 None"""
+        with self._lock:
+            total = self._counters.get(denominator, 0)
+            return self._counters.get(numerator, 0) / total if total else None
+
+    def snapshot(self):
+        """导出当前所有指标"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            samples = {name: sorted(values) for name, values in self._timings.items() if values}
+
+        timings = {}
+        for name, values in samples.items():
+            count = len(values)
+            timings[name] = {
+                'count': count,
+                'avg': round(sum(values) / count, 3),
+                'p50': values[int(count * 0.50)],
+                'p95': values[min(count - 1, int(count * 0.95))],
+                'p99': values[min(count - 1, int(count * 0.99))],
+                'max': values[-1]
+            }
+
+        return {'counters': counters, 'gauges': gauges, 'timings': timings}
+
+
+# 进程级默认注册表
+metrics = Metrics()
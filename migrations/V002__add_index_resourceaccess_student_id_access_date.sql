@@ -0,0 +1,6 @@
+-- 由 index_advisor.py 生成（2026-10-19），收益排名 2
+-- 命中 2 次查询（占 14.3%），表估算行数 1000000
+-- 示例: select ra.resource_name,ra.access_date from resourceaccess ra where ra.student_id=%s order by ra.access_date desc limit 20
+-- CONCURRENTLY 建索引不锁写入，但不能在事务中执行
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_resourceaccess_student_id_access_date ON resourceaccess (student_id, access_date);
+ANALYZE resourceaccess;
@@ -0,0 +1,6 @@
+-- 由 index_advisor.py 生成（2026-10-19），收益排名 4
+-- 命中 2 次查询（占 14.3%），表估算行数 800000
+-- 示例: select ins.course_content,sg.grade,sg.submit_date,sg.late_days,sg.comments,case when sg.grade>=90 then '优秀' when sg.grade>=80 then '良好' when sg.grade>=70 then '中等' when sg.grade>=60 then '及格' else '不及
+-- CONCURRENTLY 建索引不锁写入，但不能在事务中执行
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_studentgrades_student_id_serial_number ON studentgrades (student_id, serial_number);
+ANALYZE studentgrades;
@@ -0,0 +1,6 @@
+-- 由 index_advisor.py 生成（2026-10-19），收益排名 5
+-- 命中 2 次查询（占 14.3%），表估算行数 300000
+-- 示例: select tf.feedback_content,tf.feedback_date from teacherfeedback tf where tf.student_id=%s and tf.feedback_date>=current_date - 30 order by tf.feedback_date desc
+-- CONCURRENTLY 建索引不锁写入，但不能在事务中执行
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_teacherfeedback_student_id_feedback_date ON teacherfeedback (student_id, feedback_date);
+ANALYZE teacherfeedback;
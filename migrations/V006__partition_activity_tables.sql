@@ -0,0 +1,91 @@
+-- 学习活动、资源访问按月范围分区：按时间过滤的查询只扫描相关月份，过期月份可整块删除或归档
+-- 分区键必须包含在主键中，主键改为 (ID, 时间)；ID 仍由原序列生成，增量汇总按 ID 推进水位
+-- 已有数据最多按月建 24 个分区，更早的行和时间超出范围的行进入 DEFAULT 分区；
+-- 之后的月份由 rollup_job.py 每轮提前创建
+
+ALTER TABLE LearningActivity RENAME TO learningactivity_unpartitioned;
+ALTER INDEX IF EXISTS idx_learningactivity_student_id_activity_date RENAME TO idx_learningactivity_unpartitioned;
+
+CREATE TABLE LearningActivity (
+    activity_id INT NOT NULL DEFAULT nextval('learningactivity_activity_id_seq'),
+    student_id VARCHAR(12) REFERENCES students (student_id),
+    serial_number INT REFERENCES Intelligent_Supervision (serial_number),
+    activity_type VARCHAR(20),
+    activity_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    duration_minutes INT,
+    device_type VARCHAR(20),
+    ip_address VARCHAR(15),
+    PRIMARY KEY (activity_id, activity_date)
+) PARTITION BY RANGE (activity_date);
+-- 序列改为属于新表，删除旧表时不会连带删除
+ALTER SEQUENCE learningactivity_activity_id_seq OWNED BY LearningActivity.activity_id;
+
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            GREATEST(date_trunc('month', COALESCE(MIN(activity_date), now())), date_trunc('month', now()) - interval '23 months'),
+            date_trunc('month', now()) + interval '2 months',
+            interval '1 month'
+        )::date
+        FROM learningactivity_unpartitioned
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF LearningActivity FOR VALUES FROM (%L) TO (%L)',
+                       'learningactivity_' || to_char(month, 'YYYYMM'), month, (month + interval '1 month')::date);
+    END LOOP;
+END $$;
+CREATE TABLE learningactivity_default PARTITION OF LearningActivity DEFAULT;
+
+INSERT INTO LearningActivity (activity_id, student_id, serial_number, activity_type, activity_date, duration_minutes,
+                              device_type, ip_address)
+SELECT activity_id, student_id, serial_number, activity_type, activity_date, duration_minutes, device_type, ip_address
+FROM learningactivity_unpartitioned;
+DROP TABLE learningactivity_unpartitioned;
+
+CREATE INDEX idx_learningactivity_student_id_activity_date ON LearningActivity (student_id, activity_date);
+ANALYZE LearningActivity;
+
+
+ALTER TABLE ResourceAccess RENAME TO resourceaccess_unpartitioned;
+ALTER INDEX IF EXISTS idx_resourceaccess_student_id_access_date RENAME TO idx_resourceaccess_unpartitioned;
+
+CREATE TABLE ResourceAccess (
+    access_id INT NOT NULL DEFAULT nextval('resourceaccess_access_id_seq'),
+    student_id VARCHAR(12) REFERENCES students (student_id),
+    serial_number INT REFERENCES Intelligent_Supervision (serial_number),
+    resource_type VARCHAR(30),
+    resource_name VARCHAR(100),
+    access_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    access_duration_seconds INT,
+    PRIMARY KEY (access_id, access_date)
+) PARTITION BY RANGE (access_date);
+ALTER SEQUENCE resourceaccess_access_id_seq OWNED BY ResourceAccess.access_id;
+
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            GREATEST(date_trunc('month', COALESCE(MIN(access_date), now())), date_trunc('month', now()) - interval '23 months'),
+            date_trunc('month', now()) + interval '2 months',
+            interval '1 month'
+        )::date
+        FROM resourceaccess_unpartitioned
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF ResourceAccess FOR VALUES FROM (%L) TO (%L)',
+                       'resourceaccess_' || to_char(month, 'YYYYMM'), month, (month + interval '1 month')::date);
+    END LOOP;
+END $$;
+CREATE TABLE resourceaccess_default PARTITION OF ResourceAccess DEFAULT;
+
+INSERT INTO ResourceAccess (access_id, student_id, serial_number, resource_type, resource_name, access_date,
+                            access_duration_seconds)
+SELECT access_id, student_id, serial_number, resource_type, resource_name, access_date, access_duration_seconds
+FROM resourceaccess_unpartitioned;
+DROP TABLE resourceaccess_unpartitioned;
+
+CREATE INDEX idx_resourceaccess_student_id_access_date ON ResourceAccess (student_id, access_date);
+ANALYZE ResourceAccess;
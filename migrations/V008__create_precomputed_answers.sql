@@ -0,0 +1,29 @@
+-- 热门问题的预计算答案（precompute.py 写入，/api/query 按 (学生, 查询类型) 直接读取）
+-- 不随学生变化的答案（如单元测试安排）以 student_id = '*' 存一份
+
+CREATE TABLE precomputed_answers (
+    student_id VARCHAR(12) NOT NULL,
+    query_type VARCHAR(30) NOT NULL,
+    answer TEXT NOT NULL,
+    columns JSONB NOT NULL,
+    rows JSONB NOT NULL,
+    computed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (student_id, query_type)
+);
+
+-- 源表变更记录：由 precompute.py 安装的触发器写入，student_id 为空表示影响全部学生。
+-- 有未处理变更的答案不再读取，下一轮刷新后删除对应记录
+CREATE TABLE answer_changes (
+    change_id BIGSERIAL PRIMARY KEY,
+    student_id VARCHAR(12),
+    query_type VARCHAR(30) NOT NULL,
+    changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_answer_changes_query_type_student_id ON answer_changes (query_type, student_id);
+
+-- 每天第一轮全量刷新后记录日期（答案中的逾期状态、公告有效期等随日期变化）
+CREATE TABLE precompute_runs (
+    run_date DATE PRIMARY KEY,
+    students INT NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
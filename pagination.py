@@ -0,0 +1,211 @@
+"""
+查询结果的键集分页
+
+每条生成的 SQL 在首次执行后登记为一个结果句柄（SQL、参数、输出列、排序键），
+后续页通过 /api/query/page 重新执行缓存的 SQL，并附加键集谓词：
+
+    SELECT * FROM (<原SQL>) AS _page WHERE (排序键) 在上一页最后一行之后 ORDER BY ... LIMIT n
+
+翻页只访问数据库，不再调用大模型。排序键来自 SQL 分析得到的 ORDER BY 列，
+其余输出列依次作为决胜列，保证顺序确定。ORDER BY 无法映射到输出列
+（如按 CASE 表达式排序）或输出列名重复时退化为 OFFSET 分页。
+"""
+import base64
+import binascii
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, time as dtime, timedelta
+from decimal import Decimal
+
+from sql_analyzer import order_by_positions, parse_select
+
+
+class InvalidCursor(Exception):
+    """分页游标无法解析"""
+
+
+def build_page_plan(sql):
+    """
+    生成分页计划：
+    {'order': [(位置, 是否降序, NULL 是否排前)], 'column_count': 输出列数}，
+    order 为 None 表示只能按原 SQL 的顺序做 OFFSET 分页
+    """
+    positions = order_by_positions(sql)
+    if positions is None:
+        return {'order': None, 'column_count': None}
+    return {'order': positions, 'column_count': len(parse_select(sql)['items'])}
+
+
+def _complete_order(plan, column_count):
+    """在 ORDER BY 列之后追加其余输出列作为决胜列"""
+    order = list(plan['order'])
+    used = {position for position, _, _ in order}
+    order.extend((position, False, False) for position in range(1, column_count + 1) if position not in used)
+    return order
+
+
+def _order_clause(order):
+    return ', '.join(
+        f"{position} {'DESC' if descending else 'ASC'} NULLS {'FIRST' if nulls_first else 'LAST'}"
+        for position, descending, nulls_first in order
+    )
+
+
+def first_page_sql(sql, plan, page_size):
+    """首页 SQL 与追加参数（多取一行用于判断是否还有下一页）"""
+    if plan['order'] is None:
+        return f"SELECT * FROM ({sql}) AS _page LIMIT %s", [page_size + 1]
+    order = _complete_order(plan, plan['column_count'])
+    return f"SELECT * FROM ({sql}) AS _page ORDER BY {_order_clause(order)} LIMIT %s", [page_size + 1]
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _after_predicate(column, value, descending, nulls_first):
+    """单列"位于 value 之后"的条件"""
+    if value is None:
+        return (f"{column} IS NOT NULL", []) if nulls_first else ("FALSE", [])
+    condition = f"{column} {'<' if descending else '>'} %s"
+    if not nulls_first:
+        condition = f"({condition} OR {column} IS NULL)"
+    return condition, [value]
+
+
+def _equal_predicate(column, value):
+    if value is None:
+        return f"{column} IS NULL", []
+    return f"{column} = %s", [value]
+
+
+def next_page_sql(sql, plan, columns, cursor, page_size):
+    """
+    根据游标生成下一页 SQL 与追加参数。
+    键集模式：(k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...，按各列方向与 NULL 顺序展开
+    """
+    if cursor.get('mode') == 'offset':
+        if plan['order'] is None:
+            return f"SELECT * FROM ({sql}) AS _page LIMIT %s OFFSET %s", [page_size + 1, cursor['offset']]
+        order = _complete_order(plan, len(columns))
+        return (f"SELECT * FROM ({sql}) AS _page ORDER BY {_order_clause(order)} LIMIT %s OFFSET %s",
+                [page_size + 1, cursor['offset']])
+
+    order = _complete_order(plan, len(columns))
+    values = cursor['values']
+    if len(values) != len(order):
+        raise InvalidCursor("游标与结果列不匹配")
+
+    disjuncts, params = [], []
+    for index, (position, descending, nulls_first) in enumerate(order):
+        terms, term_params = [], []
+        for prev_index, (prev_position, _, _) in enumerate(order[:index]):
+            condition, condition_params = _equal_predicate(
+                f"_page.{_quote(columns[prev_position - 1])}", values[prev_index]
+            )
+            terms.append(condition)
+            term_params.extend(condition_params)
+        condition, condition_params = _after_predicate(
+            f"_page.{_quote(columns[position - 1])}", values[index], descending, nulls_first
+        )
+        terms.append(condition)
+        term_params.extend(condition_params)
+        disjuncts.append('(' + ' AND '.join(terms) + ')')
+        params.extend(term_params)
+
+    statement = (f"SELECT * FROM ({sql}) AS _page WHERE {' OR '.join(disjuncts)} "
+                 f"ORDER BY {_order_clause(order)} LIMIT %s")
+    return statement, params + [page_size + 1]
+
+
+def keyset_available(plan, columns):
+    """键集谓词需要按列名引用，输出列名重复时只能用 OFFSET"""
+    return plan['order'] is not None and len(set(columns)) == len(columns)
+
+
+def _json_value(value):
+    """
+    把排序键的值编码为 JSON 值，作为下一页键集谓词的参数（字符串由 PostgreSQL 按列类型解析）。
+    无法表示的类型抛出 TypeError，由 make_cursor 改用 OFFSET 游标
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (datetime, date, dtime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, timedelta):
+        # interval 字面量，保留微秒
+        return f"{value.days} days {value.seconds}.{value.microseconds:06d} seconds"
+    raise TypeError(f"无法编码为游标的值类型: {type(value).__name__}")
+
+
+def make_cursor(plan, columns, last_row, next_offset):
+    """根据当前页最后一行生成下一页游标"""
+    payload = {'mode': 'offset'}
+    if keyset_available(plan, columns):
+        order = _complete_order(plan, len(columns))
+        try:
+            payload = {'mode': 'keyset', 'values': [_json_value(last_row[position - 1]) for position, _, _ in order]}
+        except TypeError:
+            pass
+    payload['offset'] = next_offset
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def parse_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise InvalidCursor("无效的分页游标")
+    if payload.get('mode') not in ('keyset', 'offset') or not isinstance(payload.get('offset'), int):
+        raise InvalidCursor("无效的分页游标")
+    if payload['mode'] == 'keyset' and not isinstance(payload.get('values'), list):
+        raise InvalidCursor("无效的分页游标")
+    return payload
+
+
+class ResultHandleStore:
+    """结果句柄缓存：LRU 淘汰，超过 ttl_seconds 未访问即过期"""
+
+    def __init__(self, max_handles=10000, ttl_seconds=1800):
+        self.max_handles = max_handles
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()
+
+    def create(self, user_id, query_type, sql, params, plan, columns):
+        handle_id = uuid.uuid4().hex
+        with self._lock:
+            self._handles[handle_id] = {
+                'user_id': user_id,
+                'query_type': query_type,
+                'sql': sql,
+                'params': list(params or []),
+                'plan': plan,
+                'columns': columns,
+                'touched_at': time.monotonic()
+            }
+            while len(self._handles) > self.max_handles:
+                self._handles.popitem(last=False)
+        return handle_id
+
+    def get(self, handle_id, user_id):
+        """返回句柄，不存在、已过期或不属于该用户时返回 None"""
+        with self._lock:
+            handle = self._handles.get(handle_id)
+            if handle is None:
+                return None
+            if time.monotonic() - handle['touched_at'] > self.ttl_seconds:
+                del self._handles[handle_id]
+                return None
+            if handle['user_id'] != user_id:
+                return None
+            handle['touched_at'] = time.monotonic()
+            self._handles.move_to_end(handle_id)
+            return handle
@@ -0,0 +1,394 @@
+"""
+热门问题的答案预计算
+
+大部分请求集中在少数几个问题上（未交的实验报告、成绩、单元测试安排、公告），每次都要走完整的查询流程。
+后台线程定期为活跃学生预先算好这些模板问题的答案，存入 precomputed_answers（migrations/V008），
+/api/query 遇到对应的模板问题时按 (学生, 查询类型) 一次主键查询直接返回：
+- 集合查询：每种查询类型一条 SQL 一次算出一批学生的结果（与 SQL_TEMPLATES 中的模板列相同，多出的第一列为学号），
+  按学生分组后用同样的格式化函数渲染答案，与行、列类型一起写入
+- 增量刷新：LabReport、StudentGrades、Intelligent_Supervision、Announcements 上的语句级触发器把受影响的
+  (学生, 查询类型) 写入 answer_changes（影响全部学生时学号为空）。有未处理变更的答案不会被读取；
+  每轮只重算变更涉及、且已在答案表中的学生，提交后删除本轮读到的变更记录
+- 全量刷新：每天第一轮为最近 active_days 天有学习活动的学生（LearningActivityDaily，汇总表过期时读 LearningActivity）全部重算，
+  并清除不是当天算出的答案——逾期状态、公告有效期等随日期变化，答案只在算出的当天有效
+- 多个工作进程各有一个线程，同一时间只有拿到 advisory lock 的进程在刷新。锁持有在每个进程自己的一条专用连接上
+  （不占连接池），刷新的各步骤和每批重算各自从连接池借用连接、用完即还，刷新期间不长期占用连接池
+- 触发器由本模块安装：表被重建（如 generate_dataset.py --reset）后自动补装，并清空答案表重新全量计算
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_values
+
+from answer_payload import column_types
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ADVISORY_LOCK_KEY = 4701
+SHARED_STUDENT = '*'
+DEFAULT_QUERY_TYPES = ['experiment_report', 'grade_inquiry', 'unit_test', 'announcement']
+
+# 各查询类型的集合查询，%s 为学号列表；shared 的答案与学生无关，只算一份
+PRECOMPUTED_QUERIES = {
+    'experiment_report': {
+        'sql': "SELECT s.student_id, ins.serial_number, ins.course_content, ins.report_deadline, CASE WHEN ins.report_deadline < CURRENT_DATE THEN '已逾期' ELSE '未逾期' END as status, CASE WHEN ins.report_deadline - CURRENT_DATE <= 3 THEN '紧急' WHEN ins.report_deadline - CURRENT_DATE <= 7 THEN '即将到期' ELSE '正常' END as urgency FROM students s CROSS JOIN Intelligent_Supervision ins LEFT JOIN LabReport lr ON ins.serial_number = lr.serial_number AND lr.student_id = s.student_id WHERE s.student_id = ANY(%s) AND (lr.submitted IS FALSE OR lr.submitted IS NULL) ORDER BY s.student_id, ins.report_deadline, ins.serial_number",
+    },
+    'grade_inquiry': {
+        'sql': "SELECT sg.student_id, ins.course_content, sg.grade, sg.submit_date, sg.late_days, sg.comments, CASE WHEN sg.grade >= 90 THEN '优秀' WHEN sg.grade >= 80 THEN '良好' WHEN sg.grade >= 70 THEN '中等' WHEN sg.grade >= 60 THEN '及格' ELSE '不及格' END as grade_level FROM StudentGrades sg JOIN Intelligent_Supervision ins ON sg.serial_number = ins.serial_number WHERE sg.student_id = ANY(%s) ORDER BY sg.student_id, sg.submit_date DESC, sg.serial_number",
+    },
+    'unit_test': {
+        'shared': True,
+        'sql': "SELECT ins.course_content, ins.unit_number, ins.unit_test_date, ins.unit_test_date - CURRENT_DATE as days_left FROM Intelligent_Supervision ins WHERE ins.unit_test_date >= CURRENT_DATE ORDER BY ins.unit_test_date, ins.unit_number LIMIT 10",
+    },
+    'announcement': {
+        'sql': "SELECT student_id, title, content, announcement_type, publish_date, expire_date, type_zh FROM (SELECT s.student_id, a.title, a.content, a.announcement_type, a.publish_date, a.expire_date, CASE WHEN a.announcement_type = 'urgent' THEN '紧急' WHEN a.announcement_type = 'deadline' THEN '截止提醒' WHEN a.announcement_type = 'exam' THEN '考试通知' ELSE '一般通知' END as type_zh, ROW_NUMBER() OVER (PARTITION BY s.student_id ORDER BY CASE WHEN a.announcement_type = 'urgent' THEN 1 ELSE 2 END, a.publish_date DESC, a.announcement_id DESC) as position FROM students s JOIN Announcements a ON a.target_students IS NULL OR a.target_students::text LIKE '%%\"' || s.student_id || '\"%%' WHERE s.student_id = ANY(%s) AND a.is_active = TRUE AND (a.expire_date IS NULL OR a.expire_date >= CURRENT_DATE)) ranked WHERE position <= 5 ORDER BY student_id, position",
+    },
+}
+
+# (表, 查询类型)：按行记录受影响的学生；(表, 查询类型列表)：任何变更都影响全部学生
+STUDENT_SOURCES = [('LabReport', 'experiment_report'), ('StudentGrades', 'grade_inquiry')]
+SHARED_SOURCES = [
+    ('Intelligent_Supervision', ['experiment_report', 'grade_inquiry', 'unit_test']),
+    ('Announcements', ['announcement']),
+]
+
+TRIGGER_FUNCTIONS_SQL = """
+CREATE OR REPLACE FUNCTION log_student_answer_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO answer_changes (student_id, query_type) SELECT DISTINCT student_id, TG_ARGV[0] FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO answer_changes (student_id, query_type) SELECT DISTINCT student_id, TG_ARGV[0] FROM old_rows;
+    ELSE
+        INSERT INTO answer_changes (student_id, query_type)
+        SELECT student_id, TG_ARGV[0] FROM new_rows UNION SELECT student_id, TG_ARGV[0] FROM old_rows;
+    END IF;
+    RETURN NULL;
+END $$;
+CREATE OR REPLACE FUNCTION log_all_answer_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO answer_changes (query_type) SELECT unnest(TG_ARGV);
+    RETURN NULL;
+END $$;
+"""
+
+LOOKUP_SQL = """
+    SELECT a.answer, a.columns, a.rows
+    FROM precomputed_answers a
+    WHERE a.student_id = %s AND a.query_type = %s AND a.computed_at >= CURRENT_DATE
+      AND NOT EXISTS (
+          SELECT 1 FROM answer_changes c
+          WHERE c.query_type = a.query_type AND (c.student_id = a.student_id OR c.student_id IS NULL)
+      )
+"""
+
+UPSERT_SQL = """
+    INSERT INTO precomputed_answers (student_id, query_type, answer, columns, rows) VALUES %s
+    ON CONFLICT (student_id, query_type) DO UPDATE
+    SET answer = EXCLUDED.answer, columns = EXCLUDED.columns, rows = EXCLUDED.rows, computed_at = EXCLUDED.computed_at
+"""
+
+
+def _triggers():
+    """本模块安装的触发器：{触发器名: (表, 建触发器的 SQL)}"""
+    triggers = {}
+    for table, query_type in STUDENT_SOURCES:
+        prefix = f"{table.lower()}_answer_changes"
+        for event, referencing in [('INSERT', 'NEW TABLE AS new_rows'), ('DELETE', 'OLD TABLE AS old_rows'),
+                                   ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows')]:
+            triggers[f"{prefix}_{event.lower()}"] = (
+                table, f"AFTER {event} ON {table} REFERENCING {referencing} "
+                       f"FOR EACH STATEMENT EXECUTE FUNCTION log_student_answer_changes('{query_type}')")
+        triggers[f"{prefix}_truncate"] = (
+            table, f"AFTER TRUNCATE ON {table} FOR EACH STATEMENT EXECUTE FUNCTION log_all_answer_changes('{query_type}')")
+    for table, query_types in SHARED_SOURCES:
+        arguments = ', '.join(f"'{query_type}'" for query_type in query_types)
+        triggers[f"{table.lower()}_answer_changes"] = (
+            table, f"AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+                   f"FOR EACH STATEMENT EXECUTE FUNCTION log_all_answer_changes({arguments})")
+    return triggers
+
+
+def ensure_triggers(conn):
+    """补装缺失的变更触发器，返回新装的触发器名"""
+    triggers = _triggers()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT tgname FROM pg_trigger WHERE NOT tgisinternal AND tgname = ANY(%s)", (list(triggers),))
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in triggers if name not in existing]
+        if missing:
+            cursor.execute(TRIGGER_FUNCTIONS_SQL)
+            for name in missing:
+                table, definition = triggers[name]
+                cursor.execute(f"CREATE TRIGGER {name} {definition}")
+    conn.commit()
+    return missing
+
+
+def encode_rows(rows):
+    """转换为 JSON 存储，日期、时间和 Decimal 按 column_types 的列类型原样还原"""
+    encoded = []
+    for row in rows:
+        values = []
+        for value in row:
+            if isinstance(value, (date, datetime)):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = str(value)
+            elif isinstance(value, timedelta):
+                value = value.total_seconds()
+            values.append(value)
+        encoded.append(values)
+    return encoded
+
+
+_DECODERS = {
+    'date': date.fromisoformat,
+    'timestamp': datetime.fromisoformat,
+    'number': lambda value: Decimal(value) if isinstance(value, str) else value,
+    'interval': lambda value: timedelta(seconds=value),
+}
+
+
+def decode_rows(columns, rows):
+    decoders = [_DECODERS.get(column['type']) for column in columns]
+    return [
+        tuple(decoder(value) if decoder and value is not None else value for decoder, value in zip(decoders, row))
+        for row in rows
+    ]
+
+
+class AnswerPrecomputer:
+    """
+    render(query_type, rows) 返回与实时查询相同的文字答案；
+    query_types 为预计算的查询类型（QueryType 的值），需在 PRECOMPUTED_QUERIES 中；
+    db_config 为主库连接参数，用于持有 advisory lock 的专用连接
+    """
+
+    def __init__(self, db_pool, render, query_types=None, interval=30, active_days=14, batch_size=2000,
+                 rollup_freshness=None, db_config=None):
+        self.db_pool = db_pool
+        self.db_config = db_config
+        self.rollup_freshness = rollup_freshness
+        self.render = render
+        self.query_types = [query_type for query_type in (query_types or DEFAULT_QUERY_TYPES)
+                            if query_type in PRECOMPUTED_QUERIES]
+        self.interval = interval
+        self.active_days = active_days
+        self.batch_size = batch_size
+        self.enabled = True
+        self.last_refresh = None
+        self._lock_conn = None
+        # 同一进程内的刷新（后台线程与手动调用）互斥：advisory lock 在同一会话内可重入，挡不住本进程的其他线程
+        self._refreshing = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='precompute', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set() and self.enabled:
+            try:
+                self.refresh()
+            except UndefinedTable as e:
+                # 尚未执行 migrations/V008
+                self.enabled = False
+                logger.warning(f"预计算答案表不存在，停用预计算: {str(e).strip()}")
+            except Exception as e:
+                logger.error(f"预计算答案刷新失败: {str(e)}")
+            self._stop.wait(self.interval)
+
+    # ---- 读取 ----
+
+    def handles(self, query_type):
+        return self.enabled and query_type in self.query_types
+
+    def lookup(self, user_id, query_type):
+        """返回预先算好且仍然有效的答案 {'answer', 'columns', 'rows'}，没有时返回 None"""
+        if not self.handles(query_type):
+            return None
+        student_id = SHARED_STUDENT if PRECOMPUTED_QUERIES[query_type].get('shared') else str(user_id)
+        try:
+            with self.db_pool.connection(read_only=True, user_id=user_id) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(LOOKUP_SQL, (student_id, query_type))
+                    row = cursor.fetchone()
+                conn.rollback()
+        except Exception as e:
+            logger.warning("读取预计算答案失败: %s", e)
+            return None
+        if row is None:
+            metrics.incr('precompute.miss')
+            return None
+        metrics.incr('precompute.hit')
+        answer, columns, rows = row
+        return {'answer': answer, 'columns': [column['name'] for column in columns],
+                'rows': decode_rows(columns, rows)}
+
+    # ---- 刷新 ----
+
+    def _lock_connection(self):
+        """持有 advisory lock 的专用连接（autocommit），断开后下一轮重新建立"""
+        if self._lock_conn is None or self._lock_conn.closed:
+            self._lock_conn = psycopg2.connect(**self.db_config)
+            self._lock_conn.autocommit = True
+        return self._lock_conn
+
+    def refresh(self):
+        """执行一轮刷新，返回本轮概况；其他进程或本进程的其他线程正在刷新时返回 None"""
+        if not self._refreshing.acquire(blocking=False):
+            return None
+        try:
+            lock_conn = self._lock_connection()
+            try:
+                with lock_conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+                    acquired = cursor.fetchone()[0]
+            except psycopg2.OperationalError:
+                lock_conn.close()
+                raise
+            if not acquired:
+                return None
+            try:
+                return self._refresh()
+            finally:
+                if not lock_conn.closed:
+                    # 连接已断开时锁随会话释放
+                    with lock_conn.cursor() as cursor:
+                        cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        finally:
+            self._refreshing.release()
+
+    def _refresh(self):
+        started = time.monotonic()
+        with self.db_pool.connection() as conn:
+            installed = ensure_triggers(conn)
+            with conn.cursor() as cursor:
+                if installed:
+                    # 触发器缺失期间的变更无从得知，已有答案全部作废
+                    logger.info(f"已安装答案变更触发器: {', '.join(installed)}")
+                    cursor.execute("DELETE FROM precomputed_answers")
+                    cursor.execute("DELETE FROM precompute_runs WHERE run_date = CURRENT_DATE")
+                    conn.commit()
+                cursor.execute("SELECT change_id, student_id, query_type FROM answer_changes")
+                changes = cursor.fetchall()
+                cursor.execute("SELECT EXISTS (SELECT 1 FROM precompute_runs WHERE run_date = CURRENT_DATE)")
+                full = not cursor.fetchone()[0]
+            conn.commit()
+
+        if full:
+            with self.db_pool.connection() as conn:
+                targets = self._active_students(conn)
+            report = {'mode': 'full', 'students': len(targets)}
+            refreshed = self._compute({query_type: targets for query_type in self.query_types})
+            with self.db_pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM precomputed_answers WHERE computed_at < CURRENT_DATE")
+                    report['expired'] = cursor.rowcount
+                    cursor.execute("INSERT INTO precompute_runs (run_date, students) VALUES (CURRENT_DATE, %s) "
+                                   "ON CONFLICT (run_date) DO UPDATE SET students = EXCLUDED.students, "
+                                   "finished_at = now()", (len(targets),))
+                conn.commit()
+        else:
+            report = {'mode': 'incremental', 'changes': len(changes)}
+            refreshed = 0
+            if changes:
+                with self.db_pool.connection() as conn:
+                    targets = self._changed_targets(conn, changes)
+                refreshed = self._compute(targets)
+
+        if changes:
+            with self.db_pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM answer_changes WHERE change_id = ANY(%s)",
+                                   ([change_id for change_id, _, _ in changes],))
+                conn.commit()
+        elapsed_ms = (time.monotonic() - started) * 1000
+        report.update(answers=refreshed, ms=round(elapsed_ms, 1))
+        metrics.observe('precompute.refresh_ms', elapsed_ms)
+        metrics.incr('precompute.refreshed', refreshed)
+        if full or refreshed:
+            logger.info(f"预计算答案已刷新: {report}")
+        self.last_refresh = dict(report, at=datetime.now().isoformat(timespec='seconds'))
+        return report
+
+    def _active_students(self, conn):
+        with conn.cursor() as cursor:
+            if self.rollup_freshness is None or self.rollup_freshness.fresh('LearningActivityDaily'):
+                cursor.execute("SELECT DISTINCT student_id FROM LearningActivityDaily "
+                               "WHERE activity_day >= CURRENT_DATE - %s", (self.active_days,))
+            else:
+                cursor.execute("SELECT DISTINCT student_id FROM LearningActivity "
+                               "WHERE activity_date >= CURRENT_DATE - %s AND student_id IS NOT NULL", (self.active_days,))
+            students = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return students
+
+    def _changed_targets(self, conn, changes):
+        """变更涉及、且答案表中已有答案的 {查询类型: 学号列表}"""
+        changed = defaultdict(set)
+        for _, student_id, query_type in changes:
+            if query_type in self.query_types:
+                changed[query_type].add(student_id)
+        targets = {}
+        with conn.cursor() as cursor:
+            for query_type, students in changed.items():
+                if PRECOMPUTED_QUERIES[query_type].get('shared'):
+                    targets[query_type] = [SHARED_STUDENT]
+                    continue
+                if None in students:
+                    cursor.execute("SELECT student_id FROM precomputed_answers WHERE query_type = %s", (query_type,))
+                else:
+                    cursor.execute("SELECT student_id FROM precomputed_answers "
+                                   "WHERE query_type = %s AND student_id = ANY(%s)", (query_type, list(students)))
+                targets[query_type] = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return targets
+
+    def _compute(self, targets):
+        """按集合查询分批重算 {查询类型: 学号列表} 的答案并写入，返回写入的答案数；每批借用一次连接"""
+        written = 0
+        for query_type, students in targets.items():
+            spec = PRECOMPUTED_QUERIES[query_type]
+            if spec.get('shared'):
+                batches = [[SHARED_STUDENT]] if students else []
+            else:
+                batches = [students[i:i + self.batch_size] for i in range(0, len(students), self.batch_size)]
+            for batch in batches:
+                grouped = defaultdict(list)
+                with self.db_pool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        if spec.get('shared'):
+                            cursor.execute(spec['sql'])
+                            columns = [column[0] for column in cursor.description]
+                            grouped[SHARED_STUDENT] = cursor.fetchall()
+                        else:
+                            cursor.execute(spec['sql'], (batch,))
+                            columns = [column[0] for column in cursor.description][1:]
+                            for row in cursor.fetchall():
+                                grouped[row[0]].append(row[1:])
+                        entries = []
+                        for student_id in batch:
+                            rows = grouped.get(student_id, [])
+                            entries.append((student_id, query_type, self.render(query_type, rows),
+                                            json.dumps(column_types(columns, rows), ensure_ascii=False),
+                                            json.dumps(encode_rows(rows), ensure_ascii=False)))
+                        execute_values(cursor, UPSERT_SQL, entries, page_size=500)
+                    conn.commit()
+                written += len(entries)
+        return written
+
+    def stats(self):
+        return {'enabled': self.enabled, 'query_types': self.query_types, 'last_refresh': self.last_refresh}
+
+    def close(self):
+        self._stop.set()
+        if self._lock_conn is not None:
+            self._lock_conn.close()
@@ -0,0 +1,43 @@
+"""
+多进程部署的辅助函数
+
+gunicorn 以 preload_app 方式启动时，主进程先导入应用并加载只读数据（SQL 模板、意图关键词表、
+建议问题表、意图分类模型），fork 出的工作进程以写时复制方式共享这部分内存。
+数据库连接池、大模型 HTTP 客户端和线程池不能跨 fork 使用，在每个工作进程中各自创建，
+其容量按工作进程数分摊全局额度。
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def worker_count():
+    """部署的工作进程数（gunicorn / uvicorn 约定的 WEB_CONCURRENCY），未设置时为 1"""
+    try:
+        return max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+    except ValueError:
+        return 1
+
+
+def per_worker_share(total, workers, minimum=1):
+    """把全局额度平均分给各工作进程（向下取整，不少于 minimum）"""
+    return max(minimum, int(total) // max(1, workers))
+
+
+def budget_shortfall(total, workers, minimum):
+    """全局额度不够每个工作进程分到 minimum 时返回说明，否则返回 None"""
+    needed = max(1, workers) * minimum
+    if int(total) >= needed:
+        return None
+    return f"额度 {total} 不够 {workers} 个工作进程每个至少 {minimum}（共需 {needed}）"
+
+
+def preload_shared_state():
+    """在 fork 之前加载只读数据，各工作进程直接复用"""
+    # 导入时即构建 SQL 模板、模板问题表和意图关键词表
+    import ai_sql_generator  # noqa: F401
+    from intent_classifier import load_intent_classifier
+
+    load_intent_classifier(os.getenv('INTENT_MODEL_PATH', 'models/intent_nb.npz'))
+    logger.info(f"共享数据已在进程 {os.getpid()} 中预加载")
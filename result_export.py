@@ -0,0 +1,93 @@
+"""
+查询结果导出
+
+/api/query/export 按结果句柄重新执行已校验过的生成 SQL（见 AIQueryProcessor.export_rows），
+服务端游标每次取一批行，在这里编码为 CSV 或 JSONL 分块输出，可选边编码边 gzip 压缩：
+- 内存占用只与批大小有关，与导出的总行数无关
+- 每一块都立即交给 Web 服务器发送（gzip 每块做一次 Z_SYNC_FLUSH），客户端很快收到第一个字节
+- CSV 以 UTF-8 BOM 开头，Excel 可直接打开中文；JSONL 每行一个 {列名: 值} 对象
+"""
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import datetime
+
+from answer_payload import encode_value
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 格式 -> (Content-Type, 扩展名)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+}
+
+
+def csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # 结果为空时只有表头
+        yield buffer.getvalue().encode('utf-8')
+
+
+def jsonl_chunks(columns, batches):
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(columns, map(encode_value, row))), ensure_ascii=False) + '\n' for row in rows
+        ).encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """把分块流压缩为一个 gzip 流，每块之后同步刷新，不在压缩器中积压数据"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _counted(batches, counter):
+    for rows in batches:
+        counter[0] += len(rows)
+        yield rows
+
+
+def export_chunks(export_format, columns, batches, compress=False):
+    """
+    导出的响应体（字节块的生成器）。中途出错时响应头已经发出，只能记录日志并截断输出
+    （gzip 流缺少结尾，客户端解压时能发现不完整）
+    """
+    counter = [0]
+    encoder = csv_chunks if export_format == 'csv' else jsonl_chunks
+    chunks = encoder(columns, _counted(batches, counter))
+    if compress:
+        chunks = gzip_chunks(chunks)
+    try:
+        yield from chunks
+    except GeneratorExit:
+        # 客户端断开：关闭行生成器，归还数据库连接
+        batches.close()
+        logger.info("导出被客户端中止: 已输出 %d 行", counter[0])
+        raise
+    except Exception as e:
+        metrics.incr('export.failed')
+        logger.error("导出中途失败: %s（已输出 %d 行）", e, counter[0])
+        return
+    metrics.incr('export.completed')
+    metrics.incr('export.rows', counter[0])
+    logger.info("导出完成: %d 行 (%s%s)", counter[0], export_format, ', gzip' if compress else '')
+
+
+def export_filename(query_type, export_format, compress=False):
+    name = f"{query_type or 'result'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{EXPORT_FORMATS[export_format][1]}"
+    return name + '.gz' if compress else name
@@ -0,0 +1,324 @@
+"""
+学习活动 / 资源访问的增量日汇总
+
+分析类查询原来每次都对原始事件表做 SUM / AVG / COUNT(DISTINCT DATE(...))，学期越往后越慢。
+本任务把新事件累加到每日汇总表（migrations/V007），查询改读汇总表，代价只随天数增长：
+
+    python rollup_job.py run                  # 处理到当前为止的新事件后退出（首次运行即全量回填）
+    python rollup_job.py run --interval 60    # 常驻，每 60 秒一轮
+    python rollup_job.py rebuild              # 清空汇总表和水位后重新汇总
+    python rollup_job.py status               # 各汇总表的水位与待处理事件数
+
+- 水位是已汇总的最大事件 ID（rollup_watermark），每轮只读取 ID 大于水位的事件，按 batch_size 分批；
+  每批的汇总累加与水位推进在同一个事务中提交，中途失败重跑不会重复累加
+- 确定本轮上界前短暂对事件表加 SHARE ROW EXCLUSIVE 锁：等待正在写入的事务结束，
+  之后分配的 ID 一定大于上界，不会有较小的 ID 晚提交而被水位跳过
+- 事件表只追加：已汇总事件的修改和删除不会反映到汇总表，需要时执行 rebuild
+- 同一时间只有一个实例在汇总（会话级 advisory lock），多处部署时其余实例本轮直接跳过
+- 每轮顺带为分区的事件表提前创建之后几个月的分区（migrations/V006），新事件不会落入 DEFAULT 分区
+- 水位的 updated_at 在每轮结束时更新（没有新事件也更新），即最近一次确认汇总表跟上事件表的时间。
+  查询端用 RollupFreshness 检查：水位缺失或太久没有更新（汇总任务停了）时改读原始事件表
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import date
+
+import psycopg2
+from dotenv import load_dotenv
+
+from db_pool import env_db_config
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ADVISORY_LOCK_KEY = 4601
+# key 列中可能为空的列按 IS NOT DISTINCT FROM 匹配
+ROLLUPS = {
+    'LearningActivityDaily': {
+        'source': 'LearningActivity',
+        'count_column': 'activity_count',
+        'id_column': 'activity_id',
+        'time_column': 'activity_date',
+        'keys': ['student_id', 'activity_day', 'serial_number', 'device_type'],
+        'not_null_keys': ['student_id', 'activity_day'],
+        'select': "student_id, serial_number, activity_date::date AS activity_day, device_type, "
+                  "COUNT(*) AS activity_count, SUM(duration_minutes) AS total_minutes, "
+                  "COUNT(duration_minutes) AS duration_count",
+        'group_by': "student_id, serial_number, activity_date::date, device_type",
+        'merge': "activity_count = r.activity_count + b.activity_count, "
+                 "total_minutes = COALESCE(r.total_minutes + b.total_minutes, r.total_minutes, b.total_minutes), "
+                 "duration_count = r.duration_count + b.duration_count",
+    },
+    'ResourceAccessDaily': {
+        'source': 'ResourceAccess',
+        'count_column': 'access_count',
+        'id_column': 'access_id',
+        'time_column': 'access_date',
+        'keys': ['student_id', 'access_day', 'serial_number', 'resource_type', 'resource_name'],
+        'not_null_keys': ['student_id', 'access_day'],
+        'select': "student_id, serial_number, access_date::date AS access_day, resource_type, resource_name, "
+                  "COUNT(*) AS access_count, SUM(access_duration_seconds) AS total_seconds, "
+                  "COUNT(access_duration_seconds) AS duration_count, MAX(access_date) AS last_access",
+        'group_by': "student_id, serial_number, access_date::date, resource_type, resource_name",
+        'merge': "access_count = r.access_count + b.access_count, "
+                 "total_seconds = COALESCE(r.total_seconds + b.total_seconds, r.total_seconds, b.total_seconds), "
+                 "duration_count = r.duration_count + b.duration_count, "
+                 "last_access = GREATEST(r.last_access, b.last_access)",
+    },
+}
+
+
+def _match(keys, not_null_keys):
+    return ' AND '.join(
+        f"r.{key} = b.{key}" if key in not_null_keys else f"r.{key} IS NOT DISTINCT FROM b.{key}"
+        for key in keys
+    )
+
+
+def _month_start(day, months=0):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def ensure_partitions(conn, months_ahead=2, today=None):
+    """为分区的事件表创建本月及之后 months_ahead 个月的分区，返回新建的分区名；未分区的表跳过"""
+    today = today or date.today()
+    created = []
+    for rollup in ROLLUPS.values():
+        table = rollup['source'].lower()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = cursor.fetchone()
+        conn.rollback()
+        if row is None or row[0] != 'p':
+            continue
+        for offset in range(months_ahead + 1):
+            start = _month_start(today, offset)
+            name = f"{table}_{start:%Y%m}"
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT to_regclass(%s)", (name,))
+                if cursor.fetchone()[0] is not None:
+                    conn.rollback()
+                    continue
+                try:
+                    cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                                   (start, _month_start(start, 1)))
+                except psycopg2.Error as e:
+                    # DEFAULT 分区里已有该月的行时无法直接建分区，需要人工迁出
+                    conn.rollback()
+                    logger.warning(f"创建分区 {name} 失败: {str(e).strip()}")
+                    continue
+            conn.commit()
+            created.append(name)
+            logger.info(f"已创建分区 {name}")
+    return created
+
+
+def _window_end(conn, rollup, lock_timeout_ms):
+    """等正在写入事件表的事务结束后取当前最大事件 ID，作为本轮汇总的上界"""
+    with conn.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = {int(lock_timeout_ms)}")
+        cursor.execute(f"LOCK TABLE {rollup['source']} IN SHARE ROW EXCLUSIVE MODE")
+        cursor.execute(f"SELECT MAX({rollup['id_column']}) FROM {rollup['source']}")
+        end = cursor.fetchone()[0]
+    conn.commit()
+    return end or 0
+
+
+def _watermark(cursor, name, lock=False):
+    cursor.execute("SELECT last_event_id FROM rollup_watermark WHERE rollup_name = %s" + (" FOR UPDATE" if lock else ""),
+                   (name,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"rollup_watermark 中没有 {name}，请先执行 migrations/V007")
+    return row[0]
+
+
+def roll_up(conn, name, batch_size=200000, lock_timeout_ms=5000):
+    """把 ID 大于水位的事件累加到汇总表 name，返回本轮处理的事件数、更新和新增的汇总行数"""
+    rollup = ROLLUPS[name]
+    started = time.perf_counter()
+    end = _window_end(conn, rollup, lock_timeout_ms)
+    report = {'events': 0, 'updated': 0, 'inserted': 0, 'batches': 0}
+    while True:
+        with conn.cursor() as cursor:
+            start = _watermark(cursor, name, lock=True)
+            if start >= end:
+                cursor.execute("UPDATE rollup_watermark SET updated_at = now() WHERE rollup_name = %s", (name,))
+                conn.commit()
+                break
+            batch_end = min(start + batch_size, end)
+            cursor.execute(
+                f"CREATE TEMP TABLE rollup_batch ON COMMIT DROP AS "
+                f"SELECT {rollup['select']} FROM {rollup['source']} "
+                f"WHERE {rollup['id_column']} > %s AND {rollup['id_column']} <= %s "
+                f"AND student_id IS NOT NULL AND {rollup['time_column']} IS NOT NULL GROUP BY {rollup['group_by']}",
+                (start, batch_end)
+            )
+            cursor.execute(f"SELECT COALESCE(SUM({rollup['count_column']}), 0) FROM rollup_batch")
+            report['events'] += int(cursor.fetchone()[0])
+            match = _match(rollup['keys'], rollup['not_null_keys'])
+            cursor.execute(f"UPDATE {name} r SET {rollup['merge']} FROM rollup_batch b WHERE {match}")
+            report['updated'] += cursor.rowcount
+            cursor.execute(f"INSERT INTO {name} SELECT b.* FROM rollup_batch b "
+                           f"WHERE NOT EXISTS (SELECT 1 FROM {name} r WHERE {match})")
+            report['inserted'] += cursor.rowcount
+            cursor.execute("UPDATE rollup_watermark SET last_event_id = %s, updated_at = now() WHERE rollup_name = %s",
+                           (batch_end, name))
+        conn.commit()
+        report['batches'] += 1
+    report['watermark'] = end
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def run_once(conn, batch_size=200000, months_ahead=2):
+    """
+    一轮汇总：提前创建分区，再依次推进各汇总表。
+    其他实例正在汇总时返回 None
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+        acquired = cursor.fetchone()[0]
+    conn.commit()
+    if not acquired:
+        logger.info("其他实例正在汇总，本轮跳过")
+        return None
+    try:
+        report = {'partitions_created': ensure_partitions(conn, months_ahead), 'rollups': {}}
+        for name in ROLLUPS:
+            report['rollups'][name] = roll_up(conn, name, batch_size)
+        return report
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+            conn.commit()
+
+
+def reset(conn):
+    """清空汇总表并把水位归零（事件表被重建、或已汇总的事件被修改后使用）"""
+    with conn.cursor() as cursor:
+        for name in ROLLUPS:
+            cursor.execute(f"TRUNCATE {name}")
+        cursor.execute("UPDATE rollup_watermark SET last_event_id = 0, updated_at = now()")
+    conn.commit()
+
+
+def watermark_ages(conn):
+    """各汇总表的水位距上次更新的秒数，水位缺失时为 None"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT rollup_name, EXTRACT(EPOCH FROM LOCALTIMESTAMP - updated_at) FROM rollup_watermark "
+                       "WHERE rollup_name = ANY(%s)", (list(ROLLUPS),))
+        ages = {name: float(age) if age is not None else None for name, age in cursor.fetchall()}
+    conn.rollback()
+    return {name: ages.get(name) for name in ROLLUPS}
+
+
+def status(conn):
+    """各汇总表的水位、待处理事件数和汇总行数"""
+    result = {}
+    ages = watermark_ages(conn)
+    with conn.cursor() as cursor:
+        for name, rollup in ROLLUPS.items():
+            cursor.execute("SELECT last_event_id, updated_at FROM rollup_watermark WHERE rollup_name = %s", (name,))
+            watermark, updated_at = cursor.fetchone() or (None, None)
+            cursor.execute(f"SELECT COUNT(*) FROM {rollup['source']} WHERE {rollup['id_column']} > %s",
+                           (watermark or 0,))
+            pending = cursor.fetchone()[0]
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            result[name] = {'watermark': watermark, 'updated_at': updated_at.isoformat() if updated_at else None,
+                            'age_seconds': round(ages[name]) if ages[name] is not None else None,
+                            'pending_events': pending, 'rows': cursor.fetchone()[0]}
+    conn.rollback()
+    return result
+
+
+class RollupFreshness:
+    """
+    查询端判断汇总表能否使用：水位缺失、或超过 max_lag_seconds 没有更新时视为过期，
+    调用方改读原始事件表。水位每 check_seconds 秒最多读取一次，读取失败时视为全部过期
+    """
+
+    def __init__(self, db_pool, max_lag_seconds=900, check_seconds=30):
+        self.db_pool = db_pool
+        self.max_lag_seconds = max_lag_seconds
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._ages = {name: None for name in ROLLUPS}
+        self._checked_at = None
+
+    def _current_ages(self):
+        with self._lock:
+            if self._checked_at is None or time.monotonic() - self._checked_at >= self.check_seconds:
+                try:
+                    with self.db_pool.connection() as conn:
+                        self._ages = watermark_ages(conn)
+                except Exception as e:
+                    logger.warning("读取汇总水位失败，分析查询改读原始事件表: %s", e)
+                    self._ages = {name: None for name in ROLLUPS}
+                self._checked_at = time.monotonic()
+            return self._ages
+
+    def fresh(self, name):
+        age = self._current_ages().get(name)
+        if age is not None and age <= self.max_lag_seconds:
+            return True
+        metrics.incr('rollup.fallback')
+        return False
+
+    def stats(self):
+        return {
+            name: {'age_seconds': round(age) if age is not None else None,
+                   'fresh': age is not None and age <= self.max_lag_seconds}
+            for name, age in self._current_ages().items()
+        }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='学习活动 / 资源访问的增量日汇总（连接配置取自 DB_* 环境变量）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='汇总水位之后的新事件')
+    run_parser.add_argument('--interval', type=float, help='常驻运行，每隔若干秒汇总一轮')
+    rebuild_parser = subparsers.add_parser('rebuild', help='清空汇总表后重新汇总全部事件')
+    for sub in (run_parser, rebuild_parser):
+        sub.add_argument('--batch-size', type=int, default=200000, help='每个事务处理的事件 ID 范围')
+        sub.add_argument('--months-ahead', type=int, default=2, help='提前创建的月分区数')
+    subparsers.add_parser('status', help='各汇总表的水位与待处理事件数')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**env_db_config())
+    try:
+        if args.command == 'status':
+            output = status(conn)
+        elif args.command == 'rebuild':
+            reset(conn)
+            output = run_once(conn, args.batch_size, args.months_ahead)
+        elif args.interval:
+            logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+            while True:
+                try:
+                    report = run_once(conn, args.batch_size, args.months_ahead)
+                    if report:
+                        logger.info(json.dumps(report, ensure_ascii=False))
+                except psycopg2.Error as e:
+                    logger.error(f"汇总失败，下一轮重试: {str(e).strip()}")
+                    if conn.closed:
+                        conn = psycopg2.connect(**env_db_config())
+                    else:
+                        conn.rollback()
+                time.sleep(args.interval)
+        else:
+            output = run_once(conn, args.batch_size, args.months_ahead)
+    finally:
+        conn.close()
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
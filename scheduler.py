@@ -0,0 +1,97 @@
+"""
+查询的双通道调度
+
+/api/query 在进入处理前先判断问题能否不调用大模型直接回答：
+- fast: 命中模板问题（以及后续的缓存命中），只需一次数据库查询
+- slow: 需要大模型生成 SQL
+两个通道各有独立的线程池和排队上限，慢通道被大模型调用占满时，
+快通道的请求不会排在它们后面。
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import Overloaded
+from metrics import metrics
+
+FAST_LANE = 'fast'
+SLOW_LANE = 'slow'
+
+
+class Lane:
+    """单个通道：有界线程池 + 排队上限"""
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'lane-{name}')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        # 单个任务耗时的指数滑动平均，用于给出 Retry-After 建议
+        self._latency = 0.05 if name == FAST_LANE else 3.0
+
+    def submit(self, func, cancel_token=None):
+        """提交任务，排队已满时抛出 Overloaded"""
+        with self._lock:
+            if self._queued >= self.max_queue:
+                metrics.incr(f'lane.{self.name}.rejected')
+                raise Overloaded(f"{self.name} 通道排队已满",
+                                 (self._queued // self.max_workers + 1) * self._latency)
+            self._queued += 1
+            self._publish()
+        metrics.incr(f'lane.{self.name}.submitted')
+        # 在提交方的上下文中执行（日志沿用请求的 request_id）
+        return self._executor.submit(contextvars.copy_context().run, self._run, func, cancel_token, time.monotonic())
+
+    def _run(self, func, cancel_token, queued_at):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._publish()
+        metrics.observe(f'lane.{self.name}.queue_wait_ms', (time.monotonic() - queued_at) * 1000)
+
+        started = time.monotonic()
+        try:
+            # 排队期间客户端已放弃的请求不再执行
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            return func()
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._running -= 1
+                self._latency = 0.8 * self._latency + 0.2 * elapsed
+                self._publish()
+            metrics.observe(f'lane.{self.name}.latency_ms', elapsed * 1000)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queued': self._queued,
+                'running': self._running,
+                'avg_latency_seconds': round(self._latency, 3)
+            }
+
+    def _publish(self):
+        metrics.set_gauge(f'lane.{self.name}.queue_depth', self._queued)
+        metrics.set_gauge(f'lane.{self.name}.running', self._running)
+
+
+class LaneScheduler:
+    def __init__(self, fast_workers=8, fast_queue=64, slow_workers=16, slow_queue=64):
+        self.lanes = {
+            FAST_LANE: Lane(FAST_LANE, fast_workers, fast_queue),
+            SLOW_LANE: Lane(SLOW_LANE, slow_workers, slow_queue)
+        }
+
+    def run(self, lane, func, cancel_token=None):
+        """在指定通道执行 func 并等待结果，func 的异常原样抛出"""
+        return self.lanes[lane].submit(func, cancel_token).result()
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
@@ -0,0 +1,276 @@
+"""
+按语义相似度命中的问题缓存
+
+缓存大模型为已回答问题生成的 SQL（不缓存结果，结果每次重新查询）。新问题与缓存中的问题
+按字符 n-gram 的 TF-IDF 余弦相似度比较，最相似的一条达到阈值即直接复用其 SQL，跳过大模型，
+例如 "我还有哪些作业没交" 可以命中 "我有哪些作业还没交"。
+
+- 缓存条目的词频向量保存在一个 NumPy 矩阵中，查询向量是稀疏的，
+  最近邻查找只需对矩阵中相应的列做一次矩阵-向量乘法
+- IDF 随插入增量更新，行范数每插入 reweight_every 条后按新的 IDF 重新计算
+- SQL 和参数中提问者的学号替换为占位符保存，命中时替换为当前用户的学号；
+  含有其他学号的 SQL 不缓存
+- 问题中的数字和否定词必须完全一致才算命中（"最近3天" 与 "最近5天"、
+  "哪些作业没交" 与 "哪些作业交了" 不能互相命中）
+- 只用单字和双字 n-gram：语序调整后的同义问法（"我还有哪些作业没交" / "我有哪些作业还没交"）
+  共享的三字 n-gram 很少
+- 容量满时淘汰最久未命中的条目，超过 ttl_seconds 的条目不再命中
+
+用法（用意图标注日志估计不同阈值下的命中精度）:
+    python semantic_cache.py tune --data intent_labels.jsonl --precision 0.98
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+import numpy as np
+
+from metrics import metrics
+from text_features import hashed_counts, normalize_question
+
+USER_PLACEHOLDER = '{user_id}'
+NGRAM_RANGE = (1, 2)
+_STUDENT_ID = re.compile(r'\d{12}')
+# 相似度高也不能忽略的差别：数字与否定词
+_GUARD_TOKENS = re.compile(r'\d+|[没未不无非别]')
+
+
+def _term_frequencies(question, n_features, ngram_range):
+    """对数词频（1 + log tf）的稀疏表示"""
+    indices, counts = hashed_counts(question, n_features, ngram_range)
+    return indices, (1 + np.log(counts)).astype(np.float32)
+
+
+def guard_tokens(question):
+    """问题中的数字和否定词（排序后），这些差别决定了不同的 SQL"""
+    return sorted(_GUARD_TOKENS.findall(question))
+
+
+def _generalize(value, user_id):
+    return value.replace(user_id, USER_PLACEHOLDER) if isinstance(value, str) else value
+
+
+def _specialize(value, user_id):
+    return value.replace(USER_PLACEHOLDER, user_id) if isinstance(value, str) else value
+
+
+class SemanticCache:
+    def __init__(self, max_entries=2000, threshold=0.8, ttl_seconds=86400, n_features=4096,
+                 ngram_range=NGRAM_RANGE, reweight_every=64):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.reweight_every = reweight_every
+        self._lock = threading.Lock()
+        # 条目 × 特征 的对数词频矩阵
+        self._tf = np.zeros((max_entries, n_features), dtype=np.float32)
+        # 各条目在当前 IDF 下的向量范数
+        self._norms = np.zeros(max_entries, dtype=np.float32)
+        self._df = np.zeros(n_features, dtype=np.float64)
+        self._idf = np.ones(n_features, dtype=np.float32)
+        self._created = np.zeros(max_entries)
+        # 最近一次命中或写入的时间，0 表示空槽
+        self._last_used = np.zeros(max_entries)
+        self._entries = [None] * max_entries
+        self._slots = {}
+        self._pending_reweight = 0
+
+    def lookup(self, question, user_id):
+        """
+        查找相似问题，命中时返回 {'query_type', 'sql', 'params', 'similarity', 'question'}，
+        其中 SQL 参数已替换为当前用户，未命中返回 None
+        """
+        indices, tf = _term_frequencies(question, self.n_features, self.ngram_range)
+        with self._lock:
+            best = self._nearest(indices, tf, guard_tokens(question))
+            if best is None:
+                metrics.incr('semantic_cache.miss')
+                return None
+            slot, similarity = best
+            self._last_used[slot] = time.monotonic()
+            entry = self._entries[slot]
+
+        metrics.incr('semantic_cache.hit')
+        return {
+            'query_type': entry['query_type'],
+            'sql': _specialize(entry['sql'], user_id),
+            'params': [_specialize(param, user_id) for param in entry['params']],
+            'similarity': similarity,
+            'question': entry['question']
+        }
+
+    def contains(self, question):
+        """是否会命中（不更新使用时间和命中统计），用于选择调度通道"""
+        indices, tf = _term_frequencies(question, self.n_features, self.ngram_range)
+        with self._lock:
+            return self._nearest(indices, tf, guard_tokens(question)) is not None
+
+    def insert(self, question, query_type, sql, params, user_id):
+        """写入大模型生成并执行成功的 SQL，返回是否写入"""
+        sql = _generalize(sql, user_id)
+        params = [_generalize(param, user_id) for param in params or []]
+        if _STUDENT_ID.search(sql) or any(_STUDENT_ID.search(str(param)) for param in params):
+            # 涉及其他学生的查询不能复用给别人
+            metrics.incr('semantic_cache.skipped')
+            return False
+
+        key = normalize_question(question)
+        indices, tf = _term_frequencies(question, self.n_features, self.ngram_range)
+        if not key or indices.size == 0:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._free_slot(now)
+            self._release(slot)
+
+            self._tf[slot, indices] = tf
+            self._df[indices] += 1
+            self._created[slot] = now
+            self._last_used[slot] = now
+            self._entries[slot] = {
+                'key': key,
+                'question': question,
+                'guards': guard_tokens(question),
+                'query_type': query_type,
+                'sql': sql,
+                'params': params
+            }
+            self._slots[key] = slot
+
+            self._pending_reweight += 1
+            if self._pending_reweight >= self.reweight_every:
+                self._reweight()
+            else:
+                weighted = tf * self._idf[indices]
+                self._norms[slot] = np.sqrt(weighted @ weighted)
+            metrics.set_gauge('semantic_cache.size', len(self._slots))
+        metrics.incr('semantic_cache.insert')
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._slots),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'hits': metrics.counter('semantic_cache.hit'),
+                'misses': metrics.counter('semantic_cache.miss')
+            }
+
+    def _nearest(self, indices, tf, guards):
+        """返回 (槽位, 相似度)，没有达到阈值且数字、否定词一致的有效条目时返回 None"""
+        if not self._slots or indices.size == 0:
+            return None
+        idf = self._idf[indices]
+        weighted = tf * idf
+        query_norm = np.sqrt(weighted @ weighted)
+        if query_norm == 0:
+            return None
+
+        # 条目向量也按 IDF 加权：dot = Σ tf_q·idf · tf_d·idf
+        dots = self._tf[:, indices] @ (weighted * idf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = dots / (self._norms * query_norm)
+        valid = (self._last_used > 0) & (time.monotonic() - self._created <= self.ttl_seconds)
+        similarity = np.where(valid, similarity, -1.0)
+
+        slot = int(similarity.argmax())
+        if similarity[slot] < self.threshold or self._entries[slot]['guards'] != guards:
+            return None
+        return slot, float(similarity[slot])
+
+    def _free_slot(self, now):
+        """空槽，或过期 / 最久未使用的槽"""
+        empty = np.flatnonzero(self._last_used == 0)
+        if empty.size:
+            return int(empty[0])
+        expired = np.flatnonzero(now - self._created > self.ttl_seconds)
+        if expired.size:
+            return int(expired[0])
+        metrics.incr('semantic_cache.evicted')
+        return int(self._last_used.argmin())
+
+    def _release(self, slot):
+        """清空槽位并从文档频率中扣除"""
+        entry = self._entries[slot]
+        if entry is None:
+            return
+        self._df[np.flatnonzero(self._tf[slot])] -= 1
+        self._tf[slot] = 0
+        self._norms[slot] = 0
+        self._last_used[slot] = 0
+        self._entries[slot] = None
+        self._slots.pop(entry['key'], None)
+
+    def _reweight(self):
+        """按当前文档频率重新计算 IDF 与全部条目的范数"""
+        count = len(self._slots)
+        self._idf = (np.log((1 + count) / (1 + self._df)) + 1).astype(np.float32)
+        occupied = np.flatnonzero(self._last_used > 0)
+        weighted = self._tf[occupied] * self._idf
+        self._norms[:] = 0
+        self._norms[occupied] = np.sqrt(np.einsum('ij,ij->i', weighted, weighted))
+        self._pending_reweight = 0
+
+
+def tune_threshold(questions, labels, target_precision=0.98, n_features=4096, ngram_range=NGRAM_RANGE):
+    """
+    用 (问题, query_type) 标注估计阈值：每个问题在其余问题中的最近邻达到阈值时视为命中，
+    与最近邻意图相同视为命中正确（意图相同是"可复用同一 SQL"的宽松近似）。
+    返回各阈值的命中率与精度，以及达到目标精度的最小阈值
+    """
+    cache = SemanticCache(max_entries=len(questions), threshold=0.0, n_features=n_features,
+                          ngram_range=ngram_range, reweight_every=len(questions) + 1)
+    for question, label in zip(questions, labels):
+        cache.insert(question, label, '', [], '')
+    with cache._lock:
+        cache._reweight()
+        weighted = cache._tf * cache._idf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weighted = weighted / cache._norms[:, None]
+        entry_labels = np.array([entry['query_type'] if entry else '' for entry in cache._entries])
+        entry_guards = [entry['guards'] if entry else None for entry in cache._entries]
+
+    similarity = np.nan_to_num(weighted @ weighted.T, nan=-1.0)
+    np.fill_diagonal(similarity, -1.0)
+    neighbours = similarity.argmax(axis=1)
+    best = similarity[np.arange(len(neighbours)), neighbours]
+    guards_match = np.array([entry_guards[i] == entry_guards[j] for i, j in enumerate(neighbours)])
+    best = np.where(guards_match, best, -1.0)
+    correct = entry_labels[neighbours] == entry_labels
+
+    rows, recommended = [], None
+    for threshold in np.round(np.arange(0.5, 1.0, 0.025), 3):
+        hit = best >= threshold
+        precision = float(correct[hit].mean()) if hit.any() else None
+        rows.append({'threshold': float(threshold), 'hit_rate': round(float(hit.mean()), 4),
+                     'precision': round(precision, 4) if precision is not None else None})
+        if recommended is None and precision is not None and precision >= target_precision:
+            recommended = float(threshold)
+    return {'count': len(questions), 'target_precision': target_precision, 'recommended': recommended,
+            'thresholds': rows}
+
+
+def main():
+    from intent_classifier import load_pairs
+
+    parser = argparse.ArgumentParser(description='语义缓存的阈值评估')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    tune_parser = subparsers.add_parser('tune', help='估计达到目标精度的相似度阈值')
+    tune_parser.add_argument('--data', required=True, help='JSONL 标注数据 (question, query_type)')
+    tune_parser.add_argument('--precision', type=float, default=0.98)
+    args = parser.parse_args()
+
+    questions, labels = load_pairs(args.data)
+    print(json.dumps(tune_threshold(questions, labels, args.precision), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+生成 SQL 的轻量分析工具 - 规范化、指纹与引用的表
+"""
+import hashlib
+import re
+
+# 按单引号字符串字面量切分，奇数下标是字面量本身
+_LITERAL_SPLIT = re.compile(r"('(?:''|[^'])*')")
+_WHITESPACE = re.compile(r'\s+')
+_PUNCTUATION_SPACE = re.compile(r'\s*([(),=<>])\s*')
+
+
+def normalize_sql(sql):
+    """
+    规范化 SQL 文本：去除多余空白和结尾分号，字面量以外的部分统一小写。
+    语义相同、仅排版不同的两条 SQL 规范化后完全一致。
+    """
+    if not sql:
+        return ''
+
+    parts = _LITERAL_SPLIT.split(sql.strip().rstrip(';').strip())
+    normalized = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            normalized.append(part)
+        else:
+            code = _WHITESPACE.sub(' ', part.lower())
+            normalized.append(_PUNCTUATION_SPACE.sub(r'\1', code))
+    return ''.join(normalized).strip()
+
+
+def single_statement(sql):
+    """
+    去掉首尾空白和结尾的分号，返回单条语句；字面量以外仍有分号（多条语句）时返回 None。
+    生成的 SQL 会被包进子查询（分页、导出、代价检查），结尾分号会造成语法错误
+    """
+    sql = (sql or '').strip()
+    while sql.endswith(';'):
+        sql = sql[:-1].rstrip()
+    code = ''.join(_LITERAL_SPLIT.split(sql)[::2])
+    return None if ';' in code else sql
+
+
+def sql_fingerprint(sql):
+    """返回规范化 SQL 的短指纹，用于比较和缓存键"""
+    return hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest()[:16]
+
+
+# EXTRACT(... FROM x)、IS DISTINCT FROM x 中 FROM 后面不是表
+_NOT_TABLES = {'current_date', 'current_time', 'current_timestamp', 'localtime', 'localtimestamp'}
+_TABLE_REFERENCE = re.compile(r'(?<!distinct )\b(?:from|join)\s+((?:"?[a-z_][\w$]*"?\.)?"?[a-z_][\w$]*"?)')
+_CTE_NAME = re.compile(r'(?:\bwith(?:\s+recursive)?|,)\s*"?([a-z_][\w$]*)"?\s+as\s*\(')
+
+
+def referenced_tables(sql):
+    """返回 SQL 中 FROM / JOIN 引用的表名（小写、去重、排序），不含 WITH 定义的临时结果集"""
+    code = ' '.join(_LITERAL_SPLIT.split((sql or '').lower())[::2])
+    ctes = set(_CTE_NAME.findall(code))
+    tables = {name.replace('"', '') for name in _TABLE_REFERENCE.findall(code)}
+    return sorted(table for table in tables if table not in ctes and table not in _NOT_TABLES)
+
+
+def same_params(left, right):
+    """比较两组查询参数（LLM 返回的参数可能是数字字符串）"""
+    left, right = list(left or []), list(right or [])
+    return len(left) == len(right) and all(str(a) == str(b) for a, b in zip(left, right))
+
+
+# 别名位置上不可能出现的关键字（例如 CASE ... END 的 END）
+_NON_ALIAS_WORDS = {
+    'end', 'null', 'true', 'false', 'and', 'or', 'not', 'is', 'in', 'like', 'between',
+    'then', 'else', 'when', 'distinct', 'all', 'asc', 'desc', 'first', 'last'
+}
+_ORDER_ITEM = re.compile(r'^(.*?)(?:\s+(asc|desc))?(?:\s+nulls\s+(first|last))?$', re.S)
+
+
+def _mask_sql(sql):
+    """
+    返回与原 SQL 等长的掩码串：字面量内容替换为 x，括号内的内容替换为空格，
+    并统一小写。在掩码串上查找关键字和逗号，即可只匹配到最外层的语法结构。
+    """
+    masked = []
+    depth = 0
+    in_literal = False
+    for char in sql:
+        if in_literal:
+            if char == "'":
+                in_literal = False
+                masked.append(char)
+            else:
+                masked.append('x')
+        elif char == "'":
+            in_literal = True
+            masked.append(char if depth == 0 else ' ')
+        elif char == '(':
+            masked.append(char if depth == 0 else ' ')
+            depth += 1
+        elif char == ')':
+            depth = max(depth - 1, 0)
+            masked.append(char if depth == 0 else ' ')
+        else:
+            masked.append(char.lower() if depth == 0 else ' ')
+    return ''.join(masked)
+
+
+def _split_top_level(text, masked):
+    """按最外层逗号切分，返回原文片段"""
+    parts, start = [], 0
+    for index, char in enumerate(masked):
+        if char == ',':
+            parts.append(text[start:index].strip())
+            start = index + 1
+    parts.append(text[start:].strip())
+    return [part for part in parts if part]
+
+
+def _expression_key(expression):
+    return _WHITESPACE.sub(' ', expression.strip().lower())
+
+
+def parse_select(sql):
+    """
+    解析最外层 SELECT 语句，返回:
+    {
+        'items': [{'expression': ..., 'alias': ...}],   # 输出列，alias 可能为 None
+        'order_by': [{'expression': ..., 'descending': bool, 'nulls_first': bool}],
+        'has_star': bool,       # 输出列中含 *，列数无法静态确定
+        'compound': bool        # 含 UNION / INTERSECT / EXCEPT
+    }
+    无法识别为 SELECT 时返回 None
+    """
+    sql = (sql or '').strip().rstrip(';')
+    masked = _mask_sql(sql)
+
+    selects = [m for m in re.finditer(r'\bselect\b', masked)]
+    if not selects:
+        return None
+    select_match = selects[-1]
+    from_match = re.search(r'\bfrom\b', masked[select_match.end():])
+    list_start = select_match.end()
+    list_end = list_start + from_match.start() if from_match else len(sql)
+    distinct = re.match(r'\s*distinct\b', masked[list_start:list_end])
+    if distinct:
+        list_start += distinct.end()
+
+    items = []
+    for item in _split_top_level(sql[list_start:list_end], masked[list_start:list_end]):
+        item_masked = _mask_sql(item)
+        alias_match = re.search(r'\s+as\s+"?([a-z_][\w]*)"?\s*$', item_masked)
+        if not alias_match:
+            alias_match = re.search(r'(?<=[\w)\]"\'])\s+"?([a-z_][\w]*)"?\s*$', item_masked)
+            if alias_match and alias_match.group(1) in _NON_ALIAS_WORDS:
+                alias_match = None
+        if alias_match:
+            items.append({'expression': item[:alias_match.start()].strip(), 'alias': alias_match.group(1)})
+        else:
+            items.append({'expression': item, 'alias': None})
+
+    order_by = []
+    order_match = None
+    for match in re.finditer(r'\border\s+by\b', masked[list_end:]):
+        order_match = match
+    if order_match:
+        order_start = list_end + order_match.end()
+        tail = re.search(r'\b(limit|offset|fetch|for)\b', masked[order_start:])
+        order_end = order_start + tail.start() if tail else len(sql)
+        for item in _split_top_level(sql[order_start:order_end], masked[order_start:order_end]):
+            match = _ORDER_ITEM.match(_mask_sql(item).strip())
+            expression = item.strip()[:len(match.group(1))]
+            descending = match.group(2) == 'desc'
+            nulls = match.group(3)
+            order_by.append({
+                'expression': expression,
+                'descending': descending,
+                # PostgreSQL 默认: ASC 时 NULL 排最后，DESC 时 NULL 排最前
+                'nulls_first': nulls == 'first' if nulls else descending
+            })
+
+    return {
+        'items': items,
+        'order_by': order_by,
+        'has_star': any(item['expression'].endswith('*') for item in items),
+        'compound': bool(re.search(r'\b(union|intersect|except)\b', masked))
+    }
+
+
+def order_by_positions(sql):
+    """
+    把最外层 ORDER BY 映射到输出列的位置（从 1 开始）。
+    返回 [(位置, 是否降序, NULL 是否排前)]；语句无法静态分析、
+    或某个排序表达式不是输出列时返回 None。
+    """
+    parsed = parse_select(sql)
+    if not parsed or parsed['has_star'] or parsed['compound']:
+        return None
+
+    expressions = [_expression_key(item['expression']) for item in parsed['items']]
+    aliases = [item['alias'] for item in parsed['items']]
+    positions = []
+    for order in parsed['order_by']:
+        key = _expression_key(order['expression'])
+        if key.isdigit() and 1 <= int(key) <= len(expressions):
+            position = int(key)
+        elif key in aliases:
+            position = aliases.index(key) + 1
+        elif key in expressions:
+            position = expressions.index(key) + 1
+        else:
+            return None
+        positions.append((position, order['descending'], order['nulls_first']))
+    return positions
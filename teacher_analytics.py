@@ -0,0 +1,244 @@
+"""
+班级维度的教师分析
+
+班级按学号前缀选定（前缀为空时为全部学生）。每次计算只执行四条集合查询，
+整班数据按列聚合为数组（array_agg）一次取回，不逐个学生查询：
+- 实验报告：每个学生的已提交数、每个单元的已提交数（没有提交记录视为未提交）
+- 成绩：全部成绩与迟交天数
+- 学习行为：最近 activity_days 天按星期和小时汇总的活动次数与时长
+再用 NumPy 向量化计算完成率分位数与分布、成绩直方图、迟交天数分布和活动热力图。
+结果按刷新窗口缓存，同一窗口内的请求共用一次计算；缓存最多保留 max_entries 个班级（LRU），
+写入时先清除过期窗口的结果。
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = [10, 25, 50, 75, 90]
+# 与 SQL_TEMPLATES 中成绩等级一致的分段
+GRADE_BINS = [0, 60, 70, 80, 90, 100]
+GRADE_LABELS = ['不及格', '及格', '中等', '良好', '优秀']
+# 迟交天数分布的最后一档为 "≥ MAX_LATE_DAYS"
+MAX_LATE_DAYS = 7
+WEEKDAYS = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+
+STUDENT_COMPLETION_SQL = """
+    SELECT array_agg(COALESCE(done.submitted, 0))
+    FROM students s
+    LEFT JOIN (
+        SELECT lr.student_id, COUNT(*) AS submitted
+        FROM LabReport lr
+        WHERE lr.submitted AND lr.student_id LIKE %s
+        GROUP BY lr.student_id
+    ) done ON done.student_id = s.student_id
+    WHERE s.student_id LIKE %s
+"""
+
+UNIT_COMPLETION_SQL = """
+    SELECT ins.serial_number, ins.course_content, COUNT(lr.student_id)
+    FROM Intelligent_Supervision ins
+    LEFT JOIN LabReport lr
+        ON lr.serial_number = ins.serial_number AND lr.submitted AND lr.student_id LIKE %s
+    GROUP BY ins.serial_number, ins.course_content
+    ORDER BY ins.serial_number
+"""
+
+GRADES_SQL = """
+    SELECT array_agg(sg.grade::float8), array_agg(COALESCE(sg.late_days, 0))
+    FROM StudentGrades sg
+    WHERE sg.student_id LIKE %s AND sg.grade IS NOT NULL
+"""
+
+ACTIVITY_SQL = """
+    SELECT array_agg(cell.weekday), array_agg(cell.hour), array_agg(cell.activities), array_agg(cell.minutes)
+    FROM (
+        SELECT date_part('isodow', la.activity_date)::int AS weekday, date_part('hour', la.activity_date)::int AS hour,
+               COUNT(*) AS activities, COALESCE(SUM(la.duration_minutes), 0) AS minutes
+        FROM LearningActivity la
+        WHERE la.student_id LIKE %s AND la.activity_date >= now() - make_interval(days => %s)
+        GROUP BY 1, 2
+    ) cell
+"""
+
+
+def _like_prefix(prefix):
+    """学号前缀转换为 LIKE 模式"""
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+def _percentiles(values):
+    if values.size == 0:
+        return {f'p{p}': None for p in PERCENTILES}
+    return {f'p{p}': round(float(v), 4) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+def completion_stats(units, student_submitted, unit_submitted):
+    """
+    student_submitted: 每个学生已提交的报告数；unit_submitted: 每个单元已提交的学生数
+    返回学生完成率分位数与分布、各单元提交率
+    """
+    if student_submitted.size == 0 or not units:
+        return {'students': int(student_submitted.size), 'units': len(units),
+                'percentiles': _percentiles(np.empty(0)), 'histogram': [], 'at_risk_students': 0, 'by_unit': []}
+
+    per_student = student_submitted / len(units)
+    per_unit = unit_submitted / student_submitted.size
+    counts, edges = np.histogram(per_student, bins=10, range=(0, 1))
+    return {
+        'students': int(student_submitted.size),
+        'units': len(units),
+        'mean_rate': round(float(per_student.mean()), 4),
+        'percentiles': _percentiles(per_student),
+        'histogram': [
+            {'from': round(float(low), 2), 'to': round(float(high), 2), 'students': int(count)}
+            for low, high, count in zip(edges[:-1], edges[1:], counts)
+        ],
+        # 完成率不足一半的学生
+        'at_risk_students': int(np.count_nonzero(per_student < 0.5)),
+        'by_unit': [
+            {'serial_number': serial_number, 'course_content': course_content, 'rate': round(float(rate), 4)}
+            for (serial_number, course_content), rate in zip(units, per_unit)
+        ]
+    }
+
+
+def grade_stats(grades, late_days):
+    """成绩直方图（按成绩等级分段）、分位数与迟交天数分布"""
+    grade_counts, _ = np.histogram(grades, bins=GRADE_BINS)
+    late_counts = np.bincount(np.clip(late_days, 0, MAX_LATE_DAYS), minlength=MAX_LATE_DAYS + 1)
+    return {
+        'count': int(grades.size),
+        'mean': round(float(grades.mean()), 2) if grades.size else None,
+        'percentiles': _percentiles(grades),
+        'histogram': [
+            {'level': label, 'from': low, 'to': high, 'count': int(count)}
+            for label, low, high, count in zip(GRADE_LABELS, GRADE_BINS[:-1], GRADE_BINS[1:], grade_counts)
+        ],
+        'late_days': [
+            {'days': f'{days}+' if days == MAX_LATE_DAYS else str(days), 'count': int(count)}
+            for days, count in enumerate(late_counts)
+        ],
+        'on_time_rate': round(float(np.count_nonzero(late_days <= 0) / late_days.size), 4) if late_days.size else None
+    }
+
+
+def activity_heatmap(weekdays, hours, activities, minutes):
+    """按 (星期, 小时) 汇总的活动次数与学习分钟数展开为 7 × 24 热力图"""
+    counts = np.zeros((7, 24), dtype=np.int64)
+    total_minutes = np.zeros((7, 24), dtype=np.int64)
+    counts[weekdays - 1, hours] = activities
+    total_minutes[weekdays - 1, hours] = minutes
+    busiest = np.unravel_index(int(total_minutes.argmax()), total_minutes.shape) if weekdays.size else None
+    return {
+        'weekdays': WEEKDAYS,
+        'activities': counts.tolist(),
+        'minutes': total_minutes.tolist(),
+        'total_activities': int(counts.sum()),
+        'busiest': {'weekday': WEEKDAYS[busiest[0]], 'hour': int(busiest[1])} if busiest else None
+    }
+
+
+# 班级学号前缀：只允许数字，最长 8 位（学号前 8 位为入学年份、专业和班级）
+MAX_CLASS_PREFIX_LENGTH = 8
+
+
+def valid_class_prefix(class_prefix):
+    return class_prefix == '' or (class_prefix.isdigit() and len(class_prefix) <= MAX_CLASS_PREFIX_LENGTH)
+
+
+class TeacherAnalytics:
+    def __init__(self, db_pool, refresh_seconds=300, activity_days=28, max_entries=256):
+        self.db_pool = db_pool
+        self.refresh_seconds = refresh_seconds
+        self.activity_days = activity_days
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        # 每个班级一把锁，同一窗口内并发的请求只计算一次
+        self._key_locks = {}
+
+    def class_report(self, class_prefix=''):
+        """返回班级分析报告，同一刷新窗口内直接返回缓存；前缀不合法时抛出 ValueError"""
+        if not valid_class_prefix(class_prefix):
+            raise ValueError(f"班级前缀必须是不超过 {MAX_CLASS_PREFIX_LENGTH} 位的数字: {class_prefix!r}")
+        window = int(time.time() // self.refresh_seconds)
+        with self._lock:
+            cached = self._cache.get(class_prefix)
+            if cached and cached[0] == window:
+                self._cache.move_to_end(class_prefix)
+                metrics.incr('teacher_analytics.cache_hit')
+                return cached[1]
+            key_lock = self._key_locks.setdefault(class_prefix, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                cached = self._cache.get(class_prefix)
+                if cached and cached[0] == window:
+                    metrics.incr('teacher_analytics.cache_hit')
+                    return cached[1]
+
+            started = time.monotonic()
+            report = self._build_report(class_prefix)
+            report['generated_at'] = datetime.now().isoformat()
+            report['expires_at'] = datetime.fromtimestamp((window + 1) * self.refresh_seconds).isoformat()
+            elapsed_ms = (time.monotonic() - started) * 1000
+            metrics.observe('teacher_analytics.build_ms', elapsed_ms)
+            logger.info("班级分析已生成: 前缀 '%s', 耗时 %.0fms", class_prefix, elapsed_ms)
+
+            with self._lock:
+                self._store(class_prefix, window, report)
+            return report
+
+    def _store(self, class_prefix, window, report):
+        """写入缓存（调用方持有 _lock）：先清除过期窗口的结果，仍超出容量时淘汰最久未用的班级"""
+        for key in [key for key, (cached_window, _) in self._cache.items() if cached_window != window]:
+            self._evict(key)
+        self._cache[class_prefix] = (window, report)
+        self._cache.move_to_end(class_prefix)
+        while len(self._cache) > self.max_entries:
+            self._evict(next(iter(self._cache)))
+
+    def _evict(self, key):
+        del self._cache[key]
+        # 正在计算的线程仍持有这把锁的引用，之后的请求会新建一把
+        self._key_locks.pop(key, None)
+
+    def _build_report(self, class_prefix):
+        pattern = _like_prefix(class_prefix)
+        with self.db_pool.connection(read_only=True) as conn:
+            with conn.cursor() as cursor:
+                # 这些查询很快，JIT 编译的开销反而占大头
+                cursor.execute("SET LOCAL jit = off")
+                cursor.execute(STUDENT_COMPLETION_SQL, (pattern, pattern))
+                student_submitted = cursor.fetchone()[0]
+                cursor.execute(UNIT_COMPLETION_SQL, (pattern,))
+                unit_rows = cursor.fetchall()
+                cursor.execute(GRADES_SQL, (pattern,))
+                grades, late_days = cursor.fetchone()
+                cursor.execute(ACTIVITY_SQL, (pattern, self.activity_days))
+                weekdays, hours, activities, minutes = cursor.fetchone()
+
+        return {
+            'class_prefix': class_prefix,
+            'completion': completion_stats(
+                [(serial_number, course_content) for serial_number, course_content, _ in unit_rows],
+                np.array(student_submitted or [], dtype=np.float64),
+                np.array([submitted for _, _, submitted in unit_rows], dtype=np.float64)
+            ),
+            'grades': grade_stats(np.array(grades or [], dtype=np.float64),
+                                  np.array(late_days or [], dtype=np.int64)),
+            'activity': dict(activity_heatmap(np.array(weekdays or [], dtype=np.int64),
+                                              np.array(hours or [], dtype=np.int64),
+                                              np.array(activities or [], dtype=np.int64),
+                                              np.array(minutes or [], dtype=np.int64)),
+                             days=self.activity_days)
+        }
@@ -0,0 +1,512 @@
+"""
+查询遥测 - 每个问题的处理记录，供调整提示词、缓存和索引时分析
+
+每处理一个（子）问题记录一条：规范化的问题、意图、回答来源（模板 / 分类器 / 语义缓存 / 大模型 / 追问 / 细化）、
+SQL 指纹与规范化文本、涉及的表、结果行数、各阶段耗时和大模型 token 用量。
+
+记录先放入内存缓冲，由后台线程攒批写出，请求线程不做文件 I/O 和序列化。
+每批记录按列存成一行 JSON：数值列是数组，文本列做字典编码（本批不同取值的列表 + 每条记录的下标），
+压缩为一个 gzip 成员追加到当前分段文件（多个成员拼接仍是合法的 gzip 文件）。
+分段达到记录数上限后换新文件，超过保留个数的旧分段被删除。
+分析时整批读入 NumPy 数组，几百万条记录几秒内即可汇总。
+
+    python telemetry.py report --dir telemetry --top 20
+"""
+import argparse
+import atexit
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics
+from sql_analyzer import normalize_sql, referenced_tables, sql_fingerprint
+from text_features import normalize_question
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+# 字典编码的文本列与数值列；ts 存为相对本批 ts0 的毫秒数，耗时精确到 0.1 毫秒，
+# stages 是 {阶段名: 耗时数组}，未经过该阶段的记录为 null
+CATEGORICAL_FIELDS = ['question', 'intent', 'source', 'fingerprint', 'tables', 'status', 'sql']
+NUMERIC_FIELDS = ['ts', 'rows', 'total_ms', 'prompt_tokens', 'completion_tokens']
+SEGMENT_PATTERN = 'queries-*.jsonl.gz'
+USER_PLACEHOLDER = '{user_id}'
+
+# 回答来源
+SOURCE_TEMPLATE = 'template'
+SOURCE_CLASSIFIER = 'classifier'
+SOURCE_CACHE = 'cache'
+SOURCE_LLM = 'llm'
+SOURCE_FOLLOW_UP = 'follow_up'
+SOURCE_REFINEMENT = 'refinement'
+SOURCE_PRECOMPUTED = 'precomputed'
+# 调用大模型生成 SQL 的来源
+LLM_SOURCES = {SOURCE_LLM, SOURCE_FOLLOW_UP}
+
+# 当前正在处理的问题，跨线程执行时随 contextvars 复制
+_trace_var = contextvars.ContextVar('query_trace', default=None)
+
+
+class QueryTrace:
+    """一个问题的处理记录，各阶段在处理过程中通过模块级函数写入"""
+
+    def __init__(self, question, user_id=None):
+        self.ts = time.time()
+        self.started = time.perf_counter()
+        self.question = question
+        self.user_id = user_id
+        self.intent = None
+        self.source = None
+        self.sql = None
+        self.rows = 0
+        self.status = None
+        self.total_ms = None
+        self.stages = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add_stage(self, name, elapsed_ms):
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed_ms
+
+    def finish(self, result):
+        """根据处理结果填写意图、SQL、行数和状态"""
+        self.intent = result.get('query_type')
+        self.sql = result.get('sql')
+        self.rows = result.get('result_count', 0)
+        self.status = result.get('message_code') or ('OK' if result.get('success') else 'ERROR')
+
+
+@contextmanager
+def trace_query(sink, question, user_id=None):
+    """
+    在处理一个问题期间绑定 QueryTrace，结束时（含异常）交给 sink 写出；sink 为 None 时不记录。
+    异常按类名记为状态（如 QueryCancelled），并继续抛出
+    """
+    trace = QueryTrace(question, user_id)
+    token = _trace_var.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.status = type(e).__name__
+        raise
+    finally:
+        _trace_var.reset(token)
+        trace.total_ms = (time.perf_counter() - trace.started) * 1000
+        if sink is not None:
+            sink.record(trace)
+
+
+def set_source(source):
+    """记录当前问题的回答来源"""
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.source = source
+
+
+@contextmanager
+def stage(name):
+    """统计当前问题某个阶段的耗时（毫秒，同名阶段累加）"""
+    trace = _trace_var.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, (time.perf_counter() - started) * 1000)
+
+
+def add_stage_since(name, started):
+    """把从 started（time.perf_counter() 的值）到现在的耗时计入当前问题的某个阶段"""
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.add_stage(name, (time.perf_counter() - started) * 1000)
+
+
+def add_llm_usage(usage):
+    """累加大模型返回的 token 用量（流式响应最后一个分块中的 usage）"""
+    trace = _trace_var.get()
+    if trace is None or usage is None:
+        return
+    trace.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+    trace.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+
+class _DictionaryColumn:
+    """批内字典编码：不同取值只存一次，每条记录存下标"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = []
+        self._index = {}
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def to_json(self):
+        return {'values': self.values, 'codes': self.codes}
+
+
+def encode_batch(traces):
+    """把一批 QueryTrace 编码为按列存储的字典（在写出线程中调用）"""
+    columns = {field: _DictionaryColumn() for field in CATEGORICAL_FIELDS}
+    numeric = {field: [] for field in NUMERIC_FIELDS}
+    stage_names = sorted(set().union(*(trace.stages for trace in traces)))
+    stages = {name: [] for name in stage_names}
+    # 同一批里重复的 SQL 只计算一次指纹和表名
+    sql_info = {}
+    ts0 = min(trace.ts for trace in traces)
+
+    for trace in traces:
+        question = normalize_question(trace.question)
+        if trace.user_id:
+            question = question.replace(str(trace.user_id), USER_PLACEHOLDER)
+        info = sql_info.get(trace.sql)
+        if info is None:
+            info = sql_info[trace.sql] = (
+                (sql_fingerprint(trace.sql), ','.join(referenced_tables(trace.sql)), normalize_sql(trace.sql))
+                if trace.sql else (None, None, None)
+            )
+
+        columns['question'].append(question)
+        columns['intent'].append(trace.intent)
+        columns['source'].append(trace.source)
+        columns['fingerprint'].append(info[0])
+        columns['tables'].append(info[1])
+        columns['status'].append(trace.status)
+        columns['sql'].append(info[2])
+        numeric['ts'].append(int((trace.ts - ts0) * 1000))
+        numeric['rows'].append(trace.rows)
+        numeric['total_ms'].append(round(trace.total_ms, 1) if trace.total_ms is not None else None)
+        numeric['prompt_tokens'].append(trace.prompt_tokens)
+        numeric['completion_tokens'].append(trace.completion_tokens)
+        for name in stage_names:
+            value = trace.stages.get(name)
+            stages[name].append(round(value, 1) if value is not None else None)
+
+    return {'count': len(traces), 'ts0': round(ts0, 3),
+            **{field: column.to_json() for field, column in columns.items()}, **numeric, 'stages': stages}
+
+
+class TelemetrySink:
+    """攒批写出查询记录的后台写入器，分段文件名带进程号，多个工作进程可以写同一目录"""
+
+    def __init__(self, directory, batch_size=256, flush_interval=5.0, segment_records=100000, max_segments=200,
+                 max_pending=10000):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.max_pending = max_pending
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._segment_path = None
+        self._segment_records = 0
+        self._segment_seq = 0
+
+        self._thread = threading.Thread(target=self._flush_loop, name='telemetry-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, trace):
+        """登记一条记录；缓冲已满（写出跟不上）时丢弃"""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                metrics.incr('telemetry.dropped')
+                return
+            self._pending.append(trace)
+            full = len(self._pending) >= self.batch_size
+        metrics.incr('telemetry.recorded')
+        if full:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"写出查询遥测失败: {str(e)}")
+
+    def flush(self):
+        """把缓冲中的记录编码为一批写入当前分段"""
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            if self._segment_path is None or self._segment_records >= self.segment_records:
+                self._rotate()
+            self._append(encode_batch(batch))
+            self._segment_records += len(batch)
+            metrics.incr('telemetry.flushed', len(batch))
+
+    def _append(self, entry):
+        data = (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(self._segment_path, 'ab') as f:
+            f.write(compressor.compress(data) + compressor.flush())
+
+    def _rotate(self):
+        """开始新分段（第一行是格式说明），并删除超出保留个数的旧分段"""
+        self._segment_seq += 1
+        name = f"queries-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._segment_seq:04d}.jsonl.gz"
+        self._segment_path = os.path.join(self.directory, name)
+        self._segment_records = 0
+        self._append({'version': FORMAT_VERSION, 'categorical': CATEGORICAL_FIELDS, 'numeric': NUMERIC_FIELDS})
+
+        segments = sorted(glob.glob(os.path.join(self.directory, SEGMENT_PATTERN)), key=_mtime)
+        for path in segments[:max(0, len(segments) - self.max_segments)]:
+            if path != self._segment_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        """停止后台线程并写出剩余记录"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def read_segment(path):
+    """
+    读取一个分段，返回其中各批记录（encode_batch 的结果）。
+    写出过程中进程退出时最后一个 gzip 成员可能不完整，只读取完整的成员
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    batches = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            chunk = decompressor.decompress(data)
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        entry = json.loads(chunk)
+        if 'count' in entry:
+            batches.append(entry)
+        data = decompressor.unused_data
+    return batches
+
+
+class QueryTable:
+    """
+    载入内存的查询记录：文本列是全局字典下标数组（codes）加取值列表（values），
+    数值列和各阶段耗时是浮点数组（缺失为 NaN）
+    """
+
+    def __init__(self, batches):
+        codes = {field: [] for field in CATEGORICAL_FIELDS}
+        numeric = {field: [] for field in NUMERIC_FIELDS}
+        stages = {}
+        indexes = {field: {} for field in CATEGORICAL_FIELDS}
+        self.values = {field: [] for field in CATEGORICAL_FIELDS}
+        total = 0
+
+        for batch in batches:
+            count = batch['count']
+            for field in CATEGORICAL_FIELDS:
+                # 批内下标映射为全局下标；旧版本写出的批次缺少的列按空值处理
+                column = batch.get(field) or {'values': [None], 'codes': [0] * count}
+                index, values = indexes[field], self.values[field]
+                mapping = []
+                for value in column['values']:
+                    code = index.get(value)
+                    if code is None:
+                        code = index[value] = len(values)
+                        values.append(value)
+                    mapping.append(code)
+                codes[field].append(np.asarray(mapping, dtype=np.int64)[np.asarray(column['codes'],
+                                                                                   dtype=np.int64)])
+            for field in NUMERIC_FIELDS:
+                numeric[field].append(np.asarray(batch[field], dtype=float))
+            numeric['ts'][-1] = batch['ts0'] + numeric['ts'][-1] / 1000
+            for name, column in batch['stages'].items():
+                if name not in stages:
+                    stages[name] = [np.full(total, np.nan)]
+                stages[name].append(np.asarray(column, dtype=float))
+            for name in stages.keys() - batch['stages'].keys():
+                stages[name].append(np.full(count, np.nan))
+            total += count
+
+        self.count = total
+        self.codes = {field: np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+                      for field, parts in codes.items()}
+        self.numeric = {field: np.concatenate(parts) if parts else np.zeros(0) for field, parts in numeric.items()}
+        self.stages = {name: np.concatenate(parts) for name, parts in stages.items()}
+
+    def select(self, mask):
+        """按布尔掩码筛选记录（取值列表保持不变）"""
+        self.codes = {field: codes[mask] for field, codes in self.codes.items()}
+        self.numeric = {field: values[mask] for field, values in self.numeric.items()}
+        self.stages = {name: values[mask] for name, values in self.stages.items()}
+        self.count = int(np.count_nonzero(mask))
+
+    def counts(self, field, mask=None):
+        """各取值出现的次数（按取值下标）"""
+        codes = self.codes[field] if mask is None else self.codes[field][mask]
+        return np.bincount(codes, minlength=len(self.values[field]))
+
+
+def load_table(paths, since=None):
+    """读取多个分段，since 为起始时间戳"""
+    table = QueryTable(batch for path in paths for batch in read_segment(path))
+    if since is not None:
+        table.select(table.numeric['ts'] >= since)
+    return table
+
+
+def _percentiles(values):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'count': int(len(values)), 'mean': round(float(values.mean()), 2), 'p50': round(float(p50), 2),
+            'p90': round(float(p90), 2), 'p99': round(float(p99), 2), 'max': round(float(values.max()), 2)}
+
+
+def _mix(table, field):
+    counts = table.counts(field)
+    return {str(table.values[field][code]): {'count': int(counts[code]),
+                                             'share': round(float(counts[code]) / table.count, 4)}
+            for code in np.argsort(-counts, kind='stable') if counts[code]}
+
+
+def _codes_of(table, field, values):
+    return [code for code, value in enumerate(table.values[field]) if value in values]
+
+
+def analyze(table, top=20):
+    """
+    汇总查询记录：
+    - 意图、回答来源和状态的分布，各阶段耗时的分位数，token 用量
+    - 高频问题（规范化后）及其耗时
+    - 可缓存程度：问题完全重复的比例、大模型生成的 SQL 与之前重复的比例（理想缓存可省下的调用），
+      以及仍在反复调用大模型的高频问题
+    """
+    if not table.count:
+        return {'records': 0}
+
+    total_ms = table.numeric['total_ms']
+    question_codes = table.codes['question']
+    question_counts = table.counts('question')
+    top_queries = []
+    for code in np.argsort(-question_counts, kind='stable')[:top]:
+        if not question_counts[code]:
+            break
+        summary = _percentiles(total_ms[question_codes == code]) or {}
+        top_queries.append({'question': table.values['question'][code], 'count': int(question_counts[code]),
+                            'share': round(float(question_counts[code]) / table.count, 4),
+                            'mean_ms': summary.get('mean'), 'p90_ms': summary.get('p90')})
+
+    # 调用了大模型的记录：SQL 指纹与之前重复说明理想的缓存可以省下这次调用
+    llm_mask = np.isin(table.codes['source'], _codes_of(table, 'source', LLM_SOURCES))
+    llm_calls = int(np.count_nonzero(llm_mask))
+    fingerprint_codes = table.codes['fingerprint'][llm_mask]
+    fingerprint_codes = fingerprint_codes[np.isin(fingerprint_codes, _codes_of(table, 'fingerprint', {None}),
+                                                  invert=True)]
+    repeated_llm_sql = len(fingerprint_codes) - len(np.unique(fingerprint_codes))
+    llm_question_counts = table.counts('question', llm_mask)
+    top_llm_questions = [{'question': table.values['question'][code], 'llm_calls': int(llm_question_counts[code])}
+                         for code in np.argsort(-llm_question_counts, kind='stable')[:top]
+                         if llm_question_counts[code] > 1]
+    distinct_questions = int(np.count_nonzero(question_counts))
+
+    prompt_tokens = int(np.nansum(table.numeric['prompt_tokens']))
+    completion_tokens = int(np.nansum(table.numeric['completion_tokens']))
+    tables = Counter()
+    for code, count in enumerate(table.counts('tables')):
+        for name in (table.values['tables'][code] or '').split(','):
+            if name and count:
+                tables[name] += int(count)
+
+    ts = table.numeric['ts']
+    return {
+        'records': table.count,
+        'from': datetime.fromtimestamp(float(ts.min())).isoformat(timespec='seconds'),
+        'to': datetime.fromtimestamp(float(ts.max())).isoformat(timespec='seconds'),
+        'intent_mix': _mix(table, 'intent'),
+        'source_mix': _mix(table, 'source'),
+        'status_mix': _mix(table, 'status'),
+        'latency_ms': {'total': _percentiles(total_ms),
+                       **{name: _percentiles(values) for name, values in sorted(table.stages.items())}},
+        'tokens': {'prompt': prompt_tokens, 'completion': completion_tokens,
+                   'per_llm_call': round((prompt_tokens + completion_tokens) / llm_calls, 1) if llm_calls else None},
+        'cacheability': {
+            'distinct_questions': distinct_questions,
+            'repeated_question_rate': round((table.count - distinct_questions) / table.count, 4),
+            'answered_without_llm_rate': round(1 - llm_calls / table.count, 4),
+            'llm_calls': llm_calls,
+            'llm_repeated_sql_rate': round(repeated_llm_sql / llm_calls, 4) if llm_calls else None,
+            'top_llm_questions': top_llm_questions,
+        },
+        'top_queries': top_queries,
+        'top_tables': dict(tables.most_common(top)),
+    }
+
+
+def _parse_since(value):
+    """--since 接受 ISO 时间或 '24h' / '7d' 这样的相对时间"""
+    if not value:
+        return None
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if value[-1] in units and value[:-1].isdigit():
+        return time.time() - int(value[:-1]) * units[value[-1]]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查询遥测分析')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='高频问题、可缓存程度、耗时分位数与意图分布')
+    report_parser.add_argument('--dir', default=os.getenv('TELEMETRY_DIR', 'telemetry'))
+    report_parser.add_argument('--top', type=int, default=20)
+    report_parser.add_argument('--since', help="ISO 时间或相对时间（如 24h、7d）")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    paths = sorted(glob.glob(os.path.join(args.dir, SEGMENT_PATTERN)))
+    report = analyze(load_table(paths, _parse_since(args.since)), args.top)
+    report['segments'] = len(paths)
+    report['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""
+问题文本的特征提取 - 规范化与哈希字符 n-gram
+
+中文问题没有天然的词边界，按字符 n-gram 提取特征即可覆盖大部分同义表达，
+特征用 CRC32 哈希到固定维度，无需保存词表。
+"""
+import re
+import zlib
+
+import numpy as np
+
+# 匹配问题时忽略空白和标点
+_QUESTION_NOISE = re.compile(r'[\s，,；;？?。！!、:："“”\'‘’]+')
+
+
+def normalize_question(question):
+    """规范化问题文本：去除空白和标点并统一小写"""
+    return _QUESTION_NOISE.sub('', question or '').lower()
+
+
+def char_ngrams(text, ngram_range=(1, 3)):
+    """返回文本的全部字符 n-gram（含重复）"""
+    low, high = ngram_range
+    return [text[i:i + n] for n in range(low, high + 1) for i in range(len(text) - n + 1)]
+
+
+def hashed_counts(question, n_features, ngram_range=(1, 3)):
+    """
+    规范化问题并提取哈希后的字符 n-gram 计数。
+    返回 (特征下标, 计数)，下标升序且不重复
+    """
+    grams = char_ngrams(normalize_question(question), ngram_range)
+    indices = np.fromiter((zlib.crc32(gram.encode('utf-8')) % n_features for gram in grams),
+                          dtype=np.int64, count=len(grams))
+    indices, counts = np.unique(indices, return_counts=True)
+    return indices, counts.astype(np.float64)
@@ -0,0 +1,8 @@
+"""
+WSGI 入口
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from backend import create_app
+
+app = create_app()